@@ -0,0 +1,287 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  coverage_map.py
+#
+#  Copyright 2020 John Coppens <john@jcoppens.com>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#  Cobertura de los saltos, al estilo de AFL.
+#
+#  Cada destino de un salto, call, ret/reti o interrupción tiene una
+#  ubicación (un hash de su dirección). El salto desde el destino anterior
+#  (prev) al nuevo (cur) cuenta en la posición prev ^ cur de un bitmap de
+#  tamaño fijo, y prev pasa a ser cur >> 1 (así A -> B y B -> A no caen en
+#  la misma posición). Los contadores de varias ejecuciones se combinan por
+#  rangos (1, 2, 3, 4-7, 8-15, 16-31, 32-127, 128+), como en AFL, y merge
+#  indica si una ejecución encontró algo nuevo.
+#  Como el hash no se puede invertir, además se marcan las direcciones de
+#  destino: de ahí sale el listado de las instrucciones cubiertas.
+#
+
+import struct
+
+# Rango de cada contador (ver merge): un bit por rango
+BUCKETS = bytes([0, 1, 2, 4] + [8] * 4 + [16] * 8 + [32] * 16 +
+                [64] * 96 + [128] * 128)
+
+# Encabezado de los archivos: identificación, versión y tamaño del bitmap.
+# Sigue el bitmap y después los destinos (64K bytes).
+HEADER = struct.Struct("<8sHI")
+MAGIC = b"MSP430CV"
+VERSION = 1
+
+
+class Coverage_map():
+    """ Cobertura de los saltos en un bitmap de <size> contadores (una
+        potencia de 2). Se conecta al emulador con
+        MSP430_emulator.set_coverage.
+    """
+    def __init__(self, size = 65536):
+        assert size >= 2 and size & (size - 1) == 0
+        self.size = size
+        self.bitmap = bytearray(size)           # Contadores de la ejecución
+        self.targets = bytearray(0x10000)       # Destinos alcanzados
+        self.merged = bytearray(size)           # Rangos de todas (ver merge)
+        self.merged_targets = bytearray(0x10000)
+        self.runs = 0                           # Ejecuciones combinadas
+        self.prev = 0
+        # Ubicación de cada dirección: hash multiplicativo de la palabra
+        shift = 32 - (size.bit_length() - 1)
+        self.locations = [((pc >> 1) * 0x9e3779b1 & 0xffffffff) >> shift
+                          for pc in range(0x10000)]
+        self.edge = self.make_edge()
+        self.emu = None
+
+
+    def attach(self, emu):
+        """ Llamado por MSP430_emulator.set_coverage. La dirección actual
+            cuenta como el primer destino.
+        """
+        self.emu = emu
+        emu.add_hook("interrupt", self.interrupt)
+        self.edge(emu.registers.reg[0])
+
+
+    def detach(self):
+        """ Llamado por MSP430_emulator.set_coverage al desconectar la
+            cobertura
+        """
+        self.emu.remove_hook("interrupt", self.interrupt)
+        self.emu = None
+
+
+    def make_edge(self):
+        """ Construir la función edge(pc), que registra el salto al destino
+            <pc> (los contadores no pasan de 255). Es una clausura para no
+            buscar los atributos en cada salto.
+        """
+        cover = self
+        bitmap, targets, locations = self.bitmap, self.targets, self.locations
+
+        def edge(pc):
+            cur = locations[pc]
+            i = cover.prev ^ cur
+            count = bitmap[i]
+            if count < 255:
+                bitmap[i] = count + 1
+            cover.prev = cur >> 1
+            targets[pc] = 1
+
+        return edge
+
+
+    def interrupt(self, vector, pc, sp, cycles):
+        """ Registrar el salto a la rutina de interrupción (hook
+            "interrupt")
+        """
+        self.edge(self.emu.registers.reg[0])
+
+
+    def reset(self, pc = None):
+        """ Borrar la cobertura de la ejecución (no la combinada con merge).
+            Con <pc>, esa dirección cuenta como el primer destino (como en
+            attach).
+        """
+        self.bitmap[:] = bytes(self.size)
+        self.targets[:] = bytes(0x10000)
+        self.prev = 0
+        if pc is not None:
+            self.edge(pc)
+
+
+    def export(self):
+        """ Copia de los contadores de la ejecución
+        """
+        return bytes(self.bitmap)
+
+
+    @property
+    def edges(self):
+        """ Posiciones del bitmap tocadas en la ejecución
+        """
+        return self.size - self.bitmap.count(0)
+
+
+    @property
+    def merged_edges(self):
+        """ Posiciones del bitmap tocadas en alguna de las ejecuciones
+            combinadas
+        """
+        return self.size - self.merged.count(0)
+
+
+    def merge(self, bitmap = None, targets = None):
+        """ Combinar los contadores <bitmap> (y los destinos <targets>) de
+            una ejecución con los anteriores; por omisión, los de la
+            ejecución actual. Retorna True si aparece un salto nuevo o un
+            contador en un rango nuevo.
+        """
+        if bitmap is None:
+            bitmap, targets = self.bitmap, self.targets
+        assert len(bitmap) == self.size
+        ranges = int.from_bytes(bytes(bitmap).translate(BUCKETS), "little")
+        old = int.from_bytes(self.merged, "little")
+        new = ranges & ~old != 0
+        if new:
+            self.merged[:] = (old | ranges).to_bytes(self.size, "little")
+        if targets is not None:
+            reached = int.from_bytes(targets, "little") | \
+                      int.from_bytes(self.merged_targets, "little")
+            self.merged_targets[:] = reached.to_bytes(0x10000, "little")
+        self.runs += 1
+        return new
+
+
+    def save(self, filename):
+        """ Guardar los contadores y los destinos de la ejecución
+        """
+        with open(filename, "wb") as f:
+            f.write(HEADER.pack(MAGIC, VERSION, self.size))
+            f.write(self.bitmap)
+            f.write(self.targets)
+
+
+    def covered(self):
+        """ Destinos alcanzados en la ejecución o en las combinadas
+            (un byte por dirección)
+        """
+        reached = int.from_bytes(self.targets, "little") | \
+                  int.from_bytes(self.merged_targets, "little")
+        return reached.to_bytes(0x10000, "little")
+
+
+    def report(self, disassembler, start = 0, end = 0x10000):
+        """ Generar el listado de las instrucciones entre <start> y <end>
+            (excluido), marcando con '+' las cubiertas. <disassembler> es un
+            MSP430_disassembler con el programa cargado. Una instrucción
+            está cubierta si es el destino de un salto, o sigue a una
+            cubierta que no salta. La última línea es el resumen.
+        """
+        from msp430 import MSP430
+        reached = self.covered()
+        memory = disassembler.memory
+        total = hits = 0
+        for addr, data in memory.initialized_runs(start, end):
+            stop = addr + len(data)
+            pc = (addr + 1) & ~1
+            covered = False
+            while pc + 2 <= stop:
+                dec = MSP430.DECODE[memory.read_word(pc)]
+                length = 2 if dec is None else 2 + 2 * (dec.src_ext + dec.dst_ext)
+                if dec is None or pc + length > stop:
+                    # Datos
+                    yield "    {:04x}  .word   0x{:04x}".format(pc, memory.read_word(pc))
+                    covered = False
+                    pc += 2
+                    continue
+                covered = covered or reached[pc] != 0
+                total += 1
+                hits += covered
+                yield "{}   {:04x}  {}".format("+" if covered else " ", pc,
+                                               disassembler.disassemble_one(pc)[1])
+                if MSP430.is_transfer(dec):
+                    covered = False
+                pc += length
+        yield "{} de {} instrucciones cubiertas ({:.1f}%), {} posiciones del bitmap".format(
+                    hits, total, 100 * hits / total if total else 0,
+                    self.merged_edges if self.runs else self.edges)
+
+
+def read_coverage(filename):
+    """ Leer un archivo generado por Coverage_map.save. Retorna (bitmap,
+        targets), para Coverage_map.merge.
+    """
+    with open(filename, "rb") as f:
+        magic, version, size = HEADER.unpack(f.read(HEADER.size))
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("{}: no es un archivo de cobertura".format(filename))
+        bitmap = f.read(size)
+        targets = f.read(0x10000)
+    if len(bitmap) != size or len(targets) != 0x10000:
+        raise ValueError("{}: archivo de cobertura incompleto".format(filename))
+    return bitmap, targets
+
+
+def test_coverage():
+    """ El mismo programa con distintos valores en r4: cada valor nuevo
+        recorre otros caminos
+    """
+    from memory import Memory
+    from msp430 import MSP430_emulator, MSP430_disassembler
+
+    program = (0x9034, 10,              # cmp   #10, r4
+               0x2c07,                  # jhs   fc14
+               0x4406,                  # mov   r4, r6
+               0x12b0, 0xfc16,          # call  #fc16
+               0x9034, 5,               # cmp   #5, r4
+               0x2001,                  # jne   fc14
+               0x5315,                  # inc   r5
+               0x3fff,                  # jmp   $           (fc14)
+               0x8316,                  # dec   r6          (fc16)
+               0x23fe,                  # jnz   fc16
+               0x4130)                  # ret
+
+    memory = Memory()
+    memory.reserve("ROM", 0xfc00, 1024, "R")
+    memory.reserve("RAM", 0x1c00, 1024, "RW")
+    memory.write_block(0xfc00, b"".join(w.to_bytes(2, "little") for w in program))
+    memory.write_word(0xfffe, 0xfc00)
+
+    emu = MSP430_emulator(memory)
+    coverage = Coverage_map()
+    emu.set_coverage(coverage)
+    snap = emu.snapshot()
+    for r4 in (20, 3, 4, 15):
+        emu.restore(snap)
+        coverage.reset(0xfc00)
+        emu.registers.set_reg(4, r4)
+        emu.run(100)
+        print("r4 = {:>2}: {:>3} saltos, nuevo: {}".format(
+                    r4, coverage.edges, coverage.merge()))
+
+    for line in coverage.report(MSP430_disassembler(memory), 0xfc00, 0xfc1c):
+        print(line)
+
+
+def main(args):
+    test_coverage()
+    return 0
+
+if __name__ == '__main__':
+    import sys
+    sys.exit(main(sys.argv))
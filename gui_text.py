@@ -34,7 +34,7 @@
 #       Modificacion de dump y dump_words en memory.py requirio modificacion
 #       en las llamadas.
 
-from memory import Memory
+from memory import Memory, Memory_error
 from msp430 import MSP430_disassembler, MSP430_emulator, MSP430_assembler
 import pdb, os
 
@@ -51,6 +51,7 @@ def help():
           "d                    Desensamblar memoria\n"
           "n                    Ejecutar una linea de codigo\n"
           "s                    Ejecutar una instrucción\n"
+          "g [<addr> ...]       Ejecutar hasta un breakpoint (o hasta el final)\n"
           "r                    Ver registros\n"
           "r <reg> <valor>      Modificar registros. <reg> válidos son: \n"
           "                     C, Z, N, V, NCPU, NOSC, GIE, SCG1, SCG2\n"
@@ -66,7 +67,10 @@ def commands():
         if len(parts) != 2:
             print('Comando "lf" necesita el nombre del archivo')
             return
-        memory.load_intel(parts[1])
+        try:
+            print(memory.load_intel(parts[1]), "bytes cargados")
+        except (Memory_error, OSError) as err:
+            print(err)
 
     COMMANDS = {"lf": cmd_lf}
 
@@ -99,15 +103,17 @@ def commands():
             source = ' '.join(parts[2:])
             result = asm.assemble_line(' ' + source)
             print("Result:", result)
-            for w in result[0]:
-                memory.write_word(addr, w)
-                addr += 2
+            memory.write_block(addr, b"".join(
+                        (w & 0xffff).to_bytes(2, "little") for w in result[0]))
 
         elif parts[0] == "lf":
             if len(parts) != 2:
                 print('Comando "lf" necesita el nombre del archivo')
                 continue
-            print(memory.load_intel(parts[1]))
+            try:
+                print(memory.load_intel(parts[1]), "bytes cargados")
+            except (Memory_error, OSError) as err:
+                print(err)
 
         elif parts[0] == "m":
             if len(parts) == 2:
@@ -152,6 +158,17 @@ def commands():
             emu.single_step()
             emu.registers.dump()
 
+        elif parts[0] == "g":
+            try:
+                breakpoints = [int(p, 0) for p in parts[1:]]
+            except ValueError:
+                print("Esperaba valores numéricos para los breakpoints")
+                continue
+            result = emu.run_until(breakpoints, 100000)
+            print("Detenido ({}) en 0x{:04x} después de {} instrucciones".format(
+                        result.reason, result.pc, result.count))
+            emu.registers.dump()
+
         elif parts[0] == "q":
             break
 
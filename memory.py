@@ -31,10 +31,38 @@ import pdb
 TEST_FILE = "tests/test.hex"
 TEST_OUTPUT_FILE = "tests/test_output.hex"
 
+# Mapa de páginas: el espacio de 64K se divide en páginas de 256 bytes
+PAGE_BITS = 8
+PAGE_SIZE = 1 << PAGE_BITS
+NR_PAGES = 0x10000 >> PAGE_BITS
+PAGE_MASK = NR_PAGES - 1
+
+
+class Memory_error(Exception):
+    """ Errores en el manejo de la memoria (areas superpuestas, direcciones
+        fuera de las areas reservadas, ...)
+    """
+    pass
+
+
+class Intel_hex_error(Memory_error):
+    """ Error en un archivo Intel HEX. Indica el archivo y la línea.
+    """
+    def __init__(self, filename, lineno, msg):
+        super(Intel_hex_error, self).__init__(
+                    "{}:{}: {}".format(filename, lineno, msg))
+        self.filename, self.lineno, self.msg = filename, lineno, msg
+
+
 class Memory_area:
-    def __init__(self, base, size, kind):
+    def __init__(self, base, size, kind, id = None):
         self.base, self.size, self.kind = base, size, kind
-        self.mem = [None] * self.size # Inicializo toda la memoria con None
+        self.end = base + size
+        self.id = id
+        # Contenido de la memoria (un byte por dirección) y, por separado,
+        # un mapa de 'inicializado' (1 si la dirección fue escrita, 0 si no)
+        self.mem = bytearray(self.size)
+        self.init = bytearray(self.size)
 
 
     def get_size(self):
@@ -49,140 +77,586 @@ class Memory_area:
         """
         Retorna true si está inicializada
         """
-        return self.mem[addr - self.base] != None
+        return self.init[addr - self.base] != 0
 
 
     def read(self, addr, check_initialized = True):
+        """ Retorna el byte en <addr>, o None si no está inicializado
+            (y check_initialized es False)
+        """
         assert (addr - self.base) < self.size # si es false, se lanza excepción
         if check_initialized:
             assert self.initialized(addr)
+        elif not self.init[addr - self.base]:
+            return None
 
         return self.mem[addr - self.base]
 
 
     def read_word(self, addr, check_initialized = True):
+        """ Retorna la palabra en <addr>. Los bytes no inicializados se leen
+            como 0 si check_initialized es False.
+        """
         assert (addr - self.base) < self.size    # Rango direccion correcto?
         assert (addr % 2) == 0                   # Direccion debe ser par, porque es word
+        offs = addr - self.base
         if check_initialized:
-            assert self.initialized(addr)        # Contenido inicializado?
-            assert self.initialized(addr+1)      # Contenido inicializado?
+            assert self.init[offs]               # Contenido inicializado?
+            assert self.init[offs+1]             # Contenido inicializado?
 
-        return ( self.mem[addr   - self.base] +
-                (self.mem[addr+1 - self.base] << 8))
+        mem = self.mem
+        return mem[offs] | (mem[offs+1] << 8)
 
 
     def write(self, addr, value):
         assert (addr - self.base) < self.size
 
-        self.mem[addr - self.base] = value
+        offs = addr - self.base
+        self.mem[offs] = value & 0xff
+        self.init[offs] = 1
 
 
     def write_word(self, addr, value):
         assert (addr - self.base) < self.size
         assert (addr % 2) == 0           # Direccion debe ser par
 
-        self.mem[addr   - self.base] = value & 0xff
-        self.mem[addr+1 - self.base] = value >> 8
+        offs = addr - self.base
+        self.mem[offs]   = value & 0xff
+        self.mem[offs+1] = (value >> 8) & 0xff
+        self.init[offs] = self.init[offs+1] = 1
+
+
+    def write_block(self, addr, data):
+        """ Escribir los bytes de <data> a partir de <addr>
+        """
+        offs = addr - self.base
+        n = len(data)
+        assert 0 <= offs and offs + n <= self.size
+
+        self.mem[offs:offs + n] = data
+        self.init[offs:offs + n] = b"\x01" * n
+
+
+    def read_block(self, addr, n, check_initialized = True):
+        """ Retorna (como bytes) los <n> bytes a partir de <addr>
+        """
+        offs = addr - self.base
+        assert 0 <= offs and offs + n <= self.size
+        if check_initialized:
+            assert self.init.find(0, offs, offs + n) < 0
+
+        return bytes(self.mem[offs:offs + n])
+
+
+    def view(self):
+        """ Retorna un memoryview (de sólo lectura, sin copiar) del contenido
+            del area
+        """
+        return memoryview(self.mem).toreadonly()
 
 
     def range_empty(self, start, end):
-        # ~ pdb.set_trace()
-        for a in range(start, end):
-            if self.mem[a] is not None: return False
-        return True
+        """ Retorna True si ninguna de las direcciones entre start y end
+            (excluido) está inicializada
+        """
+        return self.init.find(1, max(start - self.base, 0),
+                                 max(end - self.base, 0)) < 0
 
 
-    def dump(self):
-        """ Crear el listado de la memoria (en bytes) en forma de un string
-            (principalmente pensado para uso con GUI)
+    def iter_dump(self, start = None, end = None, words = False):
+        """ Generador: retorna las líneas (de 16 bytes) del listado de la
+            memoria entre start y end (direcciones, por defecto toda el area).
+            Las líneas sin contenido inicializado se omiten.
         """
         LINE_LENGTH = 16
-        s = ''
-        for addr in range(self.size):
-            if self.range_empty(addr, addr + LINE_LENGTH):
-                continue
+        start = self.base if start is None else max(start, self.base)
+        end = self.end if end is None else min(end, self.end)
+        mem, init = self.mem, self.init
+
+        offs = (start - self.base) - (start - self.base) % LINE_LENGTH
+        last = end - self.base
+        while offs < last:
+            # Saltar directamente a la próxima línea con contenido
+            nxt = init.find(1, max(offs, start - self.base), last)
+            if nxt < 0:
+                break
+            offs = nxt - nxt % LINE_LENGTH
+            lo = max(offs, start - self.base)
+            hi = min(offs + LINE_LENGTH, last)
+
+            parts = ["{:04x}:".format(lo + self.base)]
+            if words:
+                for a in range(lo, hi - 1, 2):
+                    if init[a] and init[a+1]:
+                        parts.append("{:04x}".format(mem[a] | (mem[a+1] << 8)))
+                    else:
+                        parts.append("----")
+            else:
+                for a in range(lo, hi):
+                    parts.append("{:02x}".format(mem[a]) if init[a] else "--")
+            yield " ".join(parts) + " "
+            offs += LINE_LENGTH
 
-            if (addr % LINE_LENGTH) == 0:
-                s += "\n{:04x}: ".format(addr + self.base)
 
-            if self.mem[addr] is None:
-                s += "-- "
-            else:
-                s += "{:02x} ".format(self.read(addr + self.base))
-        return s
+    def dump(self, start = None, end = None):
+        """ Crear el listado de la memoria (en bytes) en forma de un string
+            (principalmente pensado para uso con GUI)
+        """
+        return "".join("\n" + line for line in self.iter_dump(start, end))
 
 
-    def dump_words(self):
+    def dump_words(self, start = None, end = None):
         """ Crear el listado de la memoria (en words) en forma de un string
             (principalmente pensado para uso con GUI)
         """
-        LINE_LENGTH = 16
-        s = ''
-        for addr in range(0, self.size, 2):
-            if self.range_empty(addr, addr + LINE_LENGTH):
-                continue
+        return "".join("\n" + line
+                        for line in self.iter_dump(start, end, words = True))
 
-            if (addr % LINE_LENGTH) == 0:
-                s += "\n{:04x}: ".format(addr + self.base)
+    def dump_mem_w(self, start = None, end = None):
+        """ Listado de las palabras entre start y end (por defecto toda el
+            area) separadas por comas (para las celdas de la GUI)
+        """
+        lo = 0 if start is None else max(start - self.base, 0)
+        hi = self.size if end is None else min(end - self.base, self.size)
+        mem, init = self.mem, self.init
+        return "".join("0x{:04x} ,".format(mem[a] | (mem[a+1] << 8))
+                            if init[a] else "- - - -,"
+                       for a in range(lo - lo % 2, hi - 1, 2))
 
-            if self.mem[addr] is None:
-                s += "---- "
-            else:
-                s += "{:04x} ".format(self.read_word(addr + self.base))
-        return s
-
-    def dump_mem_w(self):
-        s = ''
-        for addr in range(0, self.size, 2):
-            if self.mem[addr] is None:
-                s += "- - - -,"
-            else:
-                s += "0x{:04x} ,".format(self.read_word(addr + self.base))
-                       
-        return s
+
+class Page_watch:
+    """ Observadores de los accesos a una página (ver Memory.watch_page)
+    """
+    def __init__(self):
+        self.readers = []       # reader(addr, length, value)
+        self.writers = []       # writer(addr, length, value, old)
+
+
+class Memory_trap:
+    """ Reemplaza a un area en el mapa de páginas de una página vigilada.
+        Las lecturas y escrituras se hacen en el area, y después se avisa a
+        los observadores de la página (<watch>). Sólo las páginas vigiladas
+        pasan por aquí: el resto de la memoria no se hace más lenta.
+    """
+    def __init__(self, area, watch):
+        self.area = area
+        self.base, self.end, self.mem = area.base, area.end, area.mem
+        self.watch = watch
+
+
+    def __getattr__(self, name):
+        return getattr(self.area, name)
+
+
+    def read(self, addr, check_initialized = True):
+        value = self.area.read(addr, check_initialized)
+        for reader in self.watch.readers:
+            reader(addr, 1, value)
+        return value
+
+
+    def read_word(self, addr, check_initialized = True):
+        value = self.area.read_word(addr, check_initialized)
+        for reader in self.watch.readers:
+            reader(addr, 2, value)
+        return value
+
+
+    def write(self, addr, value):
+        old = self.area.read(addr, False) or 0
+        self.area.write(addr, value)
+        for writer in self.watch.writers:
+            writer(addr, 1, value & 0xff, old)
+
+
+    def write_word(self, addr, value):
+        old = self.area.read_word(addr, False)
+        self.area.write_word(addr, value)
+        for writer in self.watch.writers:
+            writer(addr, 2, value & 0xffff, old)
+
+
+class Memory_snapshot:
+    """ Estado de la memoria en el momento de Memory.snapshot(). No se copia
+        nada al crearla: antes de la primera escritura a una página, se
+        guarda el contenido original de la página en el 'journal' (copy on
+        write). Restaurar sólo copia de vuelta esas páginas.
+    """
+    def __init__(self):
+        self.journal = {}       # página -> [(area, offs, mem, init), ...]
 
 
 class Memory:
     def __init__(self):
         self.areas = {}
+        self.start_address = None   # Registro 3/5 del último archivo Intel
+        # Para cada página, el area que la contiene (o None). Si una página
+        # es compartida por dos areas, apunta a la primera: area_at verifica
+        # los límites y recurre a la búsqueda lineal para la otra.
+        self.pages = [None] * NR_PAGES
+        # Registro de cambios: cada escritura incrementa write_seq y marca
+        # la página con ese número (ver changes_since)
+        self.write_seq = 0
+        self.page_stamp = [0] * NR_PAGES
+        self.subscribers = []
+        # Páginas vigiladas: página -> Page_watch (ver watch_page)
+        self.watches = {}
+        # Snapshots activos (el último es el que recibe las páginas copiadas)
+        self.snapshots = []
+        self.journal = None
 
 
     def reserve(self, id, base, size, kind):
-        self.areas[id] = Memory_area(base, size, kind)
+        """ Reservar un area de memoria. Genera Memory_error si el area se
+            superpone con otra ya reservada.
+        """
+        if id in self.areas:
+            self.release(id)
+
+        for other in self.areas.values():
+            if base < other.end and other.base < base + size:
+                raise Memory_error(
+                    "Area {} (0x{:04x}-0x{:04x}) superpuesta con {}".format(
+                        id, base, base + size - 1, other.id))
+
+        area = Memory_area(base, size, kind, id)
+        self.areas[id] = area
+        self.map_pages(area)
+
+
+    def release(self, id):
+        """ Liberar el area <id> (y reconstruir el mapa de páginas)
+        """
+        del self.areas[id]
+        self.pages = [None] * NR_PAGES
+        for area in self.areas.values():
+            self.map_pages(area)
+        for page in self.watches:
+            self.trap_page(page)
+
+
+    def map_pages(self, area):
+        """ Agregar las páginas de <area> al mapa de páginas
+        """
+        for page in range(area.base >> PAGE_BITS, ((area.end - 1) >> PAGE_BITS) + 1):
+            if self.pages[page & PAGE_MASK] is None:
+                self.pages[page & PAGE_MASK] = area
+                if page & PAGE_MASK in self.watches:
+                    self.trap_page(page & PAGE_MASK)
+
+
+    def area_at(self, addr):
+        """ Retorna el area (Memory_area) que contiene <addr>, o None
+        """
+        area = self.pages[(addr >> PAGE_BITS) & PAGE_MASK]
+        if area is not None and area.base <= addr < area.end:
+            return area.area if area.__class__ is Memory_trap else area
+        for area in self.areas.values():
+            if area.base <= addr < area.end:
+                return area
+        return None
+
+
+    def access_area(self, addr):
+        """ Como area_at, pero si la página de <addr> está vigilada retorna
+            un Memory_trap (para el caso de las páginas compartidas por dos
+            areas: el mapa de páginas sólo apunta a la primera)
+        """
+        area = self.area_at(addr)
+        watch = self.watches.get((addr >> PAGE_BITS) & PAGE_MASK)
+        if area is not None and watch is not None:
+            return Memory_trap(area, watch)
+        return area
+
+
+    def watch_page(self, page, reader = None, writer = None):
+        """ Vigilar los accesos a la página <page>: después de cada lectura
+            se llama a reader(addr, length, value), y después de cada
+            escritura a writer(addr, length, value, old) (<old> es el valor
+            anterior; los bytes no inicializados valen 0). Se vigilan
+            las lecturas y escrituras de read, read_word, write y write_word
+            (las del procesador); no las de write_block, ni la búsqueda de
+            instrucciones (fetch_word).
+        """
+        watch = self.watches.get(page)
+        if watch is None:
+            watch = self.watches[page] = Page_watch()
+        if reader is not None:
+            watch.readers.append(reader)
+        if writer is not None:
+            watch.writers.append(writer)
+        self.trap_page(page)
+
+
+    def unwatch_page(self, page, reader = None, writer = None):
+        """ Retirar los observadores registrados con watch_page
+        """
+        watch = self.watches[page]
+        if reader is not None:
+            watch.readers.remove(reader)
+        if writer is not None:
+            watch.writers.remove(writer)
+        if not (watch.readers or watch.writers):
+            del self.watches[page]
+            area = self.pages[page]
+            if area is not None and area.__class__ is Memory_trap:
+                self.pages[page] = area.area
+
+
+    def trap_page(self, page):
+        """ Poner un Memory_trap en el mapa de páginas, en lugar del area
+            de la página vigilada <page>
+        """
+        area = self.pages[page]
+        if area is not None and area.__class__ is not Memory_trap:
+            self.pages[page] = Memory_trap(area, self.watches[page])
 
 
     def locate_area(self, addr):
         """ Ubicar en cual area de memoria se encuentra <addr>
             Si encuentra el area, devuelve al id, sino None
         """
-        for id, area in self.areas.items():
-            if area.base <= addr  < area.base + area.size:
-                return id
-        return None
+        area = self.area_at(addr)
+        return None if area is None else area.id
 
 
     def initialized(self, addr):
-        id = self.locate_area(addr)
-        assert id != None
-        return self.areas[id].initialized(addr)
+        area = self.area_at(addr)
+        assert area != None
+        return area.initialized(addr)
 
 
     def write(self, addr, byte):
-        id = self.locate_area(addr)
-        assert id != None
-        self.areas[id].write(addr, byte)
+        area = self.pages[(addr >> PAGE_BITS) & PAGE_MASK]
+        if area is None or not area.base <= addr < area.end:
+            area = self.access_area(addr)
+            assert area != None
+        if self.journal is not None:
+            self.save_pages(addr, 1)
+        area.write(addr, byte)
+        self.write_seq += 1
+        self.page_stamp[(addr >> PAGE_BITS) & PAGE_MASK] = self.write_seq
+        if self.subscribers:
+            self.notify(addr, 1)
+
+
+    def read(self, addr, check_initialized = True):
+        area = self.pages[(addr >> PAGE_BITS) & PAGE_MASK]
+        if area is None or not area.base <= addr < area.end:
+            area = self.access_area(addr)
+            assert area != None
+        return area.read(addr, check_initialized)
 
 
     def read_word(self, addr, check_initialized = True):
-        id = self.locate_area(addr)
-        assert id != None # assertion si es None
-        return self.areas[id].read_word(addr, check_initialized)
+        area = self.pages[(addr >> PAGE_BITS) & PAGE_MASK]
+        if area is None or not area.base <= addr < area.end:
+            area = self.access_area(addr)
+            assert area != None # assertion si es None
+        return area.read_word(addr, check_initialized)
 
 
     def write_word(self, addr, w):
-        id = self.locate_area(addr)
-        assert id != None
-        return self.areas[id].write_word(addr, w)
+        area = self.pages[(addr >> PAGE_BITS) & PAGE_MASK]
+        if area is None or not area.base <= addr < area.end:
+            area = self.access_area(addr)
+            assert area != None
+        if self.journal is not None:
+            self.save_pages(addr, 2)
+        area.write_word(addr, w)
+        self.write_seq += 1
+        self.page_stamp[(addr >> PAGE_BITS) & PAGE_MASK] = self.write_seq
+        if self.subscribers:
+            self.notify(addr, 2)
+
+
+    def fetch_word(self, addr):
+        """ Acceso rápido (sin verificaciones) a la palabra en <addr>.
+            Los bytes no inicializados se leen como 0.
+        """
+        area = self.pages[(addr >> PAGE_BITS) & PAGE_MASK]
+        if area is None or not area.base <= addr < area.end:
+            area = self.area_at(addr)
+            if area is None:
+                raise Memory_error("Dirección 0x{:04x} fuera de memoria".format(addr))
+        mem = area.mem
+        offs = addr - area.base
+        return mem[offs] | (mem[offs+1] << 8)
+
+
+    def write_block(self, addr, data):
+        """ Escribir los bytes de <data> a partir de <addr>. El bloque puede
+            extenderse sobre varias areas contiguas. Genera Memory_error si
+            alguna parte cae fuera de las areas reservadas: en ese caso no se
+            escribe nada.
+        """
+        data = memoryview(data)
+        start, length = addr, len(data)
+        # Verificar todo el rango antes de escribir
+        chunks = []
+        while addr < start + length:
+            area = self.area_at(addr)
+            if area is None:
+                raise Memory_error("Dirección 0x{:04x} fuera de memoria".format(addr))
+            n = min(start + length - addr, area.end - addr)
+            chunks.append((area, addr, n))
+            addr += n
+        if self.journal is not None:
+            self.save_pages(start, length)
+        for area, addr, n in chunks:
+            area.write_block(addr, data[addr - start:addr - start + n])
+        self.changed(start, length)
+
+
+    def changed(self, addr, length):
+        """ Registrar que se modificaron <length> bytes a partir de <addr>
+            (marcar las páginas y avisar a los suscriptores)
+        """
+        if length <= 0:
+            return
+        self.write_seq += 1
+        for page in range(addr >> PAGE_BITS, ((addr + length - 1) >> PAGE_BITS) + 1):
+            self.page_stamp[page & PAGE_MASK] = self.write_seq
+        if self.subscribers:
+            self.notify(addr, length)
+
+
+    def notify(self, addr, length):
+        for callback in self.subscribers:
+            callback(addr, length)
+
+
+    def subscribe(self, callback):
+        """ Registrar <callback>, que será llamado como callback(addr, length)
+            después de cada escritura a la memoria
+        """
+        self.subscribers.append(callback)
+
+
+    def unsubscribe(self, callback):
+        self.subscribers.remove(callback)
+
+
+    def snapshot(self):
+        """ Retorna un Memory_snapshot del estado actual (ver restore).
+            El costo es O(1): las páginas se copian recién al escribirlas.
+        """
+        snap = Memory_snapshot()
+        self.snapshots.append(snap)
+        self.journal = snap.journal
+        return snap
+
+
+    def save_pages(self, addr, length):
+        """ Guardar en el journal del último snapshot las páginas entre addr
+            y addr + length que todavía no fueron guardadas
+        """
+        journal = self.journal
+        for page in range(addr >> PAGE_BITS, ((addr + length - 1) >> PAGE_BITS) + 1):
+            page &= PAGE_MASK
+            if page in journal:
+                continue
+            start = page << PAGE_BITS
+            state = []
+            for area in self.areas.values():
+                lo = max(start, area.base) - area.base
+                hi = min(start + PAGE_SIZE, area.end) - area.base
+                if lo < hi:
+                    state.append((area, lo, area.mem[lo:hi], area.init[lo:hi]))
+            journal[page] = state
+
+
+    def restore(self, snap):
+        """ Volver la memoria al estado de <snap>. Sólo se copian las páginas
+            modificadas desde el snapshot. <snap> sigue activo (puede
+            restaurarse de nuevo); los snapshots posteriores se descartan.
+        """
+        if snap not in self.snapshots:
+            raise Memory_error("Snapshot no activo")
+
+        restored = set()
+        while True:
+            last = self.snapshots[-1]
+            for page, state in last.journal.items():
+                for area, lo, mem, init in state:
+                    area.mem[lo:lo + len(mem)] = mem
+                    area.init[lo:lo + len(init)] = init
+                restored.add(page)
+            last.journal.clear()
+            if last is snap:
+                break
+            self.snapshots.pop()
+
+        self.journal = snap.journal
+        for page in sorted(restored):
+            self.changed(page << PAGE_BITS, PAGE_SIZE)
+
+
+    def drop_snapshot(self, snap):
+        """ Descartar <snap>. Sus páginas guardadas pasan al snapshot
+            anterior (si lo hay), para que éste siga siendo restaurable.
+        """
+        idx = self.snapshots.index(snap)
+        if idx > 0:
+            previous = self.snapshots[idx - 1].journal
+            for page, state in snap.journal.items():
+                previous.setdefault(page, state)
+        del self.snapshots[idx]
+        self.journal = self.snapshots[-1].journal if self.snapshots else None
+
+
+    def change_token(self):
+        """ Retorna un 'token' que representa el estado actual de la memoria
+            (para usar luego con changes_since)
+        """
+        return self.write_seq
+
+
+    def changes_since(self, token):
+        """ Retorna (nuevo_token, rangos), donde rangos es una lista de
+            (inicio, fin) - fin excluido - de las páginas modificadas desde
+            que se obtuvo <token>. Las páginas contiguas se agrupan.
+        """
+        ranges = []
+        for page, stamp in enumerate(self.page_stamp):
+            if stamp > token:
+                start = page << PAGE_BITS
+                if ranges and ranges[-1][1] == start:
+                    ranges[-1] = (ranges[-1][0], start + PAGE_SIZE)
+                else:
+                    ranges.append((start, start + PAGE_SIZE))
+        return self.write_seq, ranges
+
+
+    def read_block(self, addr, n, check_initialized = True):
+        """ Retorna (como bytes) los <n> bytes a partir de <addr>. El bloque
+            puede extenderse sobre varias areas contiguas. Genera
+            Memory_error si alguna parte cae fuera de las areas reservadas.
+        """
+        parts = []
+        while n > 0:
+            area = self.area_at(addr)
+            if area is None:
+                raise Memory_error("Dirección 0x{:04x} fuera de memoria".format(addr))
+            count = min(n, area.end - addr)
+            parts.append(area.read_block(addr, count, check_initialized))
+            addr += count
+            n -= count
+        return b"".join(parts)
+
+
+    def view(self, id, start = None, end = None):
+        """ Retorna un memoryview de sólo lectura (sin copiar) del area <id>,
+            opcionalmente limitado a las direcciones start..end (excluido).
+            Las escrituras deben hacerse con write/write_word/write_block para
+            que se registren los cambios.
+        """
+        area = self.areas[id]
+        lo = 0 if start is None else start - area.base
+        hi = area.size if end is None else end - area.base
+        if not 0 <= lo <= hi <= area.size:
+            raise Memory_error("Rango fuera del area {}".format(id))
+        return area.view()[lo:hi]
 
 
     def next_code_address(self, id, addr):
@@ -206,56 +680,156 @@ class Memory:
 
 
     def load_intel(self, filename):
+        """ Cargar un archivo Intel HEX. Se aceptan los registros de datos (0),
+            fin de archivo (1), dirección de segmento/lineal extendida (2/4)
+            y dirección de inicio (3/5, se guarda en self.start_address).
+            Genera Intel_hex_error si el archivo tiene errores.
+            Retorna la cantidad de bytes cargados.
+        """
+        upper = 0                   # Base de los registros 2/4
+        loaded = 0
         with open(filename) as intelf:
-            for line in intelf:
-                line = line.rstrip('\n')
+            for lineno, line in enumerate(intelf, 1):
+                line = line.strip()
+                if line == "":
+                    continue
 
                 # Todas las lineas deben empezar con ':'
                 if line[0] != ":":
-                    exit(1)
+                    raise Intel_hex_error(filename, lineno,
+                                "La línea no empieza con ':'")
+                try:
+                    rec = bytes.fromhex(line[1:])
+                except ValueError:
+                    raise Intel_hex_error(filename, lineno,
+                                "Caracteres no hexadecimales")
+
+                if len(rec) < 5 or len(rec) != rec[0] + 5:
+                    raise Intel_hex_error(filename, lineno,
+                                "Longitud de registro incorrecta")
                 # Controlar si la linea tiene datos validos
-                if self.checksum(line[1:]) != 0:
-                    print("Error checksum en {}".format(line))
-                    print("Esperaba: " +
-                        "{:02x}".format((0 - self.checksum(line[1:-2])) & 0xff))
-                    exit(1)
-
-                nrbytes = int(line[1:3], 16)
-                address = int(line[3:7], 16)
-                kind = int(line[7:9], 16)
-                if kind == 1:
+                if sum(rec) & 0xff != 0:
+                    raise Intel_hex_error(filename, lineno,
+                                "Error checksum (esperaba {:02x})".format(
+                                    (0 - sum(rec[:-1])) & 0xff))
+
+                kind = rec[3]
+                data = rec[4:-1]
+                if kind == 0:
+                    address = upper + ((rec[1] << 8) | rec[2])
+                    try:
+                        self.write_block(address, data)
+                    except Memory_error as err:
+                        raise Intel_hex_error(filename, lineno, str(err))
+                    loaded += len(data)
+
+                elif kind == 1:
                     break
-                elif kind == 3:
-                    continue
 
-                for i in range(nrbytes):
-                    self.write(address, int(line[9 + i*2 : 11 + i*2], 16))
-                    address += 1
-
-
-    def save_intel(self, id, filename):
-        area = self.areas[id]
+                elif kind in (2, 4):
+                    if len(data) != 2:
+                        raise Intel_hex_error(filename, lineno,
+                                "Registro de dirección extendida incorrecto")
+                    upper = ((data[0] << 8) | data[1]) << (4 if kind == 2 else 16)
+
+                elif kind in (3, 5):
+                    if len(data) != 4:
+                        raise Intel_hex_error(filename, lineno,
+                                "Registro de dirección de inicio incorrecto")
+                    if kind == 3:   # CS:IP
+                        self.start_address = (((data[0] << 8) | data[1]) << 4) + \
+                                             ((data[2] << 8) | data[3])
+                    else:           # EIP
+                        self.start_address = int.from_bytes(data, "big")
+
+                else:
+                    raise Intel_hex_error(filename, lineno,
+                                "Tipo de registro desconocido ({})".format(kind))
+
+        return loaded
+
+
+    def ranges_of(self, which):
+        """ Convertir <which> en una lista de rangos (inicio, fin) - fin
+            excluido. <which> puede ser el id de un area, un rango (inicio, fin),
+            o una lista de ids y/o rangos.
+        """
+        if isinstance(which, tuple) and len(which) == 2 and \
+                all(isinstance(a, int) for a in which):
+            return [which]
+        if isinstance(which, (list, tuple)):
+            ranges = []
+            for w in which:
+                ranges += self.ranges_of(w)
+            return ranges
+        area = self.areas[which]
+        return [(area.base, area.end)]
+
+
+    def initialized_runs(self, start, end):
+        """ Generador: retorna (direccion, bytes) para cada secuencia contigua
+            de posiciones inicializadas entre start y end (excluido)
+        """
+        for area in sorted(self.areas.values(), key = lambda a: a.base):
+            lo, hi = max(start, area.base) - area.base, min(end, area.end) - area.base
+            pos = lo
+            while pos < hi:
+                pos = area.init.find(1, pos, hi)
+                if pos < 0:
+                    break
+                stop = area.init.find(0, pos, hi)
+                if stop < 0:
+                    stop = hi
+                yield area.base + pos, bytes(area.mem[pos:stop])
+                pos = stop
+
+
+    def intel_records(self, which, record_size = 16):
+        """ Generador: retorna las líneas Intel HEX (con '\\n') del contenido
+            inicializado de <which> (ver ranges_of). Las secuencias contiguas
+            se agrupan en registros de hasta <record_size> bytes, y se
+            agregan registros de dirección lineal extendida (tipo 4) cuando
+            hace falta.
+        """
+        def record(kind, addr, data):
+            rec = bytes((len(data), (addr >> 8) & 0xff, addr & 0xff, kind)) + data
+            return ":{}{:02x}\n".format(rec.hex(), (0 - sum(rec)) & 0xff)
+
+        upper = 0
+        for start, end in self.ranges_of(which):
+            for addr, data in self.initialized_runs(start, end):
+                while len(data) > 0:
+                    if (addr >> 16) != upper:
+                        upper = addr >> 16
+                        yield record(4, 0, upper.to_bytes(2, "big"))
+                    # Los registros no deben cruzar un límite de 64K
+                    n = min(len(data), record_size, 0x10000 - (addr & 0xffff))
+                    yield record(0, addr & 0xffff, data[:n])
+                    addr += n
+                    data = data[n:]
+        yield ":00000001ff\n"
+
+
+    def save_intel(self, id, filename, record_size = 16):
+        """ Guardar en formato Intel HEX el contenido inicializado de <id>
+            (el id de un area, un rango (inicio, fin) o una lista de ellos)
+        """
         with open(filename, "w") as intelf:
-            for addr in range(area.base, area.base + area.size):
-                if area.initialized(addr):
-                    s = ":01{:04x}00{:02x}".format(addr, area.read(addr))
-                    s += "{:02x}\n".format((256 - self.checksum(s[1:])) & 0xff)
-                    intelf.write(s)
-            intelf.write(":00000001ff\n")
+            intelf.writelines(self.intel_records(id, record_size))
 
 
-    def dump(self, id):
+    def dump_header(self, id):
         area = self.areas[id]
-        s = "\nid: {}, base: 0x{:04x}, size: {}, flags: {}\n".format(
+        return "\nid: {}, base: 0x{:04x}, size: {}, flags: {}\n".format(
                     id, area.base, area.size, area.kind)
-        return s + area.dump()
 
 
-    def dump_words(self, id):
-        area = self.areas[id]
-        s = "\nid: {}, base: 0x{:04x}, size: {}, flags: {}\n".format(
-                    id, area.base, area.size, area.kind)
-        return s + area.dump_words()
+    def dump(self, id, start = None, end = None):
+        return self.dump_header(id) + self.areas[id].dump(start, end)
+
+
+    def dump_words(self, id, start = None, end = None):
+        return self.dump_header(id) + self.areas[id].dump_words(start, end)
 
     def dump_mem(self, id):
         area = self.areas[id]
@@ -287,8 +861,32 @@ def test_save():
     print(m.dump("ROM"))
 
 
+def test_write_block():
+    """ Un bloque que sale del area no escribe nada; uno que pasa de un
+        area a la contigua se escribe y se avisa completo
+    """
+    m = Memory()
+    m.reserve("RAM", 0x200, 0x100, "RW")
+    m.reserve("RAM2", 0x300, 0x100, "RW")
+    notified = []
+    m.subscribe(lambda addr, length: notified.append((addr, length)))
+    token = m.write_seq
+    try:
+        m.write_block(0x3f0, bytes(range(32)))
+    except Memory_error as e:
+        print(e)
+    assert not m.initialized(0x3f0) and not notified
+    assert m.changes_since(token)[1] == []
+
+    m.write_block(0x2f0, bytes(range(32)))
+    assert m.read_block(0x2f0, 32) == bytes(range(32))
+    assert notified == [(0x2f0, 32)]
+    print(m.changes_since(token)[1])
+
+
 def main(args):
     # ~ test_checksum()
+    # ~ test_write_block()
     test_load()
     # ~ test_save()
     return 0
@@ -22,8 +22,10 @@
 #
 
 
-from memory import Memory
-import pdb, os
+from memory import Memory, PAGE_BITS
+from collections import namedtuple
+from array import array
+import pdb, os, sys, heapq
 import pyparsing as pp
 
 DEBUG = False
@@ -44,6 +46,129 @@ def decode_signed(value, length):
         return -((~value & (mask - 1)) + 1)
 
 
+# Registro pre-decodificado de una instrucción (ver MSP430.build_decode_table)
+#   op_id       índice de la instrucción en MSP430.OPCODES
+#   byte_op     True si la instrucción opera con bytes (.B)
+#   smode, sreg modo de direccionamiento y registro fuente
+#   dmode, dreg modo de direccionamiento y registro destino (en las
+#               instrucciones de un solo operando son iguales a los de fuente)
+#   offset      desplazamiento (en words, con signo) de los saltos
+#   src_ext     True si el operando fuente usa una palabra de extensión
+#   dst_ext     True si el operando destino usa una palabra de extensión
+#   cycles      ciclos de reloj de la instrucción (ver MSP430.cycles_of)
+#   src_op      número de los operandos fuente y destino, con el modo, el
+#   dst_op      registro y el ancho (ver MSP430.operand_id). Indexan las
+#               tablas de acceso del emulador (MSP430_emulator.make_operands)
+#   opcode      la palabra del opcode
+Decoded = namedtuple("Decoded",
+            "op_id mnem form kind byte_op smode sreg dmode dreg offset "
+            "src_ext dst_ext cycles src_op dst_op opcode")
+
+
+# Motivos de detención de los lazos de ejecución (ver MSP430_emulator.run_until)
+STOP_COUNT      = "count"       # Se ejecutó la cantidad pedida de instrucciones
+STOP_BREAKPOINT = "breakpoint"  # El PC llegó a un breakpoint
+STOP_PREDICATE  = "predicate"   # La condición de parada se cumplió
+STOP_CYCLES     = "cycles"      # Se cumplió la cantidad de ciclos (run_for)
+STOP_INVALID    = "invalid"     # Opcode inválido o memoria no inicializada
+STOP_SLEEP      = "sleep"       # CPU apagada (CPUOFF) y ningún evento agendado
+STOP_IDLE       = "idle"        # Lazo de espera sin fin y ningún evento agendado
+STOP_WATCHPOINT = "watchpoint"  # Un acceso a la memoria tocó un watchpoint
+
+# Resultado de run/run_until/run_for: motivo, PC final, instrucciones y
+# ciclos ejecutados, y el Watch_hit si se detuvo en un watchpoint
+Run_result = namedtuple("Run_result", "reason pc count cycles watch",
+                        defaults = (None,))
+
+# Watchpoints (ver MSP430_emulator.add_watchpoint): tipo (WATCH_*) y rango
+# de direcciones (end excluido)
+WATCH_READ      = "read"        # Lectura
+WATCH_WRITE     = "write"       # Escritura
+WATCH_CHANGE    = "change"      # Escritura que cambia el valor
+Watchpoint = namedtuple("Watchpoint", "kind start end")
+
+# Acceso que tocó un watchpoint: dirección, largo, valor (y valor anterior
+# en las escrituras), y dirección de la instrucción que lo hizo (None si
+# no fue una instrucción: la entrada a una interrupción, un periférico)
+Watch_hit = namedtuple("Watch_hit", "watchpoint addr length value old pc")
+
+# Lazo de espera sin efectos (p.ej. 'jmp $', o un 'bit'/'cmp' seguido de un
+# salto condicional hacia atrás): direcciones del inicio y del salto final,
+# ciclos e instrucciones por vuelta, y op_id del salto (ver find_idle_loop)
+Idle_loop = namedtuple("Idle_loop", "start end cycles count op_id")
+
+# Par de instrucciones fusionadas (ver MSP430_emulator.fuse): dirección de la
+# segunda instrucción, función que ejecuta las dos (retorna False si se
+# detuvo después de la primera), ciclos hasta el comienzo de la segunda y
+# ciclos del par
+Fused = namedtuple("Fused", "second run head cycles")
+
+
+class Scheduler():
+    """ Cola de eventos de los periféricos, ordenada por ciclo de reloj
+        (un heap). El lazo de ejecución sólo compara el ciclo actual con
+        next_event: el costo de los periféricos es proporcional a la
+        cantidad de eventos, no a la de instrucciones.
+    """
+    NEVER = sys.maxsize
+
+    def __init__(self):
+        self.queue = []             # Heap de eventos [ciclo, nro, callback]
+        self.seq = 0                # Desempate entre eventos del mismo ciclo
+        self.next_event = self.NEVER
+
+
+    def post(self, cycle, callback):
+        """ Agendar callback(cycle) para el ciclo <cycle>. Retorna el evento,
+            que puede cancelarse con cancel.
+        """
+        event = [cycle, self.seq, callback]
+        self.seq += 1
+        heapq.heappush(self.queue, event)
+        if cycle < self.next_event:
+            self.next_event = cycle
+        return event
+
+
+    def cancel(self, event):
+        """ Cancelar <event>. Se descarta cuando llega al frente de la cola.
+        """
+        if event is not None:
+            event[2] = None
+
+
+    def force(self):
+        """ Hacer que el lazo de ejecución llame a run_due después de la
+            próxima instrucción (p.ej. hay una interrupción pendiente)
+        """
+        self.next_event = 0
+
+
+    def next_pending(self):
+        """ Ciclo del próximo evento agendado (sin contar force), o NEVER
+        """
+        queue = self.queue
+        while queue and queue[0][2] is None:
+            heapq.heappop(queue)
+        return queue[0][0] if queue else self.NEVER
+
+
+    def run_due(self, now):
+        """ Ejecutar todos los eventos agendados hasta el ciclo <now>
+        """
+        queue = self.queue
+        while queue and queue[0][0] <= now:
+            cycle, seq, callback = heapq.heappop(queue)
+            if callback is not None:
+                callback(cycle)
+        self.next_event = queue[0][0] if queue else self.NEVER
+
+
+# Tipos de operación para la evaluación 'perezosa' de las banderas
+# (ver Registers.defer_flags)
+FLAGS_ADD, FLAGS_SUB, FLAGS_LOGIC, FLAGS_XOR, FLAGS_CARRY = range(5)
+
+
 class Registers():
     """ Vectores en tablas
         memory      0xfffe  Vector de reset (= PC inicial)
@@ -63,25 +188,106 @@ class Registers():
     # Nombres de las banderas para uso en 'dump' y para uso 'gui' --> tuplas
     FL_BITS = ("C", "Z", "N", "GIE", "NCPU", "NOSC", "SCG0", "SCG1", "V")
 
+    # Máscaras de las banderas en el SR (para uso del emulador)
+    C_MASK      = 0x0001
+    Z_MASK      = 0x0002
+    N_MASK      = 0x0004
+    GIE_MASK    = 0x0008
+    CPUOFF_MASK = 0x0010    # 'NCPU' en FL_BITS
+    OSCOFF_MASK = 0x0020    # 'NOSC' en FL_BITS
+    SCG0_MASK   = 0x0040
+    SCG1_MASK   = 0x0080
+    V_MASK      = 0x0100
+    FL_MASKS = {name: 1 << bit for bit, name in enumerate(FL_BITS)}
+
     NAMES = ("R0/PC", "R1/SP", "R2/SR/CG1", "R3/CG2",
              "R4", "R5", "R6", "R7",
              "R8", "R9", "R10", "R11",
              "R12", "R13", "R14", "R15")
-    def __init__(self, pc, sp):
-        self.reg = [0] * 16 # Lista de 16 elementos inicializados en 0, para representar los 16 registros.
-        self.reg[self.PC] = pc # el PC es el R0, entonce,s en la lista reg: reg[0]
-        self.reg[self.SP] = sp # reg[1]
+
+    __slots__ = ("reg", "lazy_flags", "pending")
+
+    def __init__(self, pc, sp, lazy_flags = True):
+        self.reg = array("H", [0] * 16) # 16 registros de 16 bits (sin signo)
+        self.reg[self.PC] = pc & 0xffff # el PC es el R0, entonce,s en la lista reg: reg[0]
+        self.reg[self.SP] = sp & 0xffff # reg[1]
+        # Banderas pendientes: (tipo, a, b, resultado, byte_op) de la última
+        # operación de la ALU. C, Z, N y V se calculan recién cuando se lee
+        # el SR (ver materialize)
+        self.lazy_flags = lazy_flags
+        self.pending = None
 
 
     def set_reg(self, reg, value):
-        self.reg[reg] = value
+        if reg == self.SR:
+            self.pending = None
+        self.reg[reg] = value & 0xffff
 
 
     def get_reg(self, reg):
+        if reg == self.SR and self.pending is not None:
+            self.materialize()
         return self.reg[reg]
 
 
+    def defer_flags(self, kind, a, b, result, byte_op):
+        """ Registrar la última operación de la ALU. Reemplaza C, Z, N y V.
+              FLAGS_ADD     a + b (+ carry) = result (sin recortar)
+              FLAGS_SUB     b - a (b + ~a + 1 (o carry)) = result (sin recortar)
+              FLAGS_LOGIC   C = result != 0, V = 0
+              FLAGS_XOR     C = result != 0, V = a y b negativos
+              FLAGS_CARRY   C = a, V = 0 (rotaciones, dadd)
+        """
+        self.pending = (kind, a, b, result, byte_op)
+        if not self.lazy_flags:
+            self.materialize()
+
+
+    def materialize(self):
+        """ Calcular C, Z, N y V de la operación pendiente y guardarlas en SR
+        """
+        if self.pending is None:
+            return
+        kind, a, b, result, byte_op = self.pending
+        self.pending = None
+
+        if byte_op:
+            width, msb = 0xff, 0x80
+        else:
+            width, msb = 0xffff, 0x8000
+        res = result & width
+        sr = self.reg[self.SR] & ~(self.C_MASK | self.Z_MASK | self.N_MASK | self.V_MASK)
+        if res == 0:
+            sr |= self.Z_MASK
+        if res & msb:
+            sr |= self.N_MASK
+
+        if kind == FLAGS_ADD:
+            if result > width:
+                sr |= self.C_MASK
+            if (a ^ res) & (b ^ res) & msb:     # Operandos del mismo signo, resultado distinto
+                sr |= self.V_MASK
+        elif kind == FLAGS_SUB:
+            if result > width:
+                sr |= self.C_MASK
+            if (a ^ b) & (b ^ res) & msb:       # Operandos de signo distinto, cambia el signo del destino
+                sr |= self.V_MASK
+        elif kind == FLAGS_LOGIC:
+            if res != 0:
+                sr |= self.C_MASK
+        elif kind == FLAGS_XOR:
+            if res != 0:
+                sr |= self.C_MASK
+            if a & b & msb:
+                sr |= self.V_MASK
+        elif a:                                 # FLAGS_CARRY
+            sr |= self.C_MASK
+        self.reg[self.SR] = sr
+
+
     def set_flag(self, flag, newval):
+        if self.pending is not None:
+            self.materialize()
         if newval:
             self.reg[self.SR] |= (1 << flag) # SR = SR + (1 << flag). Flag puede valer 0 o 1. Si es 1, pongo en 1 el bit correspondiente a <flag> en la lista de 8 bits
         else:
@@ -89,24 +295,83 @@ class Registers():
 
 
     def set_flag_by_name(self, flag, newval):
-        bit = self.FL_BITS.index(flag) # índice de esa flag dentro de la tupla de flags
-        self.set_flag(bit, newval)
+        """ (Para uso de la interfaz: el emulador usa las máscaras)
+        """
+        self.set_mask(self.FL_MASKS[flag], newval)
+
+
+    def test_mask(self, mask):
+        """ Return True si alguna de las banderas de <mask> está en 1
+        """
+        if self.pending is not None:
+            self.materialize()
+        return (self.reg[self.SR] & mask) != 0
+
+
+    def set_mask(self, mask, newval):
+        """ Poner en 1 (o en 0 si newval es False) las banderas de <mask>
+        """
+        if self.pending is not None:
+            self.materialize()
+        if newval:
+            self.reg[self.SR] |= mask
+        else:
+            self.reg[self.SR] &= ~mask
 
 
     def get_flag(self, flag):
         """ Return True if Flags[flag] es 1
         """
+        if self.pending is not None:
+            self.materialize()
         return (self.reg[self.SR] & (1 << flag)) != 0 # AND entre el valor del flag con un 1
 
 
     def get_flag_by_name(self, flag):
         """ Return True if Flags[flag] es 1
+            (Para uso de la interfaz: el emulador usa las máscaras)
+        """
+        return self.test_mask(self.FL_MASKS[flag])
+
+
+    def get_all(self):
+        """ Retorna los 16 registros en una tupla (banderas al día)
+        """
+        if self.pending is not None:
+            self.materialize()
+        return tuple(self.reg)
+
+
+    def set_all(self, values):
+        """ Cargar los 16 registros desde una secuencia (ver get_all)
+        """
+        self.pending = None
+        self.reg[:] = array("H", values)
+
+
+    def to_bytes(self):
+        """ Retorna los 16 registros en un bloque de 32 bytes (little endian)
+        """
+        if self.pending is not None:
+            self.materialize()
+        blob = array("H", self.reg)
+        if sys.byteorder == "big":
+            blob.byteswap()
+        return blob.tobytes()
+
+
+    def from_bytes(self, blob):
+        """ Cargar los 16 registros desde un bloque generado con to_bytes
         """
-        bit = self.FL_BITS.index(flag)
-        return self.get_flag(bit)
+        values = array("H")
+        values.frombytes(blob)
+        if sys.byteorder == "big":
+            values.byteswap()
+        self.set_all(values)
 
 
     def dump(self):
+        self.materialize()
         for quad in range(0, 16, 4):
             t = ""; d = ""
             t += "  ".join(
@@ -197,21 +462,161 @@ class MSP430():
         ("tst",     0,  0x9300, "SINGLE_BW", "SINGLE")
     )
 
+    # Tabla de decodificación, indexada por la palabra de 16 bits del opcode.
+    # Se construye una sola vez (ver build_decode_table) y la comparten todas
+    # las instancias (emulador, desensamblador, ...)
+    DECODE = None
+
     def __init__(self, memory):
         self.memory = memory
+        if MSP430.DECODE is None:
+            MSP430.build_decode_table()
         ram = self.memory.areas["RAM"]
         self.registers = Registers(pc = self.memory.read_word(0xfffe),
                                    sp = ram.base + ram.size)
 
 
+    @classmethod
+    def scan_opcode(cls, opcode):
+        """ Busqueda lineal en OPCODES. Retorna el índice de la instrucción,
+            o None si el opcode no corresponde a ninguna instrucción.
+            (Sólo se usa para construir la tabla DECODE)
+        """
+        for op_id, (mnem, mask, value, form, kind) in enumerate(cls.OPCODES):
+            if (opcode & mask) == value:
+                return op_id
+        return None
+
+
+    # Ciclos de reloj (familia MSP430x1xx-x4xx, SLAU144, tablas 3-15 y 3-16).
+    # Clases de operando: 'R' registro (o generador de constantes),
+    # '@' indirecto, '+' autoincremento, '#' inmediato, 'X' indexado,
+    # simbólico o absoluto.
+    CYCLES_SINGLE = {       #  rrc/rra/swpb/sxt  push  call
+        "R": (1, 3, 4),
+        "@": (3, 4, 4),
+        "+": (3, 5, 5),
+        "#": (3, 4, 5),
+        "X": (4, 5, 5)
+    }
+    CYCLES_DOUBLE = {       #  Rm  PC  x(Rm)
+        "R": (1, 2, 4),
+        "@": (2, 2, 5),
+        "+": (2, 3, 5),
+        "#": (2, 3, 5),
+        "X": (3, 3, 6)
+    }
+    CYCLES_JUMP = 2
+    CYCLES_RETI = 5
+    CYCLES_INTERRUPT = 6
+
+    @staticmethod
+    def operand_class(mode, reg):
+        """ Clase del operando (ver CYCLES_SINGLE) según modo y registro
+        """
+        if reg == Registers.CG2 or (reg == Registers.CG1 and mode >= 2):
+            return "R"                      # Generador de constantes
+        if mode == 3 and reg == Registers.PC:
+            return "#"
+        return ("R", "X", "@", "+")[mode]
+
+
+    @classmethod
+    def cycles_of(cls, mnem, kind, smode, sreg, dmode, dreg):
+        """ Ciclos de reloj de una instrucción
+        """
+        if kind == "JUMP":
+            return cls.CYCLES_JUMP
+        if kind == "NOOPD":                 # reti
+            return cls.CYCLES_RETI
+        src = cls.operand_class(smode, sreg)
+        if kind == "SINGLE":
+            return cls.CYCLES_SINGLE[src][{"push": 1, "call": 2}.get(mnem, 0)]
+        if dmode == 1:
+            return cls.CYCLES_DOUBLE[src][2]
+        return cls.CYCLES_DOUBLE[src][1 if dreg == Registers.PC else 0]
+
+
+    @staticmethod
+    def operand_id(mode, reg, byte_op):
+        """ Número de operando (0..127) para el modo, registro y ancho
+        """
+        return (mode << 5) | (reg << 1) | int(byte_op)
+
+
+    @classmethod
+    def build_decode_table(cls):
+        """ Construir la tabla DECODE con los 65536 opcodes posibles.
+            Cada entrada es un registro Decoded, o None si el opcode no es
+            una instrucción válida.
+        """
+        table = [None] * 0x10000
+        for opcode in range(0x10000):
+            op_id = cls.scan_opcode(opcode)
+            if op_id is None:
+                continue
+
+            mnem, mask, value, form, kind = cls.OPCODES[op_id]
+            byte_op = (opcode & 0x40) != 0
+            smode = sreg = dmode = dreg = None
+            offset = 0
+            src_ext = dst_ext = False
+            if kind == "JUMP":
+                offset = decode_signed(opcode & 0x03ff, 10)
+            elif kind == "SINGLE":
+                smode, sreg = (opcode >> 4) & 3, opcode & 0x000f
+                dmode, dreg = smode, sreg
+            elif kind == "DOUBLE":
+                smode, sreg = (opcode >> 4) & 3, (opcode >> 8) & 0x000f
+                dmode, dreg = (opcode >> 7) & 1, opcode & 0x000f
+                dst_ext = dmode == 1
+            src_op = dst_op = None
+            if smode is not None:
+                # x(Rn), simbólico y absoluto (R3 en modo 1 es la constante 1),
+                # e inmediato (@PC+)
+                src_ext = (smode == 1 and sreg != Registers.CG2) or \
+                          (smode == 3 and sreg == Registers.PC)
+                src_op = dst_op = cls.operand_id(smode, sreg, byte_op)
+            if kind == "DOUBLE":
+                # Como destino, R3 no genera constantes: x(R3) es la dirección
+                # x (R3 vale 0), igual que el modo absoluto
+                dst_op = cls.operand_id(dmode, Registers.CG1 if dmode == 1 and
+                                        dreg == Registers.CG2 else dreg, byte_op)
+
+            table[opcode] = Decoded(op_id, mnem, form, kind, byte_op,
+                                    smode, sreg, dmode, dreg, offset,
+                                    src_ext, dst_ext,
+                                    cls.cycles_of(mnem, kind, smode, sreg, dmode, dreg),
+                                    src_op, dst_op, opcode)
+        cls.DECODE = table
+
+
+    def decode(self, opcode):
+        """ Retorna el registro Decoded del opcode (o None si no es válido)
+        """
+        return self.DECODE[opcode]
+
+
     def find_opcode(self, opcode):
         """ Retorna mnem, mask, valu, form, kind después de veirificar que el opcode corresponde
             a una instrucción
         """
-        for mnem, mask, value, form, kind in self.OPCODES:
-            if (opcode & mask) == value:
-                return mnem, mask, value, form, kind
-        return None
+        dec = self.DECODE[opcode]
+        if dec is None:
+            return None
+        return self.OPCODES[dec.op_id]
+
+
+    @staticmethod
+    def is_transfer(dec):
+        """ True si la instrucción <dec> puede cambiar el flujo del programa:
+            saltos, call, reti, y las de dos operandos que escriben el PC
+            (incluye ret = mov @SP+, PC y br)
+        """
+        if dec.kind == "JUMP" or dec.mnem in ("call", "reti"):
+            return True
+        return dec.kind == "DOUBLE" and dec.dmode == 0 and \
+               dec.dreg == Registers.PC and dec.mnem not in ("cmp", "bit")
 
 
     def single_sd(self, opcode):
@@ -259,11 +664,11 @@ class MSP430_disassembler(MSP430): # Hereda de la clase MSP430
         super(MSP430_disassembler, self).__init__(memory)
 
 
-    def single_operand(self, opcode, pc):
+    def single_operand(self, dec, pc):
         """
         Devuelve el operando y el pc
         """
-        mode, reg = self.single_sd(opcode)
+        mode, reg = dec.smode, dec.sreg
 
         if mode == 0:
             line = "R{}".format(reg)
@@ -289,13 +694,13 @@ class MSP430_disassembler(MSP430): # Hereda de la clase MSP430
         return pc, line
 
 
-    def double_operand(self, opcode, pc):
+    def double_operand(self, dec, pc):
         """
         Devuelve los 2 operandos, y el pc
         """
 
-        dmode, dreg = self.double_dst(opcode) # Modo de direccionamiento, registro destino
-        smode, sreg = self.double_src(opcode) # Modo de direccionamiento, registro origen
+        dmode, dreg = dec.dmode, dec.dreg # Modo de direccionamiento, registro destino
+        smode, sreg = dec.smode, dec.sreg # Modo de direccionamiento, registro origen
         line = ""
 
         if smode == 0:
@@ -352,34 +757,32 @@ class MSP430_disassembler(MSP430): # Hereda de la clase MSP430
         Lee una palabra de la memoria y desensambla la instrucción
         """
         opcode = self.memory.read_word(pc)
-        byte_op = self.byte_op(opcode)
         pc += 2
 
-        found = self.find_opcode(opcode)
-        if found is None:
+        dec = self.DECODE[opcode]
+        if dec is None:
             return None
 
-        mnem, mask, value, form, kind = found
+        mnem, form, byte_op = dec.mnem, dec.form, dec.byte_op
         # Instrucciones de salto. Operando es dirección relativa.
         if form == "JMP":
-            line = "{:8s}{}".format(mnem,
-                    decode_signed(opcode & 0x03ff, 10) * 2) # uso esta máscara para obtener sólo los valores del desplazamiento (10 bits). El *2 es porque PC = PC + 2×offset
+            line = "{:8s}{}".format(mnem, dec.offset * 2) # El *2 es porque PC = PC + 2×offset
 
         # Instrucciones de simple operando
         elif form == "SINGLE_RETI":
             line =  "{:8s}".format(mnem)
 
         elif form == "SINGLE":
-            pc, rest = self.single_operand(opcode, pc)
+            pc, rest = self.single_operand(dec, pc)
             line = "{:8s}{}".format(mnem, rest)
 
         elif form == "SINGLE_BW":
-            pc, rest = self.single_operand(opcode, pc)
+            pc, rest = self.single_operand(dec, pc)
             line = "{:8s}{}".format(mnem + (".B" if byte_op else ""), rest)
 
         # Instrucciones de doble operando
         elif form == "DOUBLE":
-            pc, rest = self.double_operand(opcode, pc)
+            pc, rest = self.double_operand(dec, pc)
             line = "{:8s}{}".format(mnem + (".B" if byte_op else ""), rest)
 
         # Instrucciones invalidas
@@ -398,69 +801,1085 @@ class MSP430_disassembler(MSP430): # Hereda de la clase MSP430
 """
 
 class MSP430_emulator(MSP430):
-    def __init__(self, memory):
+    def __init__(self, memory, lazy_flags = True, clock_hz = 1000000):
         super(MSP430_emulator, self).__init__(memory)
+        self.registers.lazy_flags = lazy_flags
+        # Cache de instrucciones decodificadas, indexado por dirección.
+        # Las escrituras a la memoria invalidan las entradas afectadas.
+        self.icache = {}
+        memory.subscribe(self.invalidate)
+        # Páginas de la memoria con instrucciones decodificadas (en el
+        # cache, los pares fusionados o los bloques traducidos): escribir en
+        # las demás no invalida nada (ver invalidate)
+        self.code_pages = bytearray(0x10000 >> PAGE_BITS)
+        self.loaders, self.storers = self.make_operands()
+        self.handlers = self.make_dispatch()
+        self.dispatch = list(self.handlers)     # Ver update_dispatch
+        self.instructions = 0       # Instrucciones ejecutadas
+        self.cycles = 0             # Ciclos de reloj transcurridos
+        self.clock_hz = clock_hz    # Frecuencia de MCLK (para convertir a tiempo)
+        # Periféricos (ver peripherals.py) y sus eventos
+        self.scheduler = Scheduler()
+        self.interrupts = {}        # Pedidos pendientes: vector -> callback
+        self.peripherals = []
+        self.io_pages = {}          # Página -> periféricos con registros en ella
+        # Lazos de espera detectados (dirección del salto -> Idle_loop), y
+        # el último que dio una vuelta completa (ver run_loop)
+        self.idle_loops = {}
+        self.idle_loop = None
+        # Traducción de bloques básicos (ver set_translation)
+        self.translator = None
+        self.blocks = {}            # Dirección -> Block (False: no se traduce)
+        self.block_map = {}         # Palabra -> bloques que la contienen
+        self.block_hits = {}        # Ejecuciones de las direcciones sin traducir
+        self.verify_blocks = False
+        # Pares de instrucciones fusionadas (dirección -> Fused), usados por
+        # run/run_until/run_for
+        self.fused = {}
+        self.fuse_pairs = True
+        # Hooks (ver add_hook). Con hooks de instrucción o de registros,
+        # run/run_until/run_for usan run_instrumented.
+        self.hooks = {event: [] for event in self.HOOK_EVENTS}
+        self.instrumented = False
+        # Watchpoints (ver add_watchpoint), y el primero que se tocó
+        self.watchpoints = []
+        self.watch_hit = None
+        # Páginas vigiladas por los hooks y los watchpoints (ver trap_pages)
+        self.trapped = {}
+        # Trace y perfil de la ejecución (ver set_tracer y set_profiler)
+        self.tracer = None
+        self.profiler = None
+        # Cobertura de los saltos (ver set_coverage)
+        self.coverage = None
+        # La tabla de ejecución tiene envoltorios (trace o cobertura): cada
+        # instrucción pasa por ella (ver update_dispatch)
+        self.wrapped = False
+
+
+    # Condiciones de los saltos, evaluadas sobre el valor del SR
+    # (C = bit 0, Z = bit 1, N = bit 2, V = bit 8)
+    JUMP_CONDITIONS = {
+        "jnz":  lambda sr: (sr & Registers.Z_MASK) == 0,
+        "jz":   lambda sr: (sr & Registers.Z_MASK) != 0,
+        "jnc":  lambda sr: (sr & Registers.C_MASK) == 0,
+        "jc":   lambda sr: (sr & Registers.C_MASK) != 0,
+        "jn":   lambda sr: (sr & Registers.N_MASK) != 0,
+        "jge":  lambda sr: (((sr >> 2) ^ (sr >> 8)) & 1) == 0,     # N == V
+        "jl":   lambda sr: (((sr >> 2) ^ (sr >> 8)) & 1) != 0,     # N != V
+        "jmp":  lambda sr: True
+    }
+
+    def make_dispatch(self):
+        """ Construir (una vez por emulador) la tabla de ejecución, indexada
+            por op_id (ver Decoded). Cada entrada es una función
+            handler(dec, src_x, dst_x) que ejecuta la instrucción.
+        """
+        double_ops = {"mov": self.op_mov,   "and": self.op_and,
+                      "add": self.op_add,   "bic": self.op_bic,
+                      "cmp": self.op_cmp,   "bit": self.op_bit,
+                      "subc": self.op_subc, "addc": self.op_addc,
+                      "sub": self.op_sub,   "bis": self.op_bis,
+                      "dadd": self.op_dadd, "xor": self.op_xor}
+        # Instrucciones de un operando: función, y si el resultado se guarda
+        # en el operando
+        single_ops = {"rrc":  (self.op_rrc, True),
+                      "rra":  (self.op_rra, True),
+                      "push": (self.op_push, False),
+                      "swpb": (lambda v, b: self.op_swpb(v), True),
+                      "sxt":  (lambda v, b: self.op_sxt(v), True),
+                      "call": (lambda v, b: self.op_call(v), False)}
+
+        table = [None] * (len(self.OPCODES) + 1)
+        table[self.IDLE_JUMP] = self.idle_jump
+        for op_id, (mnem, mask, value, form, kind) in enumerate(self.OPCODES):
+            if kind == "JUMP":
+                table[op_id] = self.jump_handler(self.JUMP_CONDITIONS[mnem])
+            elif kind == "DOUBLE":
+                # cmp y bit sólo modifican el SR, mov no lee el destino
+                table[op_id] = self.double_handler(double_ops[mnem],
+                                                   mnem not in ("cmp", "bit"),
+                                                   mnem != "mov")
+            elif mnem == "reti":
+                table[op_id] = lambda dec, src_x, dst_x: self.op_reti()
+            else:
+                table[op_id] = self.single_handler(*single_ops[mnem])
+        return table
 
 
-    def get_src(self, pc, mode, reg):
+    # Entrada adicional de la tabla de ejecución, para los saltos que cierran
+    # un lazo de espera (ver find_idle_loop)
+    IDLE_JUMP = len(MSP430.OPCODES)
+
+    def idle_jump(self, dec, loop, dst_x):
+        """ Ejecutar el salto final de un lazo de espera. Si se toma, el lazo
+            volverá a repetirse igual hasta el próximo evento: se avisa al
+            lazo de ejecución para que adelante el reloj.
         """
-        Devuelve el operando origen (según el modo de direccionamiento del mismo)
+        self.dispatch[loop.op_id](dec, None, None)
+        # Con la memoria vigilada (hooks de memoria o watchpoints) no se
+        # saltea nada: cada vuelta tiene que leer la memoria
+        if self.registers.reg[Registers.PC] == loop.start and \
+                not self.memory.watches and self.idle_laps(loop, dec):
+            self.idle_loop = loop
+            self.scheduler.force()
+
+
+    # Comienzo de las entradas de la tabla de ejecución que registran la
+    # cobertura (COVER + op_id, ver set_coverage)
+    COVER = IDLE_JUMP + 1
+
+    def cover_handler(self, handler, edge):
+        """ Envolver <handler> para que, después de ejecutar la instrucción,
+            registre el salto al nuevo PC con <edge>
+        """
+        reg = self.registers.reg
+        def cover(dec, src_x, dst_x):
+            handler(dec, src_x, dst_x)
+            edge(reg[Registers.PC])
+        return cover
+
+
+    def idle_laps(self, loop, dec):
+        """ Verificar que el lazo de espera (con el PC en loop.start) se
+            repite igual. El salto final puede alcanzarse desde fuera del lazo,
+            con banderas calculadas por otro código: se simulan dos vueltas (la
+            segunda ya parte de las banderas que deja el cuerpo), y después se
+            restablecen el SR y el PC. El cuerpo sólo modifica las banderas.
         """
+        regs = self.registers
+        reg = regs.reg
+        pending, sr = regs.pending, reg[Registers.SR]
+        icache, dispatch = self.icache, self.dispatch
+        repeats = True
+        for lap in range(2):
+            pc = loop.start
+            while pc != loop.end and repeats:
+                d, src_x, dst_x, next_pc = icache.get(pc) or self.fetch(pc)
+                reg[Registers.PC] = next_pc
+                dispatch[d.op_id](d, src_x, dst_x)
+                pc = reg[Registers.PC]
+                repeats = pc == next_pc     # Salió del lazo
+            if not repeats:
+                break
+            reg[Registers.PC] = loop.end + 2
+            dispatch[loop.op_id](dec, None, None)
+            repeats = reg[Registers.PC] == loop.start
+        regs.pending = pending
+        reg[Registers.SR] = sr
+        reg[Registers.PC] = loop.start
+        return repeats
+
+
+    def jump_handler(self, cond):
+        regs = self.registers
+        def handler(dec, src_x, dst_x):
+            if regs.pending is not None:
+                regs.materialize()
+            reg = regs.reg
+            if cond(reg[Registers.SR]):
+                reg[Registers.PC] = (reg[Registers.PC] + dec.offset * 2) & 0xffff
+        return handler
+
+
+    def double_handler(self, op, store, reads_dst):
+        loaders, storers = self.loaders, self.storers
+        def handler(dec, src_x, dst_x):
+            src = loaders[dec.src_op](src_x)
+            dst = loaders[dec.dst_op](dst_x) if reads_dst else 0
+            result = op(src, dst, dec.byte_op)
+            if store:
+                storers[dec.dst_op](dst_x, result)
+        return handler
+
+
+    def single_handler(self, op, store):
+        loaders, storers = self.loaders, self.storers
+        def handler(dec, src_x, dst_x):
+            result = op(loaders[dec.src_op](src_x), dec.byte_op)
+            if store:
+                storers[dec.src_op](src_x, result)
+        return handler
+
+
+    def make_operands(self):
+        """ Construir (una vez por emulador) las tablas de acceso a los
+            operandos, indexadas por src_op/dst_op de Decoded (ver
+            MSP430.operand_id). Para cada modo, registro y ancho:
+              loaders[n](x)         retorna el valor del operando
+              storers[n](x, value)  guarda el resultado en el operando
+            <x> es la palabra de extensión (ya resuelta, ver fetch).
+        """
+        loaders, storers = [None] * 128, [None] * 128
+        for mode in range(4):
+            for reg in range(16):
+                for byte_op in (False, True):
+                    n = self.operand_id(mode, reg, byte_op)
+                    loaders[n] = self.make_loader(mode, reg, byte_op)
+                    storers[n] = self.make_storer(mode, reg, byte_op)
+        return loaders, storers
+
+
+    def make_loader(self, mode, reg, byte_op):
+        """ Función load(x) que lee el operando <reg> en modo <mode>:
+              0  Rn         registro (R3: constante 0)
+              1  x(Rn)      indexado, x(PC) simbólico, &x absoluto (R2)
+                            (R3: constante 1)
+              2  @Rn        indirecto (R2: constante 4, R3: constante 2)
+              3  @Rn+       autoincremento, #x inmediato (@PC+)
+                            (R2: constante 8, R3: constante -1)
+        """
+        regs = self.registers
+        r = regs.reg
+        width = 0x00ff if byte_op else 0xffff
+        read = self.memory.read if byte_op else self.memory.read_word
+        # El SP se mantiene par aun en las instrucciones de byte
+        step = 1 if byte_op and reg != Registers.SP else 2
+
+        if reg == Registers.CG2:
+            value = (0, 1, 2, 0xffff)[mode] & width
+            return lambda x: value
+        if reg == Registers.CG1 and mode >= 2:
+            value = 4 if mode == 2 else 8
+            return lambda x: value
+
         if mode == 0:
-            return pc, self.registers.get_reg(reg) # operando es el registro
+            if reg == Registers.SR:
+                def load(x):
+                    if regs.pending is not None:
+                        regs.materialize()
+                    return r[Registers.SR] & width
+                return load
+            if byte_op:
+                return lambda x: r[reg] & 0x00ff
+            return lambda x: r[reg]
+
+        if mode == 1:
+            if reg in (Registers.PC, Registers.CG1):    # Simbólico, absoluto
+                return lambda x: read(x)
+            return lambda x: read((r[reg] + x) & 0xffff)
+
+        if mode == 2:
+            return lambda x: read(r[reg])
+
+        if reg == Registers.PC:                         # Inmediato
+            return lambda x: x & width
+
+        def load(x):                                    # Autoincremento
+            addr = r[reg]
+            r[reg] = (addr + step) & 0xffff
+            return read(addr)
+        return load
+
+
+    def make_storer(self, mode, reg, byte_op):
+        """ Función store(x, value) que guarda el resultado en el operando
+            <reg> en modo <mode> (ver make_loader). Los modos indirecto y
+            autoincremento sólo son destinos en las instrucciones de un
+            operando: se guarda en la dirección que se leyó (antes del
+            incremento). En las constantes y el inmediato no se guarda nada.
+        """
+        regs = self.registers
+        r = regs.reg
+        width = 0x00ff if byte_op else 0xffff
+        write = self.memory.write if byte_op else self.memory.write_word
+        step = 1 if byte_op and reg != Registers.SP else 2
 
-        elif mode == 1:
-            if reg == Registers.PC:
-                opd = self.memory.read_word(pc, check_initialized = False)
-                pc += 2
-                return pc, self.memory.read_word(pc + opd) # El operando está en la memoria, dirección PC + opd
+        if reg == Registers.CG2 or (reg == Registers.CG1 and mode >= 2) or \
+                (reg == Registers.PC and mode == 3):
+            return lambda x, value: None
 
-            elif reg == Registers.CG1:
-                opd = self.memory.read_word(pc, check_initialized = False)
-                pc += 2
-                return pc, self.memory.read_word(opd) # el operando está en la memoria, dirección opd
+        if mode == 0:
+            if reg == Registers.SR:
+                def store(x, value):
+                    regs.set_reg(Registers.SR, value & width)
+                    if value & Registers.CPUOFF_MASK:
+                        self.scheduler.force()  # Entra en modo de bajo consumo
+                    elif value & Registers.GIE_MASK:
+                        self.interrupts_enabled()
+                return store
+            def store(x, value):
+                r[reg] = value & width
+            return store
+
+        if mode == 1:
+            if reg in (Registers.PC, Registers.CG1):    # Simbólico, absoluto
+                return lambda x, value: write(x, value & width)
+            return lambda x, value: write((r[reg] + x) & 0xffff, value & width)
+
+        if mode == 2:
+            return lambda x, value: write(r[reg], value & width)
+
+        return lambda x, value: write((r[reg] - step) & 0xffff, value & width)
+
+
+    # Vectores no enmascarables (no dependen de GIE)
+    NMI_VECTORS = frozenset((0xfffc, 0xfffa))
+    RESET_VECTOR = 0xfffe
+
+    def attach(self, periph):
+        """ Conectar el periférico <periph> (ver peripherals.Peripheral):
+            reservar las areas de sus registros y avisarle de las escrituras
+            a las mismas.
+        """
+        for id, base, size in periph.areas:
+            self.memory.reserve(id, base, size, "RW")
+            for page in range(base >> PAGE_BITS, ((base + size - 1) >> PAGE_BITS) + 1):
+                handlers = self.io_pages.setdefault(page, [])
+                if periph not in handlers:
+                    handlers.append(periph)
+        if not self.peripherals:
+            self.memory.subscribe(self.io_written)
+        self.peripherals.append(periph)
+        periph.attach(self)
+
+
+    def io_written(self, addr, length):
+        """ Llamado por Memory después de cada escritura: avisar a los
+            periféricos con registros en las páginas afectadas
+        """
+        first = addr >> PAGE_BITS
+        last = (addr + length - 1) >> PAGE_BITS
+        for page in range(first, last + 1):
+            for periph in self.io_pages.get(page, ()):
+                periph.written(addr, length)
 
-        elif mode == 2:
-            if reg == Registers.CG1:
-                return pc, 4 # el operando es la constante 4
 
-        else: # Modo 3
-            if reg == Registers.PC:                 # Immediate
-                opd = self.memory.read_word(pc, check_initialized = False)
-                pc += 2
-                return pc, opd # El operando es la siguiente palabra
+    def request_interrupt(self, vector, ack = None):
+        """ Pedir la interrupción de <vector>. Al aceptarla se llama
+            ack(vector), que puede volver a pedirla si la fuente sigue activa.
+        """
+        self.interrupts[vector] = ack
+        self.scheduler.force()
 
-            elif reg == Registers.CG1:
-                return pc, 8 # el operando es la constante 8
 
-            elif reg == Registers.CG2:
-                return pc, -1 # el operando es la constante -1
+    def clear_interrupt(self, vector):
+        """ Retirar el pedido de interrupción de <vector> (si lo hay)
+        """
+        self.interrupts.pop(vector, None)
 
 
-    def set_dst(self, pc, mode, reg, newval):
+    def check_events(self):
+        """ Ejecutar los eventos vencidos y aceptar una interrupción si hay
+            alguna pendiente y habilitada
         """
-        Setea el registro destino (dependiendo del modo de direccionamiento)
+        self.idle_loop = None
+        self.scheduler.run_due(self.cycles)
+        if self.interrupts:
+            self.service_interrupt()
+            # Las enmascaradas esperan a que se habilite GIE (ver
+            # interrupts_enabled); las NMI se aceptan una por instrucción
+            if any(v in self.NMI_VECTORS for v in self.interrupts):
+                self.scheduler.force()
+
+
+    def interrupts_enabled(self):
+        """ Llamado cuando una instrucción escribe el SR con GIE en 1 (eint,
+            mov/bis al SR, reti): aceptar las interrupciones pendientes
+            después de la instrucción
         """
-        if mode == 0:
-            self.registers.set_reg(reg, newval)
-            return pc
+        if self.interrupts:
+            self.scheduler.force()
 
-        elif mode == 1:
-            if reg == Registers.PC:
-                opd = self.memory.read_word(pc, check_initialized = False)
-                pc += 2
-                return pc, self.memory.read_word(pc + opd)
 
-            elif reg == Registers.CG1:
-                opd = self.memory.read_word(pc, check_initialized = False)
-                pc += 2
-                return pc, self.memory.read_word(opd)
+    def service_interrupt(self):
+        """ Aceptar la interrupción pendiente de mayor prioridad (el vector
+            más alto): apilar PC y SR, limpiar el SR (menos SCG0) y saltar a
+            la dirección del vector. Retorna True si se aceptó alguna.
+        """
+        regs = self.registers
+        sr = regs.get_reg(regs.SR)
+        if sr & Registers.GIE_MASK:
+            vectors = self.interrupts
+        else:
+            vectors = [v for v in self.interrupts if v in self.NMI_VECTORS]
+            if not vectors:
+                return False
+        vector = max(vectors)
+        ack = self.interrupts.pop(vector)
+        if ack is not None:
+            ack(vector)
+
+        sp = regs.get_reg(regs.SP)
+        pc = regs.get_reg(regs.PC)
+        self.memory.write_word((sp - 2) & 0xffff, pc)
+        self.memory.write_word((sp - 4) & 0xffff, sr)
+        regs.set_reg(regs.SP, sp - 4)
+        regs.set_reg(regs.SR, sr & Registers.SCG0_MASK)
+        regs.set_reg(regs.PC, self.memory.read_word(vector))
+        for hook in self.hooks["interrupt"]:
+            hook(vector, pc, sp, self.cycles)
+        self.cycles += self.CYCLES_INTERRUPT
+        return True
+
+
+    def sleep(self, target = Scheduler.NEVER):
+        """ Con la CPU apagada (CPUOFF), avanzar el reloj de evento en evento
+            hasta que una interrupción la despierte, o hasta el ciclo
+            <target>. Retorna False si no hay ningún evento que pueda
+            despertarla.
+        """
+        reg = self.registers.reg
+        sched = self.scheduler
+        while reg[Registers.SR] & Registers.CPUOFF_MASK and self.cycles < target:
+            wake = sched.next_pending()
+            if wake == Scheduler.NEVER:
+                return False
+            self.cycles = max(self.cycles, min(wake, target))
+            self.check_events()
+        return True
+
+
+    def reset(self):
+        """ Reset (PUC): PC desde el vector de reset, SR en 0, y los
+            periféricos en su estado inicial
+        """
+        regs = self.registers
+        regs.set_reg(regs.SR, 0)
+        regs.set_reg(regs.PC, self.memory.read_word(self.RESET_VECTOR))
+        self.interrupts.clear()
+        for periph in self.peripherals:
+            periph.reset()
+
+
+    def save_state(self):
+        """ Retorna el estado de la CPU (sin la memoria) en un diccionario
+        """
+        return {"regs": self.registers.get_all(),
+                "cycles": self.cycles}
+
+
+    def load_state(self, state):
+        """ Restablecer el estado de la CPU guardado con save_state
+        """
+        self.registers.set_all(state["regs"])
+        self.cycles = state["cycles"]
+        if self.interrupts:
+            self.scheduler.force()
+
+
+    def snapshot(self):
+        """ Tomar un snapshot de la máquina (registros y todas las areas de
+            memoria). Es O(1): la memoria se copia por páginas recién cuando
+            se modifica (ver Memory.snapshot).
+        """
+        return self.save_state(), self.memory.snapshot()
+
+
+    def restore(self, snap):
+        """ Volver al estado de <snap>. El snapshot sigue siendo válido, y
+            puede restaurarse cuantas veces sea necesario.
+        """
+        state, mem_snap = snap
+        self.memory.restore(mem_snap)
+        self.load_state(state)
+
+
+    def fetch(self, pc):
+        """ Leer y decodificar la instrucción en <pc>, incluyendo sus palabras
+            de extensión. Retorna (dec, src_x, dst_x, next_pc), o None si el
+            opcode no es válido. El resultado queda en el cache de
+            instrucciones (icache).
+            src_x y dst_x son las palabras de extensión ya resueltas: en el
+            modo simbólico (x(PC)) contienen la dirección efectiva.
+        """
+        area = self.memory.area_at(pc)
+        if area is None or not area.initialized(pc):
+            return None
+        dec = self.DECODE[area.read_word(pc)]
+        if dec is None:
+            return None
+
+        addr = pc + 2
+        src_x = dst_x = None
+        if dec.src_ext:
+            src_x = self.memory.fetch_word(addr)
+            if dec.smode == 1 and dec.sreg == Registers.PC:
+                src_x = (addr + src_x) & 0xffff
+            addr += 2
+        if dec.dst_ext:
+            dst_x = self.memory.fetch_word(addr)
+            if dec.dreg == Registers.PC:
+                dst_x = (addr + dst_x) & 0xffff
+            addr += 2
+
+        entry = (dec, src_x, dst_x, addr)
+        code_pages = self.code_pages
+        code_pages[pc >> PAGE_BITS] = code_pages[((addr - 1) & 0xffff) >> PAGE_BITS] = 1
+        if self.wrapped:
+            # Sin lazos de espera ni pares fusionados: cada instrucción pasa
+            # por la tabla de ejecución (ver update_dispatch)
+            if self.coverage is not None and self.is_transfer(dec):
+                entry = (dec._replace(op_id = self.COVER + dec.op_id),
+                         src_x, dst_x, addr)
+            self.icache[pc] = entry
+            return entry
+        if dec.kind == "JUMP" and dec.offset < 0:
+            loop = self.find_idle_loop(pc, dec, addr)
+            if loop is not None:
+                # El Idle_loop viaja en lugar de src_x (los saltos no lo usan)
+                entry = (dec._replace(op_id = self.IDLE_JUMP), loop, None, addr)
+                self.idle_loops[pc] = loop
+        self.icache[pc] = entry
+        if dec.mnem in self.FUSE_FIRST:
+            self.fuse(pc, entry)
+        return entry
+
+
+    def find_idle_loop(self, pc, dec, next_pc):
+        """ Verificar si el salto hacia atrás en <pc> cierra un lazo sin
+            efectos: sólo cmp/bit (sin autoincremento) y saltos hacia fuera
+            del lazo. Cada vuelta deja la máquina en el mismo estado, así que
+            el lazo se repite hasta que un evento (o una interrupción) cambie
+            algo. Retorna un Idle_loop, o None.
+        """
+        start = (next_pc + dec.offset * 2) & 0xffff
+        cycles, count = dec.cycles, 1
+        addr = start
+        while addr < pc:
+            entry = self.icache.get(addr) or self.fetch(addr)
+            if entry is None:
+                return None
+            d = entry[0]
+            if d.kind == "JUMP":
+                if start <= (entry[3] + d.offset * 2) & 0xffff <= pc:
+                    return None
+            elif d.mnem not in ("cmp", "bit") or \
+                    (d.smode == 3 and d.sreg not in (Registers.PC, Registers.CG1, Registers.CG2)):
+                return None
+            cycles += d.cycles
+            count += 1
+            addr = entry[3]
+        if addr != pc:
+            return None
+        return Idle_loop(start, pc, cycles, count, dec.op_id)
+
+
+    def invalidate(self, addr, length):
+        """ Llamado por Memory después de cada escritura: descartar del cache
+            las instrucciones que se superponen con addr..addr+length
+        """
+        code_pages = self.code_pages
+        first, last = addr >> PAGE_BITS, ((addr + length - 1) & 0xffff) >> PAGE_BITS
+        if not (code_pages[first] or code_pages[last] or
+                (last > first + 1 and any(code_pages[first:last]))):
+            return              # Datos: la escritura más frecuente
+        if self.block_map:
+            self.invalidate_blocks(addr, length)
+        fused = self.fused
+        if fused:
+            # Un par fusionado ocupa como máximo 12 bytes
+            start = (addr - 10) & ~1
+            if length <= 8:
+                for a in range(start, addr + length, 2):
+                    fused.pop(a, None)
+            else:
+                for a in [a for a in fused if start <= a < addr + length]:
+                    del fused[a]
+        icache = self.icache
+        if not icache:
+            return
+        # Una instrucción ocupa como máximo 6 bytes
+        start = (addr - 4) & ~1
+        if length <= 8:
+            for a in range(start, addr + length, 2):
+                icache.pop(a, None)
+        else:
+            for a in [a for a in icache if start <= a < addr + length]:
+                del icache[a]
+        # Un lazo de espera deja de serlo si se modifica su cuerpo
+        for pc, loop in list(self.idle_loops.items()):
+            if loop.start < addr + length and addr <= loop.end + 1:
+                icache.pop(pc, None)
+                del self.idle_loops[pc]
+
+
+    # Instrucciones que se fusionan con un salto condicional siguiente (todas
+    # calculan C, Z, N y V, ver Registers.defer_flags). Incluyen las emuladas
+    # tst, dec, inc, etc. push se fusiona con un call siguiente.
+    FUSE_FLAGS = frozenset(("cmp", "bit", "add", "addc", "sub", "subc", "and", "xor"))
+    FUSE_FIRST = FUSE_FLAGS | {"push"}
+
+    def fuse(self, pc, entry):
+        """ Buscar si la instrucción <entry> (en <pc>) forma con la siguiente
+            un par frecuente que pueda ejecutarse con un solo handler:
+              - cmp/tst/bit/dec/... seguida de un salto condicional: el
+                salto evalúa sólo la bandera que necesita (ver flag_test)
+              - push seguida de call
+            El par queda en self.fused. El lazo de ejecución lo usa sólo si
+            ningún breakpoint, límite o evento cae sobre la segunda
+            instrucción, así que el estado es siempre el mismo que al
+            ejecutarlas de a una.
+        """
+        dec, src_x, dst_x, mid = entry
+        area = self.memory.area_at(mid)
+        if area is None or not area.initialized(mid):
+            return
+        d2 = self.DECODE[area.read_word(mid)]
+        if d2 is None:
+            return
+        if dec.mnem == "push":
+            if d2.mnem != "call":
+                return
+        elif d2.kind != "JUMP" or d2.mnem == "jmp":
+            return
+        elif dec.mnem not in ("cmp", "bit") and \
+                (dec.dmode != 0 or dec.dreg in (Registers.PC, Registers.SR)):
+            return                  # Escribe la memoria, el PC o el SR
+        second = self.icache.get(mid) or self.fetch(mid)
+        if second is None or second[0].op_id == self.IDLE_JUMP:
+            return
+        if dec.mnem == "push":
+            run = self.fused_call(entry, second)
+        else:
+            run = self.fused_branch(entry, second)
+        self.fused[pc] = Fused(mid, run, dec.cycles, dec.cycles + d2.cycles)
 
-        elif mode == 2:
-            pass
 
+    @staticmethod
+    def flag_test(mnem, byte_op):
+        """ Retorna test(kind, a, b, result, byte_op), que evalúa la condición
+            del salto <mnem> sobre la operación pendiente de la ALU (ver
+            Registers.defer_flags) calculando sólo las banderas necesarias.
+            Es equivalente a Registers.materialize seguido de JUMP_CONDITIONS.
+        """
+        width, msb = (0x00ff, 0x0080) if byte_op else (0xffff, 0x8000)
+
+        def carry(kind, a, b, result, byte_op):
+            if kind == FLAGS_ADD or kind == FLAGS_SUB:
+                return result > width
+            if kind == FLAGS_CARRY:
+                return a != 0
+            return (result & width) != 0
+
+        def overflow(kind, a, b, result):
+            res = result & width
+            if kind == FLAGS_ADD:
+                return ((a ^ res) & (b ^ res) & msb) != 0
+            if kind == FLAGS_SUB:
+                return ((a ^ b) & (b ^ res) & msb) != 0
+            if kind == FLAGS_XOR:
+                return (a & b & msb) != 0
+            return False
+
+        return {
+            "jnz": lambda kind, a, b, result, byte_op: (result & width) != 0,
+            "jz":  lambda kind, a, b, result, byte_op: (result & width) == 0,
+            "jnc": lambda kind, a, b, result, byte_op: not carry(kind, a, b, result, byte_op),
+            "jc":  carry,
+            "jn":  lambda kind, a, b, result, byte_op: (result & msb) != 0,
+            "jge": lambda kind, a, b, result, byte_op:
+                        ((result & msb) != 0) == overflow(kind, a, b, result),
+            "jl":  lambda kind, a, b, result, byte_op:
+                        ((result & msb) != 0) != overflow(kind, a, b, result)
+        }[mnem]
+
+
+    def fused_branch(self, first, second):
+        """ Handler de una instrucción de la ALU seguida de un salto
+            condicional. Las banderas quedan pendientes, como siempre: el SR
+            se calcula recién cuando alguien lo lee.
+        """
+        d1, src_x, dst_x, mid = first
+        d2, _, _, after = second
+        target = (after + d2.offset * 2) & 0xffff
+        op = self.dispatch[d1.op_id]
+        test = self.flag_test(d2.mnem, d1.byte_op)
+        cond = self.JUMP_CONDITIONS[d2.mnem]
+        regs = self.registers
+        reg = regs.reg
+        def run():
+            reg[0] = mid
+            op(d1, src_x, dst_x)
+            pending = regs.pending
+            if pending is not None:
+                taken = test(*pending)
+            else:                   # Sin banderas diferidas (lazy_flags)
+                taken = cond(reg[Registers.SR])
+            reg[0] = target if taken else after
+            return True
+        return run
+
+
+    def fused_call(self, first, second):
+        """ Handler de push seguido de call (pasaje de un argumento por la
+            pila). Si la escritura del push activó un periférico, el par se
+            detiene antes del call para que el lazo atienda el evento.
+        """
+        d1, src_x1, dst_x1, mid = first
+        d2, src_x2, dst_x2, after = second
+        push, call = self.dispatch[d1.op_id], self.dispatch[d2.op_id]
+        reg = self.registers.reg
+        sched = self.scheduler
+        head = d1.cycles
+        def run():
+            reg[0] = mid
+            push(d1, src_x1, dst_x1)
+            if sched.next_event <= self.cycles + head:
+                return False
+            reg[0] = after
+            call(d2, src_x2, dst_x2)
+            return True
+        return run
+
+
+    # Cantidad de ejecuciones de una dirección antes de traducir su bloque
+    TRANSLATE_THRESHOLD = 16
+
+    def set_translation(self, enabled, verify = False):
+        """ Activar (o desactivar) la traducción de bloques básicos a
+            funciones de Python en run/run_until/run_for (ver translator.py).
+            Con <verify>, cada ejecución de un bloque se compara con el
+            intérprete (ver verify_block).
+        """
+        if enabled and self.translator is None:
+            from translator import Translator   # translator importa este módulo
+            self.translator = Translator(self)
+        elif not enabled:
+            self.translator = None
+            self.blocks.clear()
+            self.block_map.clear()
+            self.block_hits.clear()
+        self.verify_blocks = verify
+
+
+    # Eventos de los hooks, y los argumentos de las funciones:
+    #   instruction     antes de ejecutar cada instrucción: hook(pc, dec)
+    #   executed        después de ejecutarla: hook(pc, dec, cycles), con el
+    #                   ciclo del comienzo de la instrucción
+    #   read            después de cada lectura de la memoria (de datos, no
+    #                   de instrucciones): hook(addr, length, value)
+    #   write           después de cada escritura: hook(addr, length, value,
+    #                   old), <old> es el valor anterior
+    #   interrupt       al aceptar una interrupción: hook(vector, pc, sp,
+    #                   cycles), <pc> y <sp> del programa interrumpido
+    #   register        después de cada instrucción que cambie R1-R15:
+    #                   hook(reg, value) por registro (el PC no se informa)
+    HOOK_EVENTS = ("instruction", "executed", "read", "write", "interrupt", "register")
+
+    def add_hook(self, event, hook, start = 0, end = 0x10000):
+        """ Registrar <hook> para el evento <event> (ver HOOK_EVENTS). Los
+            hooks de memoria se limitan a las direcciones entre <start> y
+            <end> (excluido), y sólo las páginas de ese rango se vigilan (ver
+            Memory.watch_page): el resto de la memoria no se hace más lenta.
+            Los hooks de instrucción y de registros hacen que run/run_until/
+            run_for usen run_instrumented; sin ellos no hay ningún costo
+            por instrucción.
+        """
+        if event not in self.HOOK_EVENTS:
+            raise ValueError("Evento desconocido: {}".format(event))
+        if event in ("read", "write"):
+            self.hooks[event].append((hook, start, end))
+            self.update_hook_pages(event)
+        else:
+            self.hooks[event].append(hook)
+        self.update_instrumented()
+
+
+    def remove_hook(self, event, hook):
+        """ Retirar un hook registrado con add_hook
+        """
+        if event in ("read", "write"):
+            hooks = self.hooks[event]
+            hooks.remove(next(h for h in hooks if h[0] == hook))
+            self.update_hook_pages(event)
         else:
-            pass
+            self.hooks[event].remove(hook)
+        self.update_instrumented()
+
+
+    def update_instrumented(self):
+        hooks = self.hooks
+        self.instrumented = bool(hooks["instruction"] or hooks["executed"] or
+                                 hooks["register"])
+
+
+    def update_hook_pages(self, event):
+        """ Vigilar las páginas de los rangos de los hooks de <event> ("read"
+            o "write")
+        """
+        ranges = [(start, end) for hook, start, end in self.hooks[event]]
+        if event == "read":
+            self.trap_pages(self.hook_read, ranges, reader = True)
+        else:
+            self.trap_pages(self.hook_write, ranges, reader = False)
+
+
+    def trap_pages(self, callback, ranges, reader):
+        """ Vigilar con <callback> (ver Memory.watch_page; un reader si
+            <reader> es True, si no un writer) las páginas de <ranges> (una
+            lista de (start, end)), y dejar de vigilar las demás
+        """
+        pages = set()
+        for start, end in ranges:
+            pages.update(range(start >> PAGE_BITS, ((end - 1) >> PAGE_BITS) + 1))
+        watching = self.trapped.get(callback, set())
+        kind = "reader" if reader else "writer"
+        for page in pages - watching:
+            self.memory.watch_page(page, **{kind: callback})
+        for page in watching - pages:
+            self.memory.unwatch_page(page, **{kind: callback})
+        self.trapped[callback] = pages
+
+
+    def hook_read(self, addr, length, value):
+        """ Llamado por Memory después de cada lectura de una página vigilada
+        """
+        for hook, start, end in self.hooks["read"]:
+            if start <= addr < end:
+                hook(addr, length, value)
+
+
+    def hook_write(self, addr, length, value, old):
+        """ Llamado por Memory después de cada escritura a una página vigilada
+        """
+        for hook, start, end in self.hooks["write"]:
+            if start <= addr < end:
+                hook(addr, length, value, old)
+
+
+    def add_watchpoint(self, start, end = None, kind = WATCH_WRITE):
+        """ Detener run/run_until/run_for cuando una instrucción acceda a las
+            direcciones entre <start> y <end> (excluido; por defecto sólo
+            <start>). <kind> es WATCH_READ, WATCH_WRITE o WATCH_CHANGE (sólo
+            las escrituras que cambian el valor). La ejecución se detiene
+            después de la instrucción, con el motivo STOP_WATCHPOINT y el
+            Watch_hit en Run_result.watch (y en watch_hit).
+            Sólo las páginas de los watchpoints pasan por los Memory_trap;
+            el resto de la memoria sigue igual de rápida. Mientras haya
+            watchpoints no se usan los bloques traducidos ni los pares
+            fusionados, para detenerse justo después del acceso.
+            Retorna el Watchpoint (para remove_watchpoint).
+        """
+        if kind not in (WATCH_READ, WATCH_WRITE, WATCH_CHANGE):
+            raise ValueError("Tipo de watchpoint desconocido: {}".format(kind))
+        watchpoint = Watchpoint(kind, start, start + 1 if end is None else end)
+        self.watchpoints.append(watchpoint)
+        self.update_watch_pages()
+        return watchpoint
+
+
+    def remove_watchpoint(self, watchpoint):
+        self.watchpoints.remove(watchpoint)
+        self.update_watch_pages()
+
+
+    def update_watch_pages(self):
+        reads = [(w.start, w.end) for w in self.watchpoints if w.kind == WATCH_READ]
+        writes = [(w.start, w.end) for w in self.watchpoints if w.kind != WATCH_READ]
+        self.trap_pages(self.watch_read, reads, reader = True)
+        self.trap_pages(self.watch_write, writes, reader = False)
+
+
+    def watch_read(self, addr, length, value):
+        """ Llamado por Memory después de cada lectura de una página con
+            watchpoints
+        """
+        for w in self.watchpoints:
+            if w.kind == WATCH_READ and addr < w.end and w.start < addr + length:
+                self.hit_watchpoint(w, addr, length, value, None)
+
+
+    def watch_write(self, addr, length, value, old):
+        """ Llamado por Memory después de cada escritura a una página con
+            watchpoints
+        """
+        for w in self.watchpoints:
+            if w.kind != WATCH_READ and addr < w.end and w.start < addr + length and \
+                    (w.kind == WATCH_WRITE or value != old):
+                self.hit_watchpoint(w, addr, length, value, old)
+
+
+    def hit_watchpoint(self, watchpoint, addr, length, value, old):
+        """ Guardar el primer acceso a un watchpoint y hacer que el lazo de
+            ejecución se detenga después de la instrucción (ver run_loop)
+        """
+        if self.watch_hit is None:
+            self.watch_hit = Watch_hit(watchpoint, addr, length, value, old, None)
+            self.scheduler.force()
+
+
+    def register_values(self):
+        """ Valores de los registros (con las banderas del SR calculadas),
+            para registers_written
+        """
+        regs = self.registers
+        if regs.pending is not None:
+            regs.materialize()
+        return regs.reg.tolist()
+
+
+    def registers_written(self, old):
+        """ Llamar a los hooks "register" por cada registro (menos el PC) que
+            cambió desde <old> (ver register_values)
+        """
+        new = self.register_values()
+        if new[1:] != old[1:]:
+            for reg in range(1, 16):
+                if new[reg] != old[reg]:
+                    for hook in self.hooks["register"]:
+                        hook(reg, new[reg])
+
+
+    def set_tracer(self, tracer):
+        """ Conectar un Tracer (ver tracer.py) que registra cada instrucción
+            ejecutada, o desconectarlo con None. Las instrucciones se
+            registran desde la tabla de ejecución (ver update_dispatch), y
+            las interrupciones con el hook "interrupt".
+        """
+        if self.tracer is not None:
+            self.tracer.detach()
+        self.tracer = tracer
+        if tracer is not None:
+            tracer.attach(self)
+        self.update_dispatch()
+
+
+    def set_profiler(self, profiler):
+        """ Conectar un Profiler (ver profiler.py), o desconectarlo con
+            None. Usa los hooks "executed" e "interrupt".
+        """
+        if self.profiler is not None:
+            self.profiler.detach()
+        self.profiler = profiler
+        if profiler is not None:
+            profiler.attach(self)
+
+
+    def set_coverage(self, coverage):
+        """ Conectar un Coverage_map (ver coverage_map.py), o desconectarlo
+            con None. Los saltos, call, ret/reti y las interrupciones se
+            registran en el bitmap desde la tabla de ejecución, sin hooks de
+            instrucción: run/run_until/run_for siguen en run_loop, pero sin
+            bloques traducidos, pares fusionados ni lazos de espera.
+        """
+        if self.coverage is not None:
+            self.coverage.detach()
+        self.coverage = coverage
+        if coverage is not None:
+            coverage.attach(self)
+        self.update_dispatch()
+
+
+    def update_dispatch(self):
+        """ Reconstruir la tabla de ejecución a partir de self.handlers:
+            con el Tracer, cada entrada registra la instrucción (ver
+            Tracer.make_wrap_handler); con la cobertura se agregan las
+            entradas de los saltos, desde COVER (ver cover_handler). Mientras haya
+            envoltorios no se usan bloques traducidos, pares fusionados ni
+            lazos de espera, que no pasan por la tabla.
+        """
+        table = self.handlers
+        if self.tracer is not None:
+            table = [self.tracer.wrap_handler(handler) for handler in table]
+        if self.coverage is not None:
+            edge = self.coverage.edge
+            table = table + [self.cover_handler(handler, edge) for handler in table]
+        # La misma lista: run_loop y los pares fusionados la tienen guardada
+        self.dispatch[:] = table
+        self.wrapped = self.tracer is not None or self.coverage is not None
+        # Las instrucciones decodificadas (y los bloques) cambian
+        self.invalidate(0, 0x10000)
+
+
+    def hot_block(self, pc):
+        """ Contar una ejecución de <pc>, y traducir su bloque al llegar a
+            TRANSLATE_THRESHOLD. Retorna el Block, o None/False.
+        """
+        hits = self.block_hits.get(pc, 0) + 1
+        if hits < self.TRANSLATE_THRESHOLD:
+            self.block_hits[pc] = hits
+            return None
+        del self.block_hits[pc]
+        block = self.translator.translate(pc)
+        self.code_pages[pc >> PAGE_BITS] = 1
+        if block is None:
+            self.blocks[pc] = False
+            return False
+        self.blocks[pc] = block
+        for a in range(block.start, block.end, 2):
+            self.block_map.setdefault(a, []).append(block)
+            self.code_pages[a >> PAGE_BITS] = 1
+        return block
+
+
+    def drop_block(self, block):
+        if self.blocks.get(block.start) is block:
+            del self.blocks[block.start]
+        for a in range(block.start, block.end, 2):
+            others = self.block_map.get(a)
+            if others and block in others:
+                others.remove(block)
+                if not others:
+                    del self.block_map[a]
+        # Si el bloque se está ejecutando, termina después de la escritura
+        self.scheduler.force()
+
+
+    def invalidate_blocks(self, addr, length):
+        """ Descartar los bloques traducidos que incluyen addr..addr+length
+        """
+        blocks, block_map = self.blocks, self.block_map
+        for a in range(addr & ~1, addr + length, 2):
+            if blocks.get(a) is False:
+                del blocks[a]
+            for block in list(block_map.get(a, ())):
+                self.drop_block(block)
+
+
+    def machine_state(self):
+        """ Registros (con las banderas al día), ciclos y contenido de todas
+            las areas de memoria, para comparar (ver verify_block)
+        """
+        return (self.registers.get_all(), self.cycles,
+                [(area.id, bytes(area.mem), bytes(area.init))
+                 for area in self.memory.areas.values()])
+
+
+    def verify_block(self, block, now, stop, budget):
+        """ Ejecutar <block> y compararlo con el intérprete: se ejecuta el
+            bloque, se vuelve al snapshot previo y se ejecutan las mismas
+            instrucciones con el intérprete. Queda el estado del intérprete.
+            Genera Translation_error si los resultados difieren.
+        """
+        snap = self.snapshot()
+        n = block.run(now, stop, budget)
+        self.cycles = now + (n // block.count) * block.cycles + block.prefix[n % block.count]
+        translated = self.machine_state()
+        self.restore(snap)
+
+        reg = self.registers.reg
+        self.cycles = now
+        for i in range(n):
+            entry = self.icache.get(reg[0]) or self.fetch(reg[0])
+            dec, src_x, dst_x, reg[0] = entry
+            self.dispatch[dec.op_id](dec, src_x, dst_x)
+            self.cycles += dec.cycles
+        interpreted = self.machine_state()
+        self.memory.drop_snapshot(snap[1])
+        self.cycles = now
+
+        if translated != interpreted:
+            from translator import Translation_error
+            raise Translation_error(
+                    "El bloque en 0x{:04x} difiere del intérprete:\n{}".format(
+                        block.start, block.source))
+        return n
+
+
+    def get_src(self, mode, reg, x, byte_op = False):
+        """
+        Devuelve el operando origen (según el modo de direccionamiento del mismo)
+        <x> es la palabra de extensión (ya resuelta, ver fetch)
+        """
+        return self.loaders[self.operand_id(mode, reg, byte_op)](x)
+
+
+    def set_dst(self, mode, reg, x, newval, byte_op = False):
+        """
+        Setea el registro destino (dependiendo del modo de direccionamiento)
+        <x> es la palabra de extensión (ya resuelta, ver fetch)
+        """
+        self.storers[self.operand_id(mode, reg, byte_op)](x, newval)
 
 
     """
@@ -479,40 +1898,33 @@ class MSP430_emulator(MSP430):
         # RRC[.W]: C -> b15 -> b14 -> .... -> b1 -> b0 -> C
         regs = self.registers
         msb = 0x80 if byte_op else 0x8000
-        new_C = (in_val & 1) != 0 # Si el último bit de in_val es 1, tengo Carry
+        in_val &= (msb << 1) - 1
+        new_C = in_val & 1 # Si el último bit de in_val es 1, tengo Carry
         in_val >>= 1
-        if regs.get_flag_by_name("C"):
+        if regs.test_mask(Registers.C_MASK):
             in_val |= msb # Ingresa el carry, si hbaía uno antes, por izquierda
 
-        regs.set_flag_by_name("C", new_C)
-        regs.set_flag_by_name("V", False)
-        regs.set_flag_by_name("Z", in_val == 0)
-        regs.set_flag_by_name("N", (in_val & msb) != 0)
+        regs.defer_flags(FLAGS_CARRY, new_C, 0, in_val, byte_op)
         return in_val
 
-
     def op_rra(self, in_val, byte_op):
         """
         Rotación a la derecha (aritmética)
         """
         # RRA.B:   b15 -> b7 -> b6 -> .... -> b1 -> b0 -> C
         # RRA[.W]: b15 -> b15 -> b14 -> .... -> b1 -> b0 -> C
-        regs = self.registers
         msb = 0x80 if byte_op else 0x8000
-        new_C = (in_val & 1) != 0 # carry o no?
+        in_val &= (msb << 1) - 1
+        new_C = in_val & 1 # carry o no?
         if (in_val & msb) != 0:             # Valor es negativo?
             in_val = (in_val >> 1) | msb    # OR con msb para volver a poner el primer bit en 1 (negativo)
         else:
             in_val >>= 1                    # sino sigue positivo
 
-        # Setear las banderas segun especificaciones (C ya está seteado)
-        regs.set_flag_by_name("C", new_C)
-        regs.set_flag_by_name("V", False)
-        regs.set_flag_by_name("Z", in_val == 0)
-        regs.set_flag_by_name("N", (in_val & msb) != 0)
+        # Las banderas se calculan cuando se necesitan (ver Registers.materialize)
+        self.registers.defer_flags(FLAGS_CARRY, new_C, 0, in_val, byte_op)
         return in_val
 
-
     def op_push(self, in_val, byte_op):
         """
         Insertar en la pila
@@ -521,17 +1933,37 @@ class MSP430_emulator(MSP430):
         # in_val -> [SP]
         regs = self.registers
         new_SP = regs.get_reg(regs.SP) - 2 # Para insertar nueva dirección en el SP, le resto a SP 2, donde iría el nuevo valor
-        self.memory.ram.write_word(new_SP, in_val) # Se inserta en la memoria
+        if byte_op:
+            self.memory.write(new_SP, in_val & 0xff)
+        else:
+            self.memory.write_word(new_SP, in_val) # Se inserta en la memoria
         self.registers.set_reg(regs.SP, new_SP) # Se actualiza el registro SP
 
 
-    def op_call(self): # Llama a una subrutina
+    def op_call(self, in_val): # Llama a una subrutina
         # SP-2 -> SP
-        # in_val -> [SP]
+        # PC -> [SP]
+        # in_val -> PC
         regs = self.registers
         new_SP = regs.get_reg(regs.SP) - 2
-        self.memory.ram.write_word(new_SP, regs.get_reg(regs.PC)) # Inserta en el SP la dirección del PC (dónde volver después de subrutina)
+        self.memory.write_word(new_SP, regs.get_reg(regs.PC)) # Inserta en el SP la dirección del PC (dónde volver después de subrutina)
         self.registers.set_reg(regs.SP, new_SP)
+        self.registers.set_reg(regs.PC, in_val & 0xffff)
+
+
+    def op_reti(self):
+        """
+        Retorno de interrupción: recuperar SR y PC de la pila
+        """
+        regs = self.registers
+        sp = regs.get_reg(regs.SP)
+        regs.set_reg(regs.SR, self.memory.read_word(sp))
+        regs.set_reg(regs.PC, self.memory.read_word(sp + 2))
+        regs.set_reg(regs.SP, sp + 4)
+        if regs.reg[regs.SR] & Registers.CPUOFF_MASK:
+            self.scheduler.force()          # Vuelve al modo de bajo consumo
+        elif regs.reg[regs.SR] & Registers.GIE_MASK:
+            self.interrupts_enabled()
 
 
     def op_swpb(self, in_val):                  # SWPB --> Swap bytes
@@ -550,16 +1982,10 @@ class MSP430_emulator(MSP430):
 
         #resultado-> 0000 0000 0001 0001
 
-        dst = (in_val & 0x00ff) if ((in_val & mask) == 0) else (in_val | 0xff00)
-
-        # Status register update
-        regs = self.registers                               #accedemos a los registros
+        dst = (in_val & 0x00ff) if ((in_val & mask) == 0) else ((in_val | 0xff00) & 0xffff)
 
-        regs.set_flag_by_name("C", dst != 0)
-        regs.set_flag_by_name("V", False)
-        regs.set_flag_by_name("Z", dst == 0)
-        regs.set_flag_by_name("N", (dst & mask) != 0)           #me fijo si el ultimo bit mas significativo es 1 o 0
-        #print("aca lo reslvio ",dst)
+        # Status register update: C = (dst != 0), V = 0
+        self.registers.defer_flags(FLAGS_LOGIC, 0, 0, dst, False)
         return dst
 
 
@@ -585,124 +2011,80 @@ class MSP430_emulator(MSP430):
         """
         dst = (dst & src) & (0x00ff if byte_op else 0xffff)
 
-        # Status register update
-        regs = self.registers
-        mask = 0x0080 if byte_op else 0x8000 # Toma el primer bit para ver si es neg o pos
-        regs.set_flag_by_name("C", dst != 0)
-        regs.set_flag_by_name("V", False)
-        regs.set_flag_by_name("Z", dst == 0)
-        regs.set_flag_by_name("N", (dst & mask) != 0)
+        # Status register update: C = (dst != 0), V = 0
+        self.registers.defer_flags(FLAGS_LOGIC, 0, 0, dst, byte_op)
         return dst
 
     def op_cmp(self, src, dst, byte_op):                # CMP --> Compare source word or byte and destination word or byte
-        """ Operacion CMP: Compara los bits entre src y dst.
+        """ Operacion CMP: Compara (resta) src y dst. No devuelve resultado.
             El Status Register se modifica.
         """
-        ret = dst
-        aux = dst & (0x00ff if byte_op else 0xffff)
-        dst = (dst - src) & (0x00ff if byte_op else 0xffff)
-
-        # Status register update
-        regs = self.registers
-        mask = 0x0080 if byte_op else 0x8000
-        regs.set_flag_by_name("C", (dst & mask) != 0)        # El carry siempre está cuando el primer bit está en 1
-        regs.set_flag_by_name("V", ((decode_signed(aux, 16) < 0) & (decode_signed(src, 16) > 0) & (decode_signed(dst, 16) < 0))
-                                 | ((decode_signed(aux, 16) > 0) & (decode_signed(src, 16) < 0) & (decode_signed(dst, 16) > 0)))   # -SUB+ --> - = V o +SUB- --> + = V
-        regs.set_flag_by_name("Z", dst == 0)
-        regs.set_flag_by_name("N", decode_signed(dst, 16) < 0)        # Explicacion ELI   
-        return ret              # verificar V y C, ver porque no cambia el seteo por consola de flags
+        width = 0x00ff if byte_op else 0xffff
+        src &= width
+        dst &= width
+        # dst - src se calcula como dst + ~src + 1 (el carry es 'no borrow')
+        self.registers.defer_flags(FLAGS_SUB, src, dst,
+                                   dst + (~src & width) + 1, byte_op)
 
     def op_bit(self, src, dst, byte_op):                # BIT --> Bit Test
         """ Operacion BIT: AND entre bits de src y dst. No devuelve resutlado.
             El Status Register se modifica.
         """
-        ret = dst
         dst = (src & dst) & (0x00ff if byte_op else 0xffff)
-        
-        regs = self.registers
-        mask = 0x0080 if byte_op else 0x8000
-        regs.set_flag_by_name("C", dst != 0)
-        regs.set_flag_by_name("V", False)
-        regs.set_flag_by_name("Z", dst == 0)
-        regs.set_flag_by_name("N", (dst & mask) != 0)     
-        return ret
+        self.registers.defer_flags(FLAGS_LOGIC, 0, 0, dst, byte_op)
 
     def op_subc(self, src, dst, byte_op):                # SUBC --> Subtraction Carry
         """ Operacion SUBC: Resta al destino la fuente con carry.
             El Status Register se modifica.
         """
-        aux = dst
         regs = self.registers
-        if (regs.get_flag_by_name("C")):
-            c = 1
-        else:
-            c = 0
-        dst = ((-decode_signed(src, 16)) + c + dst) & (0x00ff if byte_op else 0xffff)
-
-        mask = 0x0080 if byte_op else 0x8000
-        regs.set_flag_by_name("C", (dst & mask) != 0)
-        regs.set_flag_by_name("V", ((decode_signed(src, 16) < 0) & (decode_signed(aux, 16) > 0) & (decode_signed(dst, 16) < 0))
-                                 | ((decode_signed(src, 16) > 0) & (decode_signed(aux, 16) < 0) & (decode_signed(dst, 16) > 0)))
-        regs.set_flag_by_name("Z", dst == 0)
-        regs.set_flag_by_name("N", (dst & mask) != 0)  
-        return dst
+        c = 1 if regs.test_mask(Registers.C_MASK) else 0
+        width = 0x00ff if byte_op else 0xffff
+        src &= width
+        dst &= width
+        result = dst + (~src & width) + c
+        regs.defer_flags(FLAGS_SUB, src, dst, result, byte_op)
+        return result & width
 
     def op_addc(self, src, dst, byte_op):                # ADDC --> Add Carry
         """ Operacion ADDC: Suma al destino la fuente con carry.
             El Status Register se modifica.
         """
-        aux = dst
         regs = self.registers
-        if (regs.get_flag_by_name("C")):
-            c = 1
-        else:
-            c = 0
-        dst = (src + dst + c) & (0x00ff if byte_op else 0xffff)
-
-        mask = 0x0080 if byte_op else 0x8000
-        regs.set_flag_by_name("C", (dst & mask) != 0)
-        regs.set_flag_by_name("V", ((decode_signed(src, 16) < 0) & (decode_signed(aux, 16) < 0) & (decode_signed(dst, 16) > 0))
-                                 | ((decode_signed(src, 16) > 0) & (decode_signed(aux, 16) > 0) & (decode_signed(dst, 16) < 0)))
-        regs.set_flag_by_name("Z", dst == 0)
-        regs.set_flag_by_name("N", (dst & mask) != 0)  
-        return dst
+        c = 1 if regs.test_mask(Registers.C_MASK) else 0
+        width = 0x00ff if byte_op else 0xffff
+        src &= width
+        dst &= width
+        result = src + dst + c
+        regs.defer_flags(FLAGS_ADD, src, dst, result, byte_op)
+        return result & width
 
     def op_xor(self, src, dst, byte_op):                # XOR --> Exclusive OR
         """ Operacion XOR: Realizar la función XOR entre src, y dst.
             El Status Register se modifica.
         """
-        aux = dst
-        dst = (dst ^ src) & (0x00ff if byte_op else 0xffff)
+        width = 0x00ff if byte_op else 0xffff
+        src &= width
+        dst &= width
+        result = dst ^ src
 
-        # Status register update
-        regs = self.registers
-        mask = 0x0080 if byte_op else 0x8000
-        regs.set_flag_by_name("C", dst != 0)
-        regs.set_flag_by_name("V", (decode_signed(aux, 16) < 0) & (decode_signed(src, 16) < 0))
-        regs.set_flag_by_name("Z", dst == 0)
-        regs.set_flag_by_name("N", (dst & mask) != 0)       
-        return dst
+        # Status register update: C = (result != 0), V = ambos negativos
+        self.registers.defer_flags(FLAGS_XOR, src, dst, result, byte_op)
+        return result
 
     def op_add(self, src, dst, byte_op):
         """ Operacion ADD: Toma el el segundo dato y se lo suma
             al primero como resultado.
             El Status Register se modifica.
         """
-        mask = 0x0080 if byte_op else 0x8000
-
-        dst = (dst + src) & mask
-
-        flaga = True if (((dst & mask) == 0) & ((src & mask) == 0)) else False  # verdadero si ambos son positivos
-        flagb = True if (((dst & mask) != 0) & ((src & mask) != 0)) else False  # verdadero si ambos son negativos
+        width = 0x00ff if byte_op else 0xffff
+        src &= width
+        dst &= width
+        result = dst + src
 
-        # Status register update
-        regs = self.registers
-
-        regs.set_flag_by_name("N", (dst & mask) != 0)
-        regs.set_flag_by_name("Z", dst == 0)
-        regs.set_flag_by_name("C", (dst & mask) != 0)
-        regs.set_flag_by_name("V", ( (((dst & mask)!=0) & flaga) | (((dst & mask)==0) & flagb) ) )
-        return dst
+        # Status register update (se calcula cuando se necesita)
+        self.registers.defer_flags(FLAGS_ADD, src, dst, result, byte_op)
+        return result & width
 
     def op_bic(self, src, dst, byte_op):
         """ Operacion BIC: (clear bits in destination) Realizar and entre
@@ -724,19 +2106,15 @@ class MSP430_emulator(MSP430):
 
     def op_sub(self, src, dst, byte_op):
         """
-        Se hace origen - destino
+        Se hace destino - origen
         """
-        temp = True if (src>dst) else False 
-        dst = (dst + ~(src) + 1) & (0x00ff if byte_op else 0xffff)
-        # Status register update
-        regs = self.registers                               #accedemos a los registros
-        mask = 0x0080 if byte_op else 0x8000
-        regs.set_flag_by_name("C", (dst & mask) == 1)
-        regs.set_flag_by_name("V", (dst & mask) == 1)       #me fijo si el ultimo bit mas significativo es 1 o 0
-        regs.set_flag_by_name("Z", dst == 0)#listo
-        regs.set_flag_by_name("N", temp)    #listo      
-        return dst
-    
+        width = 0x00ff if byte_op else 0xffff
+        src &= width
+        dst &= width
+        result = dst + (~src & width) + 1
+        self.registers.defer_flags(FLAGS_SUB, src, dst, result, byte_op)
+        return result & width
+
     def op_bis(self, src, dst, byte_op):
         """
         BIT set. Es un OR entre src y dst
@@ -747,118 +2125,322 @@ class MSP430_emulator(MSP430):
     
     def op_dadd(self, src, dst, byte_op):
         """
-        Suma decimal entre src y dts, con carry
+        Suma decimal (BCD) entre src y dts, con carry
         """
-        ca = 0
         regs = self.registers               #accedemos a los registros
-        if regs.get_flag_by_name("C"):      #aca coloco un 1 si el carry es 1 sino ya tiene el cero colocado
-            ca = 1
-        
-        dst = (dst + src + ca ) & (0x00ff if byte_op else 0xffff)
-        mask = 0x0080 if byte_op else 0x8000
-        # Status register update
-        regs.set_flag_by_name("C", (dst & mask) != 0)
-        #regs.set_flag_by_name("V", False)
-        regs.set_flag_by_name("Z", dst == 0 )
-        regs.set_flag_by_name("N", (dst & mask) != 0)
-        
-        return dst
-
+        carry = 1 if regs.test_mask(Registers.C_MASK) else 0
+        result = 0
+        for shift in range(0, 8 if byte_op else 16, 4):   # Un dígito por vez
+            digit = ((src >> shift) & 0xf) + ((dst >> shift) & 0xf) + carry
+            carry = 1 if digit > 9 else 0
+            if carry:
+                digit -= 10
+            result |= (digit & 0xf) << shift
+
+        # Status register update: C = carry decimal, V = 0
+        regs.defer_flags(FLAGS_CARRY, carry, 0, result, byte_op)
+        return result
 
     def single_step(self):
         """
         Ejecuta una instrucción y aumenta el PC
+        Retorna True, o None si el opcode no es válido (o no está inicializado)
         """
         regs = self.registers
-        pc = regs.get_reg(0)
-        opcode = self.memory.read_word(pc)
-        pc += 2
-        regs.set_reg(0, pc)
-
-        found = self.find_opcode(opcode)
-        if found is None:
+        if regs.reg[Registers.SR] & Registers.CPUOFF_MASK and not self.sleep():
             return None
+        pc = regs.get_reg(0)
+        entry = self.icache.get(pc)
+        if entry is None:
+            entry = self.fetch(pc)
+            if entry is None:
+                return None
+
+        dec, src_x, dst_x, next_pc = entry
+        hooks = self.hooks
+        if self.instrumented:
+            for hook in hooks["instruction"]:
+                hook(pc, dec)
+            if hooks["register"]:
+                old = self.register_values()
+        self.watch_hit = None
+        regs.set_reg(0, next_pc)    # PC apunta a la siguiente instrucción
+        self.dispatch[dec.op_id](dec, src_x, dst_x)
+        if self.watch_hit is not None:
+            self.watch_hit = self.watch_hit._replace(pc = pc)
+        if self.instrumented:
+            for hook in hooks["executed"]:
+                hook(pc, dec, self.cycles)
+            if hooks["register"]:
+                self.registers_written(old)
+        self.instructions += 1
+        self.cycles += dec.cycles
+        if self.cycles >= self.scheduler.next_event:
+            self.check_events()
+        return True
+
+
+    def elapsed_us(self, cycles = None):
+        """ Convertir <cycles> (por defecto el total de ciclos) a
+            microsegundos, según clock_hz
+        """
+        if cycles is None:
+            cycles = self.cycles
+        return cycles * 1e6 / self.clock_hz
 
-        mnem, mask, value, form, kind = found
-        byte_op = self.byte_op(opcode)
-        # Instrucciones de salto. Operando es dirección relativa.
-        if form == "JMP":
-            jump = False
-            if mnem == "JMP":
-                jump = True
-            elif mnem == "JNZ":
-                jump = not regs.get_flag(regs.get_flag_by_name("Z")) # Si Z = 1, es negativo. JNZ indica que salta si != 0
-            elif mnem == "JZ":
-                jump = regs.get_flag(regs.get_flag_by_name("Z"))
-            elif mnem == "JC":      
-                jump = regs.get_flag(regs.get_flag_by_name("C"))
-            elif mnem == "JNC":     
-                jump = not regs.get_flag(regs.get_flag_by_name("C"))
-            elif mnem == "JL":  # Jump si es menor
-                jump = (regs.get_flag(regs.get_flag_by_name("N")) ^ regs.get_flag(regs.get_flag_by_name("V")))
-            elif mnem == "JN": # Jump si es negativo
-                jump = regs.get_flag(regs.get_flag_by_name("N"))
-            elif mnem == "JGE": # Jump si es mayor o igual
-                jump = not (regs.get_flag_by_name("N") ^ regs.get_flag_by_name("V"))
-
-            if jump:
-                offs = decode_signed(opcode & (mask ^ 0xffff), 10) # los 10 bits menos significativos indican el offset
-                pc = pc + offs * 2
-                regs.set_reg(0, pc + offs * 2)
-
-        elif form == "DOUBLE":
-            # pdb.set_trace()
-            dmode, dreg = self.double_dst(opcode)
-            smode, sreg = self.double_src(opcode)
-
-            # Las funciones get_src y get_dst usan el pc porque hay modos de direcc que modifican el pc
-            pc, src = self.get_src(pc, smode, sreg)
-            _, dst = self.get_src(pc, dmode, dreg)   # ATTENTION
-
-            # Diccionario para vincular operación con función que la ejecuta. Esta función se la paso como parámetro a la función set_dst, junto con los
-            # parámetros que necesita cada función op (src, dst, byte_op)
-            result = {"mov": self.op_mov,
-                      "and": self.op_and,
-                      "add": self.op_add,
-                      "bic": self.op_bic,
-                      "cmp": self.op_cmp,
-                      "bit": self.op_bit,
-                      "subc": self.op_subc,
-                      "addc": self.op_addc,
-                      "sub": self.op_sub,
-                      "bis": self.op_bis,
-                      "dadd": self.op_dadd,
-                      "xor": self.op_xor}[mnem](src, dst, byte_op)
-
-            pc = self.set_dst(pc, dmode, dreg, result)
-
-        elif form == "SINGLE_BW":
-            if mnem in ("RRC", "RRA", "PUSH"):
-                mode, reg = self.single_sd(opcode)
-                _, src = self.get_src(pc, mode, reg)
-
-                result = {"RRC": self.op_rrc,
-                          "RRA": self.op_rra,
-                          "PUSH": self.op_push}[mnem](src, byte_op)
-
-                pc = self.set_dst(pc, mode, reg, result)
 
-        elif form == "SINGLE":
-            if mnem in ("SXT", "SWPB", "CALL"):
-                mode, reg = self.single_sd(opcode)
-                _, src = self.get_src(pc, mode, reg)
+    def run(self, max_instructions):
+        """ Ejecutar hasta <max_instructions> instrucciones.
+            Retorna un Run_result (motivo, pc, cantidad ejecutada).
+        """
+        return self.run_loop(max_instructions, frozenset(), None, None)
 
-                result = {"CALL": self.op_call,
-                          "SWPB": self.op_swpb,
-                          "SXT": self.op_sxt}[mnem](src)
 
-                pc = self.set_dst(pc, mode, reg, result)
+    def run_until(self, stop, max_instructions = None):
+        """ Ejecutar hasta que el PC llegue a una de las direcciones de <stop>
+            (un conjunto de breakpoints), o hasta que stop(emulador) retorne
+            True si <stop> es una función. El breakpoint en el PC inicial se
+            ignora, para poder continuar desde un breakpoint.
+        """
+        if callable(stop):
+            return self.run_loop(max_instructions, frozenset(), stop, None)
+        return self.run_loop(max_instructions, frozenset(stop), None, None)
 
-        elif form == "SINGLE_RETI":
-            pass
 
-        regs.set_reg(Registers.PC, pc)
-        return
+    def run_for(self, cycles, stop = ()):
+        """ Ejecutar durante (por lo menos) <cycles> ciclos de reloj, o hasta
+            llegar a un breakpoint de <stop>. La última instrucción puede
+            terminar algunos ciclos después.
+        """
+        return self.run_loop(None, frozenset(stop), None, cycles)
+
+
+    def run_loop(self, max_instructions, breakpoints, predicate, cycles):
+        """ Lazo de ejecución común de run, run_until y run_for.
+            Las verificaciones por instrucción se limitan a la pertenencia
+            del PC al conjunto de breakpoints (y la función <predicate> si
+            se indicó una).
+            Con la CPU apagada (CPUOFF), y en los lazos de espera sin efectos
+            (ver find_idle_loop), el reloj avanza directamente hasta el
+            próximo evento.
+            Si hay hooks de instrucción se usa run_instrumented.
+        """
+        if self.interrupts:
+            # El SR pudo cambiar desde afuera (p.ej. set_reg) con GIE en 1
+            self.scheduler.force()
+        if self.instrumented:
+            return self.run_instrumented(max_instructions, breakpoints, predicate, cycles)
+        limit = sys.maxsize if max_instructions is None else max_instructions
+        start = self.cycles
+        target = sys.maxsize if cycles is None else start + cycles
+        reg = self.registers.reg
+        icache, fetch, dispatch = self.icache, self.fetch, self.dispatch
+        sched = self.scheduler
+        # Bloques traducidos (no se usan si hay que evaluar <predicate> en
+        # cada instrucción)
+        blocks = self.blocks if self.translator is not None and predicate is None else None
+        verify = self.verify_blocks and not self.peripherals
+        # Pares fusionados (ver fuse), con las mismas condiciones
+        fused = self.fused if self.fuse_pairs and predicate is None else None
+        # Con watchpoints se ejecuta de a una instrucción, para detenerse
+        # justo después del acceso; con el trace o la cobertura, para
+        # registrar todas las instrucciones o saltos
+        if self.watchpoints or self.wrapped:
+            blocks = fused = None
+        self.watch_hit = None
+
+        count = 0
+        reason = STOP_COUNT
+        if reg[Registers.SR] & Registers.CPUOFF_MASK and not self.sleep(target):
+            limit = 0
+            reason = STOP_SLEEP
+        now = self.cycles
+        if now >= target:
+            limit = 0
+            reason = STOP_CYCLES
+
+        while count < limit:
+            pc = reg[0]
+            if pc in breakpoints and count:
+                reason = STOP_BREAKPOINT
+                break
+            if predicate is not None and predicate(self):
+                reason = STOP_PREDICATE
+                break
+
+            block = None
+            if blocks is not None:
+                block = blocks.get(pc)
+                if block is None:
+                    block = self.hot_block(pc)
+                # El bloque se ejecuta entero sólo si ningún evento, límite
+                # o breakpoint cae antes de su última instrucción
+                if block and not (count + block.count <= limit and
+                                  now + block.head < sched.next_event and
+                                  now + block.head < target and
+                                  breakpoints.isdisjoint(block.inner)):
+                    block = None
+            if block:
+                self.cycles = now
+                # Un breakpoint al comienzo del bloque limita los lazos a
+                # una vuelta
+                budget = limit - count if pc not in breakpoints else block.count
+                if verify:
+                    n = self.verify_block(block, now, target, budget)
+                else:
+                    n = block.run(now, target, budget)
+                count += n
+                now += (n // block.count) * block.cycles + block.prefix[n % block.count]
+            else:
+                pair = fused.get(pc) if fused is not None else None
+                # El par se ejecuta junto sólo si no hay que detenerse (ni
+                # atender un evento) en la segunda instrucción
+                if pair is not None and count + 1 < limit and \
+                        now + pair.head < sched.next_event and \
+                        now + pair.head < target and pair.second not in breakpoints:
+                    self.cycles = now
+                    if pair.run():
+                        count += 2
+                        now += pair.cycles
+                    else:
+                        count += 1
+                        now += pair.head
+                    pc = None
+                if pc is not None:
+                    entry = icache.get(pc)
+                    if entry is None:
+                        entry = fetch(pc)
+                        if entry is None:
+                            reason = STOP_INVALID
+                            break
+                    dec, src_x, dst_x, reg[0] = entry
+                    self.cycles = now   # Los periféricos ven el ciclo actual
+                    dispatch[dec.op_id](dec, src_x, dst_x)
+                    count += 1
+                    now += dec.cycles
+            if now >= sched.next_event:
+                if self.watch_hit is not None:
+                    # La instrucción en <pc> tocó un watchpoint
+                    self.watch_hit = self.watch_hit._replace(pc = pc)
+                    reason = STOP_WATCHPOINT
+                    break
+                loop = self.idle_loop
+                if loop is not None and not self.interrupts and predicate is None \
+                        and not any(loop.start <= bp <= loop.end for bp in breakpoints):
+                    # Saltear las vueltas completas que caben antes del
+                    # próximo evento (o del fin de run_for)
+                    wake = min(sched.next_pending(), target)
+                    if wake == sys.maxsize and limit == sys.maxsize:
+                        reason = STOP_IDLE
+                        break
+                    if wake > now:
+                        laps = min((wake - now) // loop.cycles,
+                                   (limit - count) // loop.count)
+                        now += laps * loop.cycles
+                        count += laps * loop.count
+                self.cycles = now
+                self.check_events()
+                if self.watch_hit is not None:
+                    # Un acceso de la entrada a una interrupción o de un
+                    # periférico
+                    now = self.cycles
+                    reason = STOP_WATCHPOINT
+                    break
+                if reg[Registers.SR] & Registers.CPUOFF_MASK and not self.sleep(target):
+                    reason = STOP_SLEEP
+                    break
+                now = self.cycles
+            if now >= target:
+                reason = STOP_CYCLES
+                break
+
+        self.instructions += count
+        self.cycles = now
+        return Run_result(reason, reg[0], count, now - start,
+                          self.watch_hit if reason == STOP_WATCHPOINT else None)
+
+
+    def run_instrumented(self, max_instructions, breakpoints, predicate, cycles):
+        """ Lazo de ejecución de run_loop cuando hay hooks de instrucción o
+            de registros (ver add_hook). Ejecuta de a una instrucción: sin
+            bloques traducidos, pares fusionados, ni lazos de espera
+            salteados.
+        """
+        limit = sys.maxsize if max_instructions is None else max_instructions
+        start = self.cycles
+        target = sys.maxsize if cycles is None else start + cycles
+        reg = self.registers.reg
+        icache, fetch, dispatch = self.icache, self.fetch, self.dispatch
+        sched = self.scheduler
+        before, after = self.hooks["instruction"], self.hooks["executed"]
+        registers = self.hooks["register"]
+        self.watch_hit = None
+
+        count = 0
+        reason = STOP_COUNT
+        if reg[Registers.SR] & Registers.CPUOFF_MASK and not self.sleep(target):
+            limit = 0
+            reason = STOP_SLEEP
+        now = self.cycles
+        if now >= target:
+            limit = 0
+            reason = STOP_CYCLES
+
+        while count < limit:
+            pc = reg[0]
+            if pc in breakpoints and count:
+                reason = STOP_BREAKPOINT
+                break
+            if predicate is not None and predicate(self):
+                reason = STOP_PREDICATE
+                break
+
+            entry = icache.get(pc)
+            if entry is None:
+                entry = fetch(pc)
+                if entry is None:
+                    reason = STOP_INVALID
+                    break
+            dec, src_x, dst_x, next_pc = entry
+            self.cycles = now
+            for hook in before:
+                hook(pc, dec)
+            if registers:
+                old = self.register_values()
+            reg[0] = next_pc
+            dispatch[dec.op_id](dec, src_x, dst_x)
+            for hook in after:
+                hook(pc, dec, now)
+            if registers:
+                self.registers_written(old)
+            count += 1
+            now += dec.cycles
+
+            if now >= sched.next_event:
+                if self.watch_hit is not None:
+                    self.watch_hit = self.watch_hit._replace(pc = pc)
+                    reason = STOP_WATCHPOINT
+                    break
+                self.cycles = now
+                self.check_events()
+                if self.watch_hit is not None:
+                    # Un acceso de la entrada a una interrupción o de un
+                    # periférico
+                    now = self.cycles
+                    reason = STOP_WATCHPOINT
+                    break
+                if reg[Registers.SR] & Registers.CPUOFF_MASK and not self.sleep(target):
+                    reason = STOP_SLEEP
+                    break
+                now = self.cycles
+            if now >= target:
+                reason = STOP_CYCLES
+                break
+
+        self.instructions += count
+        self.cycles = now
+        return Run_result(reason, reg[0], count, now - start,
+                          self.watch_hit if reason == STOP_WATCHPOINT else None)
 
 
     """
@@ -1165,6 +2747,153 @@ def test_emulation():
 
     # Para que ejecute las n instrucciones dle archivo, debería hacer un memory.initialized(addr):
 
+def test_hooks():
+    """ Velocidad de run() sin hooks, con hooks registrados y retirados (debe
+        ser la misma: sin hooks se usa el mismo lazo), y con hooks activos
+    """
+    import time
+
+    program = (0x4035, 200,                 # mov   #200, r5
+               0x5506,                      # add   r5, r6
+               0x4682, 0x1c00,              # mov   r6, &0x1c00
+               0x8315,                      # dec   r5
+               0x23fb,                      # jnz   $-8
+               0x3ff8)                      # jmp   $-16
+    def emulator():
+        memory = Memory()
+        memory.reserve("ROM", 0xfc00, 1024, "R")
+        memory.reserve("RAM", 0x1c00, 1024, "RW")
+        memory.write_block(0xfc00, b"".join(w.to_bytes(2, "little") for w in program))
+        memory.write_word(0xfffe, 0xfc00)
+        return MSP430_emulator(memory)
+
+    def speed(msp, n = 200000):
+        best = None
+        for i in range(5):
+            t = time.perf_counter()
+            assert msp.run(n).count == n
+            t = time.perf_counter() - t
+            best = t if best is None else min(best, t)
+        return n / best
+
+    writes = []
+    def on_write(addr, length, value, old):
+        writes.append(addr)
+    def on_instruction(pc, dec):
+        pass
+
+    base = speed(emulator())
+    msp = emulator()
+    msp.add_hook("write", on_write)
+    msp.add_hook("instruction", on_instruction)
+    msp.remove_hook("write", on_write)
+    msp.remove_hook("instruction", on_instruction)
+    removed = speed(msp)
+    print("sin hooks:             {:9.0f} instr/s".format(base))
+    print("hooks retirados:       {:9.0f} instr/s ({:+.1f}%)".format(
+                removed, (removed / base - 1) * 100))
+    msp = emulator()
+    msp.add_hook("write", on_write, 0x1c00, 0x1c02)
+    print("hook de escritura:     {:9.0f} instr/s".format(speed(msp)))
+    msp = emulator()
+    msp.add_hook("instruction", on_instruction)
+    print("hook de instrucción:   {:9.0f} instr/s".format(speed(msp)))
+
+
+def test_watchpoints():
+    """ Detenerse en la escritura de un contador en la RAM, cuando cambia
+    """
+    program = (0x4382, 0x1c00,              # mov   #0, &0x1c00
+               0x5392, 0x1c00,              # inc   &0x1c00
+               0x4392, 0x1c02,              # mov   #1, &0x1c02
+               0x3ffb)                      # jmp   $-8
+    memory = Memory()
+    memory.reserve("ROM", 0xfc00, 1024, "R")
+    memory.reserve("RAM", 0x1c00, 1024, "RW")
+    memory.write_block(0xfc00, b"".join(w.to_bytes(2, "little") for w in program))
+    memory.write_word(0xfffe, 0xfc00)
+    msp = MSP430_emulator(memory)
+
+    watchpoint = msp.add_watchpoint(0x1c00, 0x1c02, WATCH_CHANGE)
+    for i in range(3):
+        print(msp.run(1000))
+    msp.remove_watchpoint(watchpoint)
+    msp.add_watchpoint(0x1c02, kind = WATCH_CHANGE)
+    print(msp.run(1000))
+
+
+def test_translation():
+    """ Los mismos resultados con y sin la traducción de bloques: un lazo
+        con todos los modos de direccionamiento (registro, indexado,
+        simbólico, absoluto, indirecto, autoincremento, inmediato y los
+        generadores de constantes), en byte y en palabra, con verify
+        comparando cada ejecución de un bloque con el intérprete
+    """
+    program = (0x4031, 0x1c40,             # mov   #1c40, sp
+               0x4034, 0x1c00,             # mov   #1c00, r4
+               0x4035, 0x0014,             # mov   #20, r5
+               0x4036, 0x1c10,             # mov   #1c10, r6             (fc0c)
+               0x5437,                     # add   @r4+, r7
+               0x6668,                     # addc.b @r6, r8
+               0x8619, 0x0002,             # sub   2(r6), r9
+               0xe296, 0x1c04, 0x0004,     # xor   &1c04, 4(r6)
+               0xd786, 0x0006,             # bis   r7, 6(r6)
+               0x401a, 0x1fe4,             # mov   1c08, r10           (simbólico)
+               0x5580, 0x1fe2,             # add   r5, 1c0a            (simbólico)
+               0x9339,                     # cmp   #-1, r9
+               0x632a,                     # addc  #2, r10
+               0x522b,                     # add   #4, r11
+               0x523b,                     # add   #8, r11
+               0x735c,                     # subc.b #1, r12
+               0xa70c,                     # dadd  r7, r12
+               0xb039, 0x0010,             # bit   #10, r9
+               0x1009,                     # rrc   r9
+               0x1156, 0x0003,             # rra.b 3(r6)
+               0x10a6,                     # swpb  @r6
+               0x1192, 0x1c0c,             # sxt   &1c0c
+               0x1236,                     # push  @r6+
+               0x1256, 0x0001,             # push.b 1(r6)
+               0x413d,                     # pop   r13
+               0x413e,                     # pop   r14
+               0x48c6, 0xffff,             # mov.b r8, -1(r6)
+               0x12b0, 0xfc74,             # call  #sub
+               0x990a,                     # cmp   r9, r10
+               0x3801,                     # jl    $+4
+               0x531b,                     # inc   r11
+               0x2c01,                     # jc    $+4
+               0x831b,                     # dec   r11
+               0x3001,                     # jn    $+4
+               0xe33c,                     # inv   r12
+               0xf034, 0x1c1e,             # and   #1c1e, r4
+               0x8315,                     # dec   r5
+               0x23cf,                     # jnz   fc0c
+               0x4035, 0x0014,             # mov   #20, r5
+               0x3fcc,                     # jmp   fc0c
+               0x531f,                     # inc   r15                   (sub)
+               0x4130)                     # ret
+    def emulator():
+        memory = Memory()
+        memory.reserve("ROM", 0xfc00, 1024, "R")
+        memory.reserve("RAM", 0x1c00, 1024, "RW")
+        memory.write_block(0xfc00, b"".join(w.to_bytes(2, "little") for w in program))
+        memory.write_word(0xfffe, 0xfc00)
+        memory.write_block(0x1c00, bytes((i * 37 + 11) & 0xff for i in range(64)))
+        return MSP430_emulator(memory)
+
+    plain = emulator()
+    translated = emulator()
+    translated.set_translation(True, verify = True)
+    print(plain.run(20000))
+    print(translated.run(20000))
+    blocks = [block for block in translated.blocks.values() if block]
+    print("{} bloques traducidos".format(len(blocks)))
+    assert blocks
+    assert translated.registers.get_all() == plain.registers.get_all()
+    assert translated.cycles == plain.cycles
+    assert translated.memory.read_block(0x1c00, 1024, False) == \
+           plain.memory.read_block(0x1c00, 1024, False)
+
+
 def test_parse_registers():
     memory = Memory()
     memory.reserve("ROM", 0xfc00, 1024, "R")
@@ -1185,6 +2914,9 @@ def main(args):
     # ~ test_disasm_modes()
     # ~ test_registers()
     # ~ test_parse_registers()
+    # ~ test_hooks()
+    # ~ test_watchpoints()
+    # ~ test_translation()
     test_emulation()
     # test_parser()
     return 0
@@ -27,7 +27,7 @@ gi.require_version('Gtk', '3.0')
 gi.require_version('GtkSource', '3.0')
 from gi.repository import Gdk, GdkPixbuf, Gtk, GtkSource
 from msp430 import MSP430_assembler, MSP430_disassembler, MSP430_emulator
-from memory import Memory
+from memory import Memory, Memory_error
 
 MAIN_TITLE = "Herramientas de Desarrollo para MSP430"
 VERSION = "1.0"
@@ -86,6 +86,7 @@ class Emulator(Gtk.Frame):
         self.toplevel = toplevel
         super(Emulator, self).__init__()
         self.ejecutar = True
+        self.mem_token = 0      # Ver Memory.changes_since
 
         self.fixed = Gtk.Fixed()
 
@@ -164,7 +165,10 @@ class Emulator(Gtk.Frame):
 
         if fc.run() == Gtk.ResponseType.OK:
             fname = fc.get_filename()
-            mspEMU.memory.load_intel(fname)
+            try:
+                mspEMU.memory.load_intel(fname)
+            except Memory_error as err:
+                print(err)
             self.refresh_memory()
             self.reset()
 
@@ -250,13 +254,19 @@ class Emulator(Gtk.Frame):
 
 
     def refresh_memory(self):
-        s = mspEMU.memory.dump_mem("ROM").split(",")
-        # for i in range(len(s)):
-        #     self.cellROM[i].set_properties(label = s[i])
-
-        e = mspEMU.memory.dump_mem("ROM").split(",")
-        for i in range(len(e)):
-            self.cellRAM[i].set_properties(label = e[i])
+        """ Actualizar sólo las celdas de las páginas modificadas desde la
+            última actualización
+        """
+        rom = mspEMU.memory.areas["ROM"]
+        self.mem_token, changed = mspEMU.memory.changes_since(self.mem_token)
+        for start, end in changed:
+            lo, hi = max(start, rom.base), min(end, rom.end)
+            if lo >= hi:
+                continue
+            e = rom.dump_mem_w(lo, hi).split(",")
+            first = (lo - rom.base) // 2
+            for i in range(len(e) - 1):
+                self.cellRAM[first + i].set_properties(label = e[i])
 
 
     def make_register_viewer(self):
@@ -363,6 +373,7 @@ class Emulator(Gtk.Frame):
             if (memory.initialized(addr)):
                 mspEMU.single_step()
                 self.refresh_regs()
+                self.refresh_memory()
                 self.emulator_add_text(s + "\n")
             else:
                 print("No hay más instrucciones en la memoria")
@@ -396,6 +407,7 @@ class Emulator(Gtk.Frame):
         if (memory.initialized(addr)):
             mspEMU.single_step()
             self.refresh_regs()
+            self.refresh_memory()
             self.emulator_add_text(s + "\n")
 
             while Gtk.events_pending(): Gtk.main_iteration()
@@ -0,0 +1,506 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  peripherals.py
+#
+#  Copyright 2020 John Coppens <john@jcoppens.com>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#  Periféricos del emulador. Las direcciones y vectores por defecto son
+#  los de la familia MSP430F5xx (RAM en 0x1c00).
+#
+#  Los periféricos no se consultan en cada instrucción: agendan su próximo
+#  evento en el Scheduler del emulador, y reaccionan a las escrituras a
+#  sus registros (ver MSP430_emulator.attach).
+#
+
+
+class Peripheral():
+    """ Clase base de los periféricos. <areas> es la lista de areas de
+        registros (id, base, tamaño) que reserva el emulador.
+        Los registros se guardan en la memoria: el periférico los lee con
+        peek y los modifica con poke.
+    """
+    def __init__(self, areas):
+        self.areas = areas
+        self.emu = None
+        self.poking = False
+
+
+    def attach(self, emu):
+        self.emu = emu
+        self.memory = emu.memory
+        self.reset()
+
+
+    def reset(self):
+        """ Estado inicial (después de un PUC)
+        """
+        pass
+
+
+    def written(self, addr, length):
+        """ Llamado después de cada escritura a una página con registros del
+            periférico (no necesariamente a sus registros)
+        """
+        pass
+
+
+    def overlaps(self, addr, length, base, size):
+        return addr < base + size and base < addr + length
+
+
+    def peek(self, addr, byte = False):
+        area = self.memory.area_at(addr)
+        if byte:
+            return area.read(addr, False)
+        return area.read_word(addr, False)
+
+
+    def poke(self, addr, value, byte = False):
+        """ Modificar un registro sin provocar written. Se escribe con
+            write_block: el cambio se registra (snapshots, changes_since,
+            suscriptores), pero no pasa por las trampas de los hooks de
+            memoria y los watchpoints, que son para los accesos del
+            procesador (ver Memory.watch_page).
+        """
+        self.poking = True
+        if byte:
+            self.memory.write_block(addr, bytes((value & 0xff,)))
+        else:
+            self.memory.write_block(addr, (value & 0xffff).to_bytes(2, "little"))
+        self.poking = False
+
+
+    def now(self):
+        return self.emu.cycles
+
+
+class Timer_A(Peripheral):
+    """ Timer_A: modos stop, up, continuo y up/down, divisor de entrada, y
+        comparación en todos los CCR (la captura no está implementada).
+        El reloj del timer es MCLK (no se emulan ACLK/SMCLK por separado).
+        TAR se actualiza en cada evento y en cada escritura a los registros.
+    """
+    CTL, IV, R = 0x00, 0x2e, 0x10
+    CCTL, CCR = 0x02, 0x12          # + 2 * n
+
+    # Bits de TAxCTL
+    TACLR   = 0x0004
+    TAIE    = 0x0002
+    TAIFG   = 0x0001
+    # Bits de TAxCCTLn
+    CAP     = 0x0100
+    CCIE    = 0x0010
+    CCIFG   = 0x0001
+
+    MC_STOP, MC_UP, MC_CONT, MC_UPDOWN = range(4)
+    TAIV_TAIFG = 0x0e
+
+    def __init__(self, id = "TA0", base = 0x0340, nr_ccr = 3,
+                 vector_ccr0 = 0xffea, vector_iv = 0xffe8):
+        super(Timer_A, self).__init__([(id, base, 0x30)])
+        self.base = base
+        self.nr_ccr = nr_ccr
+        self.vector_ccr0 = vector_ccr0
+        self.vector_iv = vector_iv
+        self.event = None
+
+
+    def reset(self):
+        self.emu.scheduler.cancel(self.event)
+        self.event = None
+        for offs in range(0, 0x30, 2):
+            self.poke(self.base + offs, 0)
+        self.pos = 0                # Posición dentro del período
+        self.when = self.now()      # Ciclo en que el contador estaba en pos
+        self.update_irq()
+
+
+    def reg(self, offs):
+        return self.peek(self.base + offs)
+
+
+    def config(self):
+        """ Retorna (modo, divisor, ccr0) según TAxCTL y TAxCCR0
+        """
+        ctl = self.reg(self.CTL)
+        return (ctl >> 4) & 3, 1 << ((ctl >> 6) & 3), self.reg(self.CCR)
+
+
+    def period(self, mode, ccr0):
+        """ Cantidad de cuentas del ciclo completo del contador (0: detenido)
+        """
+        if mode == self.MC_UP:
+            return ccr0 + 1 if ccr0 else 0
+        if mode == self.MC_CONT:
+            return 0x10000
+        if mode == self.MC_UPDOWN:
+            return 2 * ccr0
+        return 0
+
+
+    def tar(self, mode, ccr0, pos):
+        if mode == self.MC_UPDOWN and pos > ccr0:
+            return 2 * ccr0 - pos
+        return pos
+
+
+    def positions(self, mode, ccr0, period, value):
+        """ Posiciones del período en las que TAR vale <value>
+        """
+        if value >= period and not (mode == self.MC_UPDOWN and value == ccr0):
+            return ()
+        if mode == self.MC_UPDOWN and 0 < value < ccr0:
+            return (value, period - value)
+        return (value,)
+
+
+    def advance(self, now):
+        """ Avanzar el contador hasta el ciclo <now> con la configuración
+            actual
+        """
+        mode, div, ccr0 = self.config()
+        period = self.period(mode, ccr0)
+        ticks = (now - self.when) // div
+        if period:
+            self.pos = (self.pos + ticks) % period
+        self.when += ticks * div
+
+
+    def schedule(self):
+        """ Agendar el próximo evento: el siguiente valor de TAR que coincide
+            con un CCR, o el paso por 0
+        """
+        sched = self.emu.scheduler
+        sched.cancel(self.event)
+        self.event = None
+        mode, div, ccr0 = self.config()
+        period = self.period(mode, ccr0)
+        if not period:
+            return
+
+        targets = [0]
+        for n in range(self.nr_ccr):
+            if not self.reg(self.CCTL + 2*n) & self.CAP:
+                targets.extend(self.positions(mode, ccr0, period,
+                                              self.reg(self.CCR + 2*n)))
+        ticks = min((t - self.pos) % period or period for t in targets)
+        self.event = sched.post(self.when + ticks * div, self.expired)
+
+
+    def expired(self, cycle):
+        self.event = None
+        self.advance(cycle)
+        mode, div, ccr0 = self.config()
+        tar = self.tar(mode, ccr0, self.pos)
+        self.poke(self.base + self.R, tar)
+
+        for n in range(self.nr_ccr):
+            cctl = self.reg(self.CCTL + 2*n)
+            if not cctl & self.CAP and self.reg(self.CCR + 2*n) == tar:
+                self.poke(self.base + self.CCTL + 2*n, cctl | self.CCIFG)
+        if self.pos == 0:
+            self.poke(self.base + self.CTL, self.reg(self.CTL) | self.TAIFG)
+
+        self.schedule()
+        self.update_irq()
+
+
+    def written(self, addr, length):
+        if self.poking or not self.overlaps(addr, length, self.base, 0x30):
+            return
+        # TAR siguió contando con la configuración anterior hasta ahora.
+        # (La nueva configuración ya está en la memoria: el error es de a lo
+        # sumo el tiempo de una instrucción.)
+        now = self.now()
+        self.advance(now)
+        if self.overlaps(addr, length, self.base + self.R, 2):
+            self.pos = self.reg(self.R)
+            self.when = now
+        ctl = self.reg(self.CTL)
+        if ctl & self.TACLR:
+            self.pos = 0
+            self.when = now
+            self.poke(self.base + self.CTL, ctl & ~self.TACLR)
+        mode, div, ccr0 = self.config()
+        self.poke(self.base + self.R, self.tar(mode, ccr0, self.pos))
+        self.schedule()
+        self.update_irq()
+
+
+    def pending_iv(self):
+        """ Valor de TAxIV: la fuente pendiente de mayor prioridad del
+            vector compartido (CCR1..n y TAIFG), o 0
+        """
+        for n in range(1, self.nr_ccr):
+            cctl = self.reg(self.CCTL + 2*n)
+            if cctl & self.CCIE and cctl & self.CCIFG:
+                return 2 * n
+        ctl = self.reg(self.CTL)
+        if ctl & self.TAIE and ctl & self.TAIFG:
+            return self.TAIV_TAIFG
+        return 0
+
+
+    def update_irq(self):
+        cctl0 = self.reg(self.CCTL)
+        if cctl0 & self.CCIE and cctl0 & self.CCIFG:
+            self.emu.request_interrupt(self.vector_ccr0, self.ack_ccr0)
+        else:
+            self.emu.clear_interrupt(self.vector_ccr0)
+
+        iv = self.pending_iv()
+        self.poke(self.base + self.IV, iv)
+        if iv:
+            self.emu.request_interrupt(self.vector_iv, self.ack_iv)
+        else:
+            self.emu.clear_interrupt(self.vector_iv)
+
+
+    def ack_ccr0(self, vector):
+        # CCIFG de CCR0 se borra automáticamente al aceptar la interrupción
+        self.poke(self.base + self.CCTL, self.reg(self.CCTL) & ~self.CCIFG)
+        self.update_irq()
+
+
+    def ack_iv(self, vector):
+        # Sin hooks de lectura, la lectura de TAxIV de la rutina se emula
+        # aquí: se borra la bandera atendida y TAxIV conserva su valor
+        iv = self.pending_iv()
+        if iv == self.TAIV_TAIFG:
+            self.poke(self.base + self.CTL, self.reg(self.CTL) & ~self.TAIFG)
+        else:
+            offs = self.CCTL + iv
+            self.poke(self.base + offs, self.reg(offs) & ~self.CCIFG)
+        self.update_irq()
+        self.poke(self.base + self.IV, iv)
+
+
+class Watchdog(Peripheral):
+    """ Watchdog (WDT_A). En modo watchdog provoca un reset al vencer, o
+        al escribir WDTCTL sin la clave. En modo intervalo activa WDTIFG
+        (en SFRIFG1) y pide la interrupción si WDTIE (en SFRIE1) está
+        habilitado.
+    """
+    WDTPW   = 0x5a00                # Clave de escritura
+    WDTRD   = 0x6900                # Byte alto al leer WDTCTL
+    WDTHOLD = 0x0080
+    WDTTMSEL = 0x0010
+    WDTCNTCL = 0x0008
+    WDTIS   = 0x0007
+    WDTIE = WDTIFG = 0x0001         # Bits en SFRIE1 y SFRIFG1
+
+    # Períodos (en ciclos) según WDTIS
+    INTERVALS = (1 << 31, 1 << 27, 1 << 23, 1 << 19,
+                 1 << 15, 1 << 13, 1 << 9,  1 << 6)
+
+    def __init__(self, ctl = 0x015c, sfr = 0x0100, vector = 0xfff2):
+        super(Watchdog, self).__init__([("SFR", sfr, 4), ("WDT", ctl, 2)])
+        self.ctl = ctl
+        self.sfrie = sfr
+        self.sfrifg = sfr + 2
+        self.vector = vector
+        self.event = None
+
+
+    def reset(self):
+        self.poke(self.sfrie, 0)
+        self.poke(self.sfrifg, 0)
+        self.poke(self.ctl, self.WDTRD | 0x0004)
+        self.start = self.now()
+        self.schedule()
+        self.update_irq()
+
+
+    def schedule(self):
+        sched = self.emu.scheduler
+        sched.cancel(self.event)
+        self.event = None
+        ctl = self.peek(self.ctl)
+        if not ctl & self.WDTHOLD:
+            cycle = max(self.start + self.INTERVALS[ctl & self.WDTIS], self.now())
+            self.event = sched.post(cycle, self.expired)
+
+
+    def expired(self, cycle):
+        self.event = None
+        if not self.peek(self.ctl) & self.WDTTMSEL:
+            self.emu.reset()            # Venció el watchdog
+            return
+        self.poke(self.sfrifg, self.peek(self.sfrifg) | self.WDTIFG)
+        self.start = cycle
+        self.schedule()
+        self.update_irq()
+
+
+    def written(self, addr, length):
+        if self.poking:
+            return
+        if self.overlaps(addr, length, self.ctl, 2):
+            value = self.peek(self.ctl)
+            if length < 2 or (value & 0xff00) != self.WDTPW:
+                self.emu.reset()        # Violación de la clave
+                return
+            if value & self.WDTCNTCL or value & self.WDTHOLD:
+                self.start = self.now()
+            self.poke(self.ctl, self.WDTRD | (value & 0xff & ~self.WDTCNTCL))
+            self.schedule()
+        if self.overlaps(addr, length, self.sfrie, 4):
+            self.update_irq()
+
+
+    def update_irq(self):
+        if self.peek(self.sfrie) & self.WDTIE and self.peek(self.sfrifg) & self.WDTIFG:
+            self.emu.request_interrupt(self.vector, self.ack)
+        else:
+            self.emu.clear_interrupt(self.vector)
+
+
+    def ack(self, vector):
+        # En modo intervalo, WDTIFG se borra al aceptar la interrupción
+        self.poke(self.sfrifg, self.peek(self.sfrifg) & ~self.WDTIFG)
+
+
+class GPIO_port(Peripheral):
+    """ Puerto de entrada/salida de 8 bits con interrupciones por flanco
+        (P1 o P2). Las entradas se cambian con set_input, o se agendan con
+        schedule_edge. <on_output>, si se indica, se llama como
+        on_output(ciclo, valor) cuando cambian PxOUT o PxDIR.
+    """
+    IN, OUT, DIR, IV, IES, IE, IFG = 0x00, 0x02, 0x04, 0x0e, 0x18, 0x1a, 0x1c
+
+    def __init__(self, id = "P1", base = 0x0200, vector = 0xffde, on_output = None):
+        super(GPIO_port, self).__init__([(id, base, 0x20)])
+        self.base = base
+        self.vector = vector
+        self.on_output = on_output
+        self.inputs = 0
+
+
+    def reset(self):
+        for offs in range(0, 0x20, 2):
+            self.poke(self.base + offs, 0)
+        self.poke(self.base + self.IN, self.inputs, True)
+        self.emu.clear_interrupt(self.vector)
+
+
+    def reg(self, offs):
+        return self.peek(self.base + offs, True)
+
+
+    def outputs(self):
+        """ Niveles de los pines configurados como salida
+        """
+        return self.reg(self.OUT) & self.reg(self.DIR)
+
+
+    def set_input(self, pin, level):
+        """ Cambiar el nivel del pin <pin>. Si el flanco coincide con PxIES
+            (0: ascendente, 1: descendente) se activa su bandera en PxIFG.
+        """
+        bit = 1 << pin
+        old = self.inputs
+        self.inputs = (old | bit) if level else (old & ~bit)
+        if self.inputs == old:
+            return
+        self.poke(self.base + self.IN, self.inputs, True)
+        falling = bool(self.reg(self.IES) & bit)
+        if falling != bool(level):
+            self.poke(self.base + self.IFG, self.reg(self.IFG) | bit, True)
+        self.update_irq()
+
+
+    def schedule_edge(self, cycle, pin, level):
+        """ Agendar el cambio del pin <pin> a <level> en el ciclo <cycle>
+        """
+        return self.emu.scheduler.post(cycle,
+                                       lambda c: self.set_input(pin, level))
+
+
+    def written(self, addr, length):
+        if self.poking or not self.overlaps(addr, length, self.base, 0x20):
+            return
+        if self.overlaps(addr, length, self.base + self.IN, 1):
+            self.poke(self.base + self.IN, self.inputs, True)   # Sólo lectura
+        if self.on_output is not None and \
+                (self.overlaps(addr, length, self.base + self.OUT, 1) or
+                 self.overlaps(addr, length, self.base + self.DIR, 1)):
+            self.on_output(self.now(), self.outputs())
+        self.update_irq()
+
+
+    def pending_iv(self):
+        pending = self.reg(self.IE) & self.reg(self.IFG)
+        for pin in range(8):
+            if pending & (1 << pin):
+                return 2 * (pin + 1)
+        return 0
+
+
+    def update_irq(self):
+        iv = self.pending_iv()
+        self.poke(self.base + self.IV, iv, True)
+        if iv:
+            self.emu.request_interrupt(self.vector, self.ack)
+        else:
+            self.emu.clear_interrupt(self.vector)
+
+
+    def ack(self, vector):
+        # Igual que en Timer_A: se emula la lectura de PxIV de la rutina
+        iv = self.pending_iv()
+        self.poke(self.base + self.IFG, self.reg(self.IFG) & ~(1 << (iv//2 - 1)), True)
+        self.update_irq()
+        self.poke(self.base + self.IV, iv, True)
+
+
+def test_timer():
+    """ Interrupción de CCR0 cada 1000 ciclos (modo up), contada en R5
+    """
+    from memory import Memory
+    from msp430 import MSP430_emulator
+
+    program = (0x40b2, 999,    0x0352,      # mov   #999, &TA0CCR0
+               0x40b2, 0x0010, 0x0342,      # mov   #CCIE, &TA0CCTL0
+               0x40b2, 0x0210, 0x0340,      # mov   #TASSEL_2|MC_1, &TA0CTL
+               0xd232,                      # eint
+               0x3fff)                      # jmp   $
+    isr = (0x5035, 0x0001,                  # add   #1, r5
+           0x1300)                          # reti
+
+    memory = Memory()
+    memory.reserve("ROM", 0xfc00, 1024, "R")
+    memory.reserve("RAM", 0x1c00, 1024, "RW")
+    memory.write_block(0xfc00, b"".join(w.to_bytes(2, "little") for w in program))
+    memory.write_block(0xfc40, b"".join(w.to_bytes(2, "little") for w in isr))
+    memory.write_word(0xffea, 0xfc40)
+    memory.write_word(0xfffe, 0xfc00)
+
+    emu = MSP430_emulator(memory)
+    emu.attach(Timer_A())
+    result = emu.run_for(10500)
+    print(result, "interrupciones:", emu.registers.get_reg(5))
+
+
+def main(args):
+    test_timer()
+    return 0
+
+if __name__ == '__main__':
+    import sys
+    sys.exit(main(sys.argv))
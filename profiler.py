@@ -0,0 +1,405 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  profiler.py
+#
+#  Copyright 2020 John Coppens <john@jcoppens.com>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#  Perfil de la ejecución: dónde gasta los ciclos el programa.
+#
+#  Por cada dirección se cuentan las ejecuciones y los ciclos (en arreglos
+#  que cubren los 64K), y por cada opcode las ejecuciones (de donde sale el
+#  histograma de instrucciones y modos de direccionamiento). Una pila de
+#  llamadas paralela, que siguen call, ret, las interrupciones y reti, da
+#  el costo inclusivo de cada función.
+#  Los resultados se exportan en el formato de callgrind (kcachegrind) y
+#  en el de pilas 'colapsadas' de flamegraph.pl.
+#
+
+from array import array
+from bisect import bisect_right
+from collections import namedtuple
+import re
+
+# Marco de la pila paralela:
+#   func        dirección de entrada de la función (o rutina de interrupción)
+#   sp          SP antes de la llamada: la función terminó cuando un ret
+#               (o reti) lo deja en ese valor o más arriba
+#   start       ciclo de la entrada
+#   site        dirección de la llamada (o de la instrucción interrumpida)
+Frame = namedtuple("Frame", "func sp start site")
+
+# Instrucciones que modifican la pila de llamadas (ver Profiler.attach)
+FLOW_CALL, FLOW_RET = 1, 2
+OPCODE_RET = 0x4130             # mov @sp+, pc
+
+# Nombres de los modos de direccionamiento en el histograma
+MODE_NAMES = ("Rn", "x(Rn)", "@Rn", "@Rn+")
+
+
+def mode_name(mode, reg):
+    """ Nombre del modo de direccionamiento (<mode>, <reg>), con los casos
+        especiales del PC, el SR y los generadores de constantes
+    """
+    if mode is None:
+        return ""
+    if reg == 0 and mode == 1:
+        return "simbólico"
+    if reg == 0 and mode == 3:
+        return "#inmediato"
+    if reg == 2 and mode == 1:
+        return "&absoluto"
+    if (reg == 2 and mode >= 2) or reg == 3:
+        return "#constante"
+    return MODE_NAMES[mode]
+
+
+def read_listing(filename, base = 0xfc00):
+    """ Leer los símbolos de un listado del ensamblador (as -al, como los
+        de tests/*.lst). Las direcciones del listado son relativas a la
+        sección: se suma <base>, la dirección de .text del enlazador (ver
+        tests/test.cmd). Retorna un diccionario dirección -> nombre.
+    """
+    symbols = {}
+    pending = []            # Etiquetas que esperan la próxima instrucción
+    in_text = True
+    for line in open(filename):
+        if "\t" not in line:
+            continue
+        left, source = line.split("\t", 1)
+        fields = left.split()
+        source = source.strip()
+        if source.startswith(".text"):
+            in_text = True
+        elif source.startswith(".section") or source.startswith(".data") or \
+                source.startswith(".bss"):
+            in_text = False
+            pending = []
+        elif in_text:
+            label = re.match(r"([A-Za-z_.$][\w.$]*):", source)
+            if label:
+                pending.append(label.group(1))
+            if len(fields) >= 3 and pending:
+                addr = base + int(fields[1], 16)
+                for name in pending:
+                    symbols.setdefault(addr, name)
+                pending = []
+    return symbols
+
+
+class Profiler():
+    """ Perfil de la ejecución. Se conecta al emulador con
+        MSP430_emulator.set_profiler; los símbolos (opcionales) se cargan
+        con load_listing.
+    """
+    def __init__(self):
+        self.hits = array("L", [0]) * 0x10000       # Ejecuciones por dirección
+        self.cycles = array("Q", [0]) * 0x10000     # Ciclos por dirección
+        self.opcodes = array("L", [0]) * 0x10000    # Ejecuciones por opcode
+        self.symbols = {}           # Dirección -> nombre
+        self.functions = set()      # Direcciones de entrada de las funciones
+        self.entries = []           # Las mismas, ordenadas (ver function_of)
+        # Llamadas: (función, dirección de la llamada, llamada) ->
+        #               [cantidad, ciclos inclusivos]
+        self.calls = {}
+        # Ciclos propios de cada pila de llamadas (tupla de funciones)
+        self.stacks = {}
+        self.stack = []             # Marcos de la pila paralela (Frame)
+        self.path = ()              # Funciones de la pila, desde la raíz
+        self.mark = 0               # Ciclo del último cambio de la pila
+        self.emu = None
+
+
+    def load_listing(self, filename, base = 0xfc00):
+        """ Agregar los símbolos del listado <filename> (ver read_listing)
+        """
+        self.symbols.update(read_listing(filename, base))
+
+
+    def attach(self, emu):
+        """ Llamado por MSP430_emulator.set_profiler. La función raíz de la
+            pila es la del PC actual.
+        """
+        from msp430 import MSP430, Registers
+        self.emu = emu
+        self.reg = emu.registers.reg
+        root = self.reg[Registers.PC]
+        self.functions.add(root)
+        self.stack = []
+        self.path = (root,)
+        self.mark = emu.cycles
+        # Tipo de cada opcode para la pila (FLOW_*, o 0)
+        flow = bytearray(0x10000)
+        for opcode, dec in enumerate(MSP430.DECODE):
+            if dec is not None and dec.mnem == "call":
+                flow[opcode] = FLOW_CALL
+            elif dec is not None and dec.mnem == "reti":
+                flow[opcode] = FLOW_RET
+        flow[OPCODE_RET] = FLOW_RET
+        self.flow = flow
+        self.record = self.make_record()
+        emu.add_hook("executed", self.record)
+        emu.add_hook("interrupt", self.interrupt)
+
+
+    def detach(self):
+        """ Llamado por MSP430_emulator.set_profiler al desconectar el
+            perfil. Cierra la cuenta de la pila actual.
+        """
+        self.switch(self.emu.cycles)
+        self.emu.remove_hook("executed", self.record)
+        self.emu.remove_hook("interrupt", self.interrupt)
+        self.emu = None
+
+
+    def make_record(self):
+        """ Construir la función record(pc, dec, cycles), que cuenta la
+            instrucción <dec> en <pc>, comenzada en el ciclo <cycles> (hook
+            "executed").
+        """
+        hits, cycles, opcodes, flow = self.hits, self.cycles, self.opcodes, self.flow
+        control = self.control
+
+        def record(pc, dec, now):
+            hits[pc] += 1
+            cycles[pc] += dec.cycles
+            opcode = dec.opcode
+            opcodes[opcode] += 1
+            if flow[opcode]:
+                control(flow[opcode], pc, now + dec.cycles)
+
+        return record
+
+
+    def control(self, kind, pc, now):
+        """ Seguir un call o un ret/reti (<kind>) en <pc>, terminado en el
+            ciclo <now>
+        """
+        reg = self.reg
+        if kind == FLOW_CALL:
+            # SP antes de apilar la dirección de retorno
+            self.enter(reg[0], (reg[1] + 2) & 0xffff, pc, now)
+        else:
+            self.leave(reg[1], now)
+
+
+    def interrupt(self, vector, pc, sp, cycles):
+        """ Hook "interrupt": <pc> y <sp> son los del programa interrumpido
+            (antes de apilar PC y SR). La rutina se trata como una función
+            más.
+        """
+        self.enter(self.reg[0], sp, pc, cycles)
+
+
+    def switch(self, now):
+        """ Acumular los ciclos desde el último cambio de la pila a la pila
+            actual
+        """
+        path = self.path
+        self.stacks[path] = self.stacks.get(path, 0) + now - self.mark
+        self.mark = now
+
+
+    def enter(self, func, sp, site, now):
+        self.switch(now)
+        self.stack.append(Frame(func, sp, now, site))
+        self.path += (func,)
+        self.functions.add(func)
+
+
+    def leave(self, sp, now):
+        """ Sacar de la pila los marcos que terminan con el SP en <sp>
+            (normalmente uno; más si alguna función no retornó con ret)
+        """
+        stack = self.stack
+        if not stack or stack[-1].sp > sp:
+            return
+        self.switch(now)
+        while stack and stack[-1].sp <= sp:
+            frame = stack.pop()
+            caller = stack[-1].func if stack else self.path[0]
+            key = (caller, frame.site, frame.func)
+            call = self.calls.get(key)
+            if call is None:
+                call = self.calls[key] = [0, 0]
+            call[0] += 1
+            call[1] += now - frame.start
+        self.path = self.path[:len(stack) + 1]
+
+
+    def name(self, addr):
+        """ Nombre de la función (o dirección) <addr>
+        """
+        return self.symbols.get(addr, "0x{:04x}".format(addr))
+
+
+    def function_of(self, pc):
+        """ Función a la que pertenece <pc>: la entrada de función
+            (conocida) anterior más cercana
+        """
+        entries = self.entries
+        if len(entries) != len(self.functions):
+            # Sólo se agregan funciones: se ordena de nuevo cuando aparece
+            # alguna
+            entries = self.entries = sorted(self.functions)
+        i = bisect_right(entries, pc) - 1
+        return entries[max(i, 0)]
+
+
+    def inclusive(self):
+        """ Costo inclusivo de cada función: dirección -> [llamadas, ciclos].
+            (Con recursión, los ciclos de las llamadas anidadas se cuentan
+            más de una vez.)
+        """
+        result = {}
+        for (caller, site, func), (count, cycles) in self.calls.items():
+            total = result.setdefault(func, [0, 0])
+            total[0] += count
+            total[1] += cycles
+        return result
+
+
+    def histogram(self):
+        """ Ejecuciones por instrucción y modos de direccionamiento:
+            (mnemónico, modo fuente, modo destino) -> cantidad
+        """
+        from msp430 import MSP430
+        result = {}
+        for opcode, count in enumerate(self.opcodes):
+            if count:
+                dec = MSP430.DECODE[opcode]
+                mnem = dec.mnem + (".b" if dec.byte_op and dec.kind != "JUMP" else "")
+                key = (mnem, mode_name(dec.smode, dec.sreg),
+                       mode_name(dec.dmode, dec.dreg) if dec.kind == "DOUBLE" else "")
+                result[key] = result.get(key, 0) + count
+        return result
+
+
+    def top(self, n = 20):
+        """ Las <n> direcciones con más ciclos: lista de (dirección,
+            ejecuciones, ciclos)
+        """
+        hot = sorted((c, pc) for pc, c in enumerate(self.cycles) if c)
+        return [(pc, self.hits[pc], c) for c, pc in reversed(hot[-n:])]
+
+
+    def update(self):
+        """ Acumular los ciclos de la pila actual, para que los resultados
+            incluyan la ejecución hasta el momento
+        """
+        if self.emu is not None:
+            self.switch(self.emu.cycles)
+
+
+    def save_callgrind(self, filename):
+        """ Guardar el perfil en el formato de callgrind (para kcachegrind),
+            con las posiciones por dirección de instrucción
+        """
+        self.update()
+        by_function = {}
+        for pc, hits in enumerate(self.hits):
+            if hits:
+                by_function.setdefault(self.function_of(pc), []).append(pc)
+        calls = {}
+        for (caller, site, func), cost in self.calls.items():
+            calls.setdefault(caller, []).append((site, func, cost))
+
+        with open(filename, "w") as f:
+            f.write("# callgrind format\n"
+                    "version: 1\n"
+                    "creator: msp430.py\n"
+                    "positions: instr\n"
+                    "events: Cycles Instructions\n"
+                    "summary: {} {}\n".format(sum(self.cycles), sum(self.hits)))
+            for func in sorted(set(by_function) | set(calls)):
+                f.write("\nfn={}\n".format(self.name(func)))
+                for pc in by_function.get(func, ()):
+                    f.write("0x{:04x} {} {}\n".format(pc, self.cycles[pc], self.hits[pc]))
+                for site, callee, (count, cycles) in sorted(calls.get(func, ())):
+                    f.write("cfn={}\n"
+                            "calls={} 0x{:04x}\n"
+                            "0x{:04x} {}\n".format(self.name(callee), count,
+                                                   callee, site, cycles))
+
+
+    def save_collapsed(self, filename):
+        """ Guardar los ciclos propios de cada pila de llamadas en el formato
+            'colapsado' de flamegraph.pl (una línea 'f1;f2;f3 ciclos' por pila)
+        """
+        self.update()
+        with open(filename, "w") as f:
+            for path, cycles in sorted(self.stacks.items()):
+                if cycles:
+                    f.write("{} {}\n".format(";".join(self.name(func) for func in path),
+                                             cycles))
+
+
+def test_profile():
+    """ Un lazo que llama a una subrutina, con la interrupción de un timer
+    """
+    from memory import Memory
+    from msp430 import MSP430_emulator
+    from peripherals import Timer_A
+
+    program = (0x40b2, 499,    0x0352,      # mov   #499, &TA0CCR0
+               0x40b2, 0x0010, 0x0342,      # mov   #CCIE, &TA0CCTL0
+               0x40b2, 0x0210, 0x0340,      # mov   #TASSEL_2|MC_1, &TA0CTL
+               0xd232,                      # eint
+               0x4036, 10,                  # mov   #10, r6     (fc14)
+               0x12b0, 0xfc20,              # call  #fc20
+               0x3ffb,                      # jmp   fc14
+               0x3fff,                      # jmp   $
+               0x8316,                      # dec   r6          (fc20)
+               0x23fe,                      # jnz   fc20
+               0x4130)                      # ret
+    isr = (0x5315,                          # inc   r5
+           0x1300)                          # reti
+
+    memory = Memory()
+    memory.reserve("ROM", 0xfc00, 1024, "R")
+    memory.reserve("RAM", 0x1c00, 1024, "RW")
+    memory.write_block(0xfc00, b"".join(w.to_bytes(2, "little") for w in program))
+    memory.write_block(0xfc40, b"".join(w.to_bytes(2, "little") for w in isr))
+    memory.write_word(0xffea, 0xfc40)
+    memory.write_word(0xfffe, 0xfc00)
+
+    emu = MSP430_emulator(memory)
+    emu.attach(Timer_A())
+    profiler = Profiler()
+    profiler.symbols.update({0xfc00: "main", 0xfc20: "delay", 0xfc40: "timer_isr"})
+    emu.set_profiler(profiler)
+    print(emu.run_for(10000))
+
+    for pc, hits, cycles in profiler.top(5):
+        print("{:04x} {:>8} {:>8}".format(pc, hits, cycles))
+    for func, (count, cycles) in sorted(profiler.inclusive().items()):
+        print("{:<12} {:>6} llamadas {:>8} ciclos".format(profiler.name(func), count, cycles))
+    for key, count in sorted(profiler.histogram().items()):
+        print("{:<8} {:<12} {:<12} {:>8}".format(*key, count))
+    profiler.update()
+    for path, cycles in sorted(profiler.stacks.items()):
+        print(";".join(profiler.name(func) for func in path), cycles)
+
+
+def main(args):
+    test_profile()
+    return 0
+
+if __name__ == '__main__':
+    import sys
+    sys.exit(main(sys.argv))
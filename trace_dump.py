@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  trace_dump.py
+#
+#  Copyright 2020 John Coppens <john@jcoppens.com>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#  Conversión a texto de los archivos de trace (ver tracer.py).
+#
+#  Uso: trace_dump.py trace [programa.hex]
+#
+#  Con el archivo .hex del programa las instrucciones se desensamblan
+#  completas (con sus operandos); si no, sólo se muestra el mnemónico.
+#
+
+from msp430 import MSP430, MSP430_disassembler, Registers
+from memory import Memory
+from tracer import read_trace, DST_REG, DST_BYTE, DST_WORD, DST_INTERRUPT
+
+
+def full_sr(rec):
+    """ El SR al terminar la instrucción, con las banderas pendientes del
+        registro <rec> (ver tracer.py)
+    """
+    if rec.flags == 0:
+        return rec.sr
+    regs = Registers(0, 0)
+    regs.reg[Registers.SR] = rec.sr
+    regs.pending = ((rec.flags & 0x7f) - 1, rec.a, rec.b, rec.result,
+                    (rec.flags & 0x80) != 0)
+    regs.materialize()
+    return regs.reg[Registers.SR]
+
+
+def format_records(records, disassembler = None):
+    """ Generar una línea de texto por cada registro de <records>. Con un
+        <disassembler> (MSP430_disassembler con el programa cargado) las
+        instrucciones se desensamblan de la memoria.
+    """
+    if MSP430.DECODE is None:
+        MSP430.build_decode_table()
+    for rec in records:
+        if rec.kind == DST_INTERRUPT:
+            yield "{:>12}  {:04x}  *** interrupción, vector {:04x} -> {:04x}".format(
+                        rec.cycles, rec.pc, rec.dst, rec.value)
+            continue
+
+        text = None
+        if disassembler is not None and disassembler.memory.initialized(rec.pc):
+            result = disassembler.disassemble_one(rec.pc)
+            if result is not None:
+                text = result[1]
+        if text is None:
+            dec = MSP430.DECODE[rec.opcode]
+            text = "{:04x}".format(rec.opcode) if dec is None else dec.mnem
+
+        if rec.kind == DST_REG:
+            effect = "R{} = {:04x}".format(rec.dst, rec.value)
+        elif rec.kind == DST_BYTE:
+            effect = "[{:04x}] = {:02x}".format(rec.dst, rec.value)
+        elif rec.kind == DST_WORD:
+            effect = "[{:04x}] = {:04x}".format(rec.dst, rec.value)
+        else:
+            effect = ""
+        yield "{:>12}  {:04x}  {:<28}{:<16}SR={:04x}".format(
+                    rec.cycles, rec.pc, text, effect, full_sr(rec))
+
+
+def main(args):
+    if len(args) < 2:
+        print("Uso: {} trace [programa.hex]".format(args[0]))
+        return 1
+    disassembler = None
+    if len(args) > 2:
+        # Toda la memoria en un área (MSP430 necesita una llamada RAM, y el
+        # vector de reset)
+        memory = Memory()
+        memory.reserve("RAM", 0, 0x10000, "RW")
+        memory.load_intel(args[2])
+        if not memory.initialized(0xfffe):
+            memory.write_word(0xfffe, 0)
+        disassembler = MSP430_disassembler(memory)
+
+    for line in format_records(read_trace(args[1]), disassembler):
+        print(line)
+    return 0
+
+if __name__ == '__main__':
+    import sys
+    sys.exit(main(sys.argv))
@@ -0,0 +1,403 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  tracer.py
+#
+#  Copyright 2020 John Coppens <john@jcoppens.com>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#  Registro de la ejecución (trace).
+#
+#  Cada instrucción ejecutada se guarda en un buffer circular preasignado,
+#  que conserva las últimas N instrucciones. Opcionalmente el buffer se
+#  copia a un archivo cada vez que se llena. Durante la ejecución no se
+#  formatea nada: el buffer guarda los valores tal cual (ver Tracer.to_record),
+#  que pasan a registros binarios de tamaño fijo recién al copiarlos al
+#  archivo o al leerlos. trace_dump.py decodifica los registros a texto.
+#
+
+import struct
+from collections import namedtuple
+
+# Registro del trace (little endian, 28 bytes):
+#   pc          dirección de la instrucción
+#   opcode      primera palabra de la instrucción (0 en las interrupciones)
+#   kind        qué modificó la instrucción (ver DST_*)
+#   flags       operación de la ALU pendiente al terminar la instrucción
+#               (ver Registers.defer_flags): 0 si no hay ninguna, si no su
+#               tipo (FLAGS_*) + 1, con el bit 7 en 1 si es de byte
+#   dst         registro o dirección de memoria modificada (en las
+#               interrupciones, el vector)
+#   value       nuevo valor del destino (en las interrupciones, la dirección
+#               de la rutina)
+#   sr          el SR, sin las banderas pendientes
+#   a, b        operandos y resultado de la operación pendiente: el SR
+#   result      completo se calcula al decodificar (ver trace_dump.py)
+#   cycles      ciclo de reloj al comienzo de la instrucción
+RECORD = struct.Struct("<HHBBHHHHHIQ")
+Trace_record = namedtuple("Trace_record",
+            "pc opcode kind flags dst value sr a b result cycles")
+
+DST_NONE      = 0       # Sin destino (saltos, cmp, bit, ...)
+DST_REG       = 1       # Registro
+DST_BYTE      = 2       # Byte de memoria
+DST_WORD      = 3       # Palabra de memoria
+DST_INTERRUPT = 4       # Aceptación de una interrupción
+
+# Encabezado de los archivos: identificación, versión y tamaño del registro
+HEADER = struct.Struct("<8sHH")
+MAGIC = b"MSP430TR"
+VERSION = 1
+
+
+class Tracer():
+    """ Trace de la ejecución en un buffer circular de <size> registros.
+        Si se indica <stream> (un nombre de archivo, o un archivo binario
+        abierto) se copian allí todos los registros, por bloques: el buffer
+        entero cada vez que se llena (ver flush).
+        Se conecta al emulador con MSP430_emulator.set_tracer.
+    """
+    def __init__(self, size = 65536, stream = None):
+        self.size = size
+        self.buffer = [None] * size     # Entradas (ver to_record)
+        self.pos = 0            # Posición del próximo registro en el buffer
+        self.laps = 0           # Vueltas completas del buffer
+        self.streamed = 0       # Posición hasta donde se copió el buffer
+        self.owns_stream = isinstance(stream, str)
+        if self.owns_stream:
+            stream = open(stream, "wb")
+        self.stream = stream
+        if stream is not None:
+            stream.write(HEADER.pack(MAGIC, VERSION, RECORD.size))
+        self.emu = None
+
+
+    def attach(self, emu):
+        """ Llamado por MSP430_emulator.set_tracer. El emulador envuelve su
+            tabla de ejecución con wrap_handler (ver make_wrap_handler).
+        """
+        self.emu = emu
+        self.regs = emu.registers
+        # Destino de cada opcode (y largo de la instrucción), calculado la
+        # primera vez que se ejecuta (ver destination), y las funciones de
+        # dirección ya construidas
+        self.destinations = [None] * 0x10000
+        self.functions = {}
+        self.wrap_handler = self.make_wrap_handler()
+        emu.add_hook("interrupt", self.interrupt)
+
+
+    def detach(self):
+        """ Llamado por MSP430_emulator.set_tracer al desconectar el trace
+        """
+        self.emu.remove_hook("interrupt", self.interrupt)
+        self.emu = None
+
+
+    def destination(self, dec):
+        """ Qué modifica la instrucción <dec>: (DST_REG, registro),
+            (DST_BYTE o DST_WORD, función address(src_x, dst_x)) o
+            (DST_NONE, None), más el largo de la instrucción. La función se
+            evalúa después de ejecutar la instrucción, con los registros ya
+            modificados (como en MSP430_emulator.make_storer). Las escrituras
+            de los periféricos no cuentan: el destino sale sólo de la
+            instrucción.
+        """
+        from msp430 import Registers
+        stores = dec.kind in ("DOUBLE", "SINGLE") and \
+                 dec.mnem not in ("cmp", "bit", "push", "call")
+        width = DST_BYTE if dec.byte_op else DST_WORD
+        length = 2 + 2 * (dec.src_ext + dec.dst_ext)
+        if dec.mnem in ("push", "call"):
+            # El nuevo tope de la pila (call guarda siempre una palabra)
+            key = ("sp",)
+            width = DST_WORD if dec.mnem == "call" else width
+        elif not stores:
+            return DST_NONE, None, length
+        elif dec.kind == "DOUBLE":
+            if dec.dmode == 0:
+                return DST_REG, dec.dreg, length
+            if dec.dreg == Registers.CG2:
+                return DST_NONE, None, length
+            if dec.dreg in (Registers.PC, Registers.SR):
+                key = ("dst_x",)                # Simbólico, absoluto
+            else:
+                key = ("dst", dec.dreg)         # x(Rn)
+        else:
+            mode, reg = dec.smode, dec.sreg
+            if mode == 0:
+                return DST_REG, reg, length
+            if reg == Registers.CG2 or \
+                    (mode >= 2 and reg in (Registers.PC, Registers.CG1)):
+                return DST_NONE, None, length   # Constante, #x
+            if mode == 1:
+                key = ("src_x",) if reg in (Registers.PC, Registers.SR) else ("src", reg)
+            elif mode == 2:
+                key = ("ind", reg, 0)           # @Rn
+            else:
+                # @Rn+: la dirección leída, antes del incremento
+                key = ("ind", reg, 1 if dec.byte_op and reg != Registers.SP else 2)
+
+        functions = self.functions
+        if key not in functions:
+            reg = self.regs.reg
+            if key[0] == "sp":
+                address = lambda src_x, dst_x: reg[Registers.SP]
+            elif key[0] == "dst_x":
+                address = lambda src_x, dst_x: dst_x
+            elif key[0] == "src_x":
+                address = lambda src_x, dst_x: src_x
+            elif key[0] == "dst":
+                r = key[1]
+                address = lambda src_x, dst_x: (reg[r] + dst_x) & 0xffff
+            elif key[0] == "src":
+                r = key[1]
+                address = lambda src_x, dst_x: (reg[r] + src_x) & 0xffff
+            else:
+                r, step = key[1], key[2]
+                address = lambda src_x, dst_x: (reg[r] - step) & 0xffff
+            functions[key] = address
+        return width, functions[key], length
+
+
+    def make_wrap_handler(self):
+        """ Construir la función wrap_handler(handler), que retorna un
+            handler de la tabla de ejecución (ver
+            MSP430_emulator.update_dispatch) que ejecuta la instrucción con
+            <handler> y la registra. El ciclo del comienzo de la instrucción
+            es emu.cycles (ver run_loop). Son clausuras para no buscar los
+            atributos en cada instrucción.
+        """
+        tracer, emu = self, self.emu
+        buffer, size = self.buffer, self.size
+        regs = self.regs
+        reg = regs.reg
+        # El valor guardado se lee del area, no a través de las trampas de
+        # los hooks de memoria y los watchpoints (ver Memory.watch_page): el
+        # trace no debe producir accesos propios
+        area_at = emu.memory.area_at
+        destinations, destination = self.destinations, self.destination
+
+        def wrap_handler(handler):
+            def trace(dec, src_x, dst_x):
+                next_pc = reg[0]
+                handler(dec, src_x, dst_x)
+                opcode = dec.opcode
+                info = destinations[opcode]
+                if info is None:
+                    info = destinations[opcode] = destination(dec)
+                kind, dst, length = info
+                if kind == DST_REG:
+                    value = reg[dst]
+                elif kind == DST_NONE:
+                    dst = value = 0
+                else:
+                    dst = dst(src_x, dst_x)
+                    area = area_at(dst)
+                    if kind == DST_BYTE:
+                        value = area.read(dst, False)
+                    else:
+                        value = area.read_word(dst, False)
+                pos = tracer.pos
+                buffer[pos] = ((next_pc - length) & 0xffff, opcode, kind, dst,
+                               value, reg[2], regs.pending, emu.cycles)
+                pos += 1
+                if pos == size:
+                    tracer.wrap()
+                    pos = 0
+                tracer.pos = pos
+
+            return trace
+
+        return wrap_handler
+
+
+    def interrupt(self, vector, pc, sp, cycles):
+        """ Registrar la aceptación de la interrupción de <vector> (hook
+            "interrupt", después de saltar a la rutina)
+        """
+        reg = self.regs.reg
+        self.buffer[self.pos] = (reg[0], 0, DST_INTERRUPT, vector, reg[0],
+                                 reg[2], None, cycles)
+        self.pos += 1
+        if self.pos == self.size:
+            self.wrap()
+            self.pos = 0
+
+
+    @staticmethod
+    def to_record(entry):
+        """ Convertir una entrada del buffer, (pc, opcode, kind, dst, value,
+            sr, pending, cycles) con la operación pendiente de la ALU tal
+            como está en Registers.pending, a Trace_record
+        """
+        pc, opcode, kind, dst, value, sr, pending, cycles = entry
+        if pending is None:
+            return Trace_record(pc, opcode, kind, 0, dst, value, sr, 0, 0, 0,
+                                cycles)
+        flags, a, b, result, byte_op = pending
+        return Trace_record(pc, opcode, kind,
+                            (flags + 1) | (0x80 if byte_op else 0), dst, value,
+                            sr, a, b, result, cycles)
+
+
+    def pack(self, start, end):
+        """ Las entradas del buffer entre <start> y <end> (excluido) como
+            registros binarios (RECORD)
+        """
+        data = bytearray((end - start) * RECORD.size)
+        pack_into, size, to_record = RECORD.pack_into, RECORD.size, self.to_record
+        for i in range(start, end):
+            pack_into(data, (i - start) * size, *to_record(self.buffer[i]))
+        return data
+
+
+    def wrap(self):
+        """ El buffer se llenó: copiarlo al archivo (si hay uno) y volver a
+            empezar
+        """
+        if self.stream is not None:
+            self.stream.write(self.pack(self.streamed, self.size))
+            self.streamed = 0
+        self.laps += 1
+
+
+    @property
+    def total(self):
+        """ Registros guardados desde el comienzo
+        """
+        return self.laps * self.size + self.pos
+
+
+    def flush(self):
+        """ Copiar al archivo los registros que todavía no se copiaron
+        """
+        if self.stream is not None:
+            self.stream.write(self.pack(self.streamed, self.pos))
+            self.streamed = self.pos
+            self.stream.flush()
+
+
+    def close(self):
+        """ Terminar el archivo (ver flush). Si el Tracer lo abrió, lo cierra.
+        """
+        if self.stream is not None:
+            self.flush()
+            if self.owns_stream:
+                self.stream.close()
+            self.stream = None
+
+
+    def __len__(self):
+        return min(self.total, self.size)
+
+
+    def records(self):
+        """ Iterar sobre los registros del buffer (Trace_record), del más
+            viejo al más nuevo
+        """
+        if self.total >= self.size:
+            ranges = ((self.pos, self.size), (0, self.pos))
+        else:
+            ranges = ((0, self.pos),)
+        for start, end in ranges:
+            for i in range(start, end):
+                yield self.to_record(self.buffer[i])
+
+
+    def save(self, filename):
+        """ Guardar los registros del buffer (las últimas instrucciones) en
+            <filename>, en el mismo formato que <stream>
+        """
+        with open(filename, "wb") as f:
+            f.write(HEADER.pack(MAGIC, VERSION, RECORD.size))
+            if self.total >= self.size:
+                f.write(self.pack(self.pos, self.size))
+            f.write(self.pack(0, self.pos))
+
+
+def read_trace(filename, chunk_records = 4096):
+    """ Iterar sobre los registros (Trace_record) de un archivo generado por
+        Tracer, leyéndolo por bloques
+    """
+    with open(filename, "rb") as f:
+        magic, version, size = HEADER.unpack(f.read(HEADER.size))
+        if magic != MAGIC or version != VERSION or size != RECORD.size:
+            raise ValueError("{}: no es un archivo de trace".format(filename))
+        while True:
+            chunk = f.read(chunk_records * RECORD.size)
+            if not chunk:
+                break
+            for fields in RECORD.iter_unpack(chunk):
+                yield Trace_record._make(fields)
+
+
+def test_trace():
+    """ Escrituras a los registros de un timer: el timer modifica TAR
+        (0x350) al mismo tiempo, pero el destino es el de cada instrucción
+    """
+    from memory import Memory
+    from msp430 import MSP430_emulator
+    from peripherals import Timer_A
+
+    program = (0x40b2, 99, 0x0352,          # mov   #99, &TA0CCR0
+               0x40b2, 0x0210, 0x0340,      # mov   #TASSEL_2|MC_1, &TA0CTL
+               0x4031, 0x1c40,              # mov   #1c40, sp
+               0x1230, 0x1234,              # push  #1234
+               0x4035, 0x1c3e,              # mov   #1c3e, r5
+               0x43f5, 0x0003,              # mov.b #-1, 3(r5)
+               0x1135,                      # rra   @r5+
+               0x3fff)                      # jmp   $
+    memory = Memory()
+    memory.reserve("ROM", 0xfc00, 1024, "R")
+    memory.reserve("RAM", 0x1c00, 1024, "RW")
+    memory.write_block(0xfc00, b"".join(w.to_bytes(2, "little") for w in program))
+    memory.write_word(0xfffe, 0xfc00)
+
+    emu = MSP430_emulator(memory)
+    emu.attach(Timer_A())
+    tracer = Tracer(size = 16)
+    emu.set_tracer(tracer)
+    snap = emu.snapshot()
+    emu.run(7)
+    for rec in tracer.records():
+        print(rec)
+    assert [(rec.kind, rec.dst, rec.value) for rec in tracer.records()] == [
+                (DST_WORD, 0x0352, 99), (DST_WORD, 0x0340, 0x0210),
+                (DST_REG, 1, 0x1c40), (DST_WORD, 0x1c3e, 0x1234),
+                (DST_REG, 5, 0x1c3e), (DST_BYTE, 0x1c41, 0xff),
+                (DST_WORD, 0x1c3e, 0x091a)]
+
+    # Un watchpoint de lectura no se toca con las escrituras del programa
+    # (el trace no lee la memoria por las trampas)
+    from msp430 import WATCH_READ, STOP_WATCHPOINT
+    reads = []
+    emu.add_hook("read", lambda addr, length, value: reads.append(addr), 0x1c00, 0x2000)
+    emu.add_watchpoint(0x1c00, 0x2000, WATCH_READ)
+    emu.restore(snap)
+    result = emu.run(6)
+    print(result)
+    assert result.reason != STOP_WATCHPOINT and result.count == 6 and not reads
+
+
+def main(args):
+    test_trace()
+    return 0
+
+if __name__ == '__main__':
+    import sys
+    sys.exit(main(sys.argv))
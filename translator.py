@@ -0,0 +1,443 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  translator.py
+#
+#  Copyright 2020 John Coppens <john@jcoppens.com>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#  Traducción de bloques básicos a funciones de Python.
+#
+#  Un bloque es una secuencia de instrucciones que termina en un salto, un
+#  call, una escritura al PC, o antes de la primera instrucción que no se
+#  sabe traducir (ésta la ejecuta el intérprete). Para cada bloque se genera
+#  el código fuente de una función, con los operandos, modos y banderas
+#  resueltos, y se compila con compile().
+#
+
+from collections import namedtuple
+from msp430 import Registers, FLAGS_ADD, FLAGS_SUB, FLAGS_LOGIC, FLAGS_XOR, \
+                   FLAGS_CARRY
+
+# Bloque traducido:
+#   start, end  direcciones del bloque (end: la siguiente a la última palabra)
+#   count       cantidad de instrucciones
+#   cycles      ciclos de todo el bloque
+#   head        ciclos de todas las instrucciones menos la última
+#   prefix      prefix[n]: ciclos de las primeras n instrucciones
+#   inner       direcciones de las instrucciones (sin la primera), para
+#               verificar los breakpoints
+#   run         la función: run(now, stop, budget) ejecuta el bloque a partir
+#               del ciclo <now> y retorna la cantidad de instrucciones
+#               ejecutadas. Si el bloque termina en un salto a su comienzo,
+#               sigue dando vueltas mientras no se llegue al ciclo <stop>, ni
+#               a un evento, ni a <budget> instrucciones.
+#   source      el código fuente generado
+#
+# Los ciclos de n instrucciones del bloque son
+#   (n // count) * cycles + prefix[n % count]
+Block = namedtuple("Block", "start end count cycles head prefix inner run source")
+
+
+class Translation_error(Exception):
+    """ El bloque traducido no hizo lo mismo que el intérprete (ver
+        MSP430_emulator.verify_block)
+    """
+    pass
+
+
+class Translator():
+    MAX_INSTRUCTIONS = 32
+
+    # Instrucciones de dos operandos: (expresión del resultado, tipo de
+    # banderas, si usa el carry, si guarda el resultado). En las expresiones
+    # s y d son los operandos ya recortados al ancho W, y c el carry.
+    DOUBLE = {
+        "mov":  ("s",                   None,        False, True),
+        "add":  ("d + s",               FLAGS_ADD,   False, True),
+        "addc": ("s + d + c",           FLAGS_ADD,   True,  True),
+        "sub":  ("d + (~s & W) + 1",    FLAGS_SUB,   False, True),
+        "subc": ("d + (~s & W) + c",    FLAGS_SUB,   True,  True),
+        "cmp":  ("d + (~s & W) + 1",    FLAGS_SUB,   False, False),
+        "and":  ("d & s",               FLAGS_LOGIC, False, True),
+        "bit":  ("d & s",               FLAGS_LOGIC, False, False),
+        "xor":  ("d ^ s",               FLAGS_XOR,   False, True),
+        "bic":  ("d & ~s & W",          None,        False, True),
+        "bis":  ("d | s",               None,        False, True),
+    }
+    SINGLE = ("rrc", "rra", "swpb", "sxt", "push", "call")
+
+    # Condiciones de los saltos en función de las banderas
+    CONDITIONS = {
+        "jnz":  "not ({Z})",
+        "jz":   "{Z}",
+        "jnc":  "not ({C})",
+        "jc":   "{C}",
+        "jn":   "{N}",
+        "jge":  "bool({N}) == bool({V})",
+        "jl":   "bool({N}) != bool({V})",
+        "jmp":  "True",
+    }
+
+    def __init__(self, emu):
+        self.emu = emu
+
+
+    def operand(self, mode, reg, x, next_pc, byte_op):
+        """ Descripción de un operando (fuente, destino, u operando de una
+            instrucción de un operando), igual que en
+            MSP430_emulator.make_loader. Retorna (valor, dirección, registro,
+            incremento): <valor> es la expresión del operando si no está en
+            la memoria; si no <dirección> es la expresión de su dirección, y
+            en el modo autoincremento se suma <incremento> a <registro>
+            después de leerlo.
+        """
+        if reg == Registers.CG2:
+            return ("0", "1", "2", "-1")[mode], None, None, 0
+        if reg == Registers.CG1 and mode >= 2:
+            return ("4" if mode == 2 else "8"), None, None, 0
+        if mode == 0:
+            if reg == Registers.PC:
+                return "0x{:04x}".format(next_pc), None, None, 0
+            return "reg[{}]".format(reg), None, None, 0
+        if mode == 1:
+            if reg in (Registers.PC, Registers.CG1):    # Simbólico, absoluto
+                return None, "0x{:04x}".format(x), None, 0
+            return None, "(reg[{}] + 0x{:04x}) & 0xffff".format(reg, x), None, 0
+        if reg == Registers.PC:
+            if mode == 2:                               # @PC
+                return None, "0x{:04x}".format(next_pc), None, 0
+            return "0x{:04x}".format(x), None, None, 0  # Inmediato
+        if mode == 2:
+            return None, "reg[{}]".format(reg), None, 0
+        step = 1 if byte_op and reg != Registers.SP else 2
+        return None, "reg[{}]".format(reg), reg, step
+
+
+    def destination(self, mode, reg, operand):
+        """ Dónde se guarda el resultado: 'reg', 'pc', 'mem', None (no se
+            guarda: constantes e inmediatos) o False (el SR, que puede apagar
+            la CPU, no se traduce). <operand> es la descripción del operando
+            (ver operand).
+        """
+        if operand[1] is not None:
+            return "mem"
+        if mode != 0 or reg == Registers.CG2:
+            return None
+        if reg == Registers.SR:
+            return False
+        return "pc" if reg == Registers.PC else "reg"
+
+
+    def analyze(self, entry):
+        """ Retorna la descripción de la instrucción de <entry> (del icache)
+            para generar su código, o None si no se sabe traducir
+        """
+        dec, src_x, dst_x, next_pc = entry
+        if dec.op_id == self.emu.IDLE_JUMP:
+            return None                 # Lo maneja el lazo de ejecución
+        info = {"dec": dec, "src_x": src_x, "dst_x": dst_x, "next": next_pc,
+                "sets_flags": False, "reads_sr": False, "writes_mem": False,
+                "ends": False}
+
+        if dec.kind == "JUMP":
+            info["ends"] = True
+            return info
+
+        if dec.kind == "DOUBLE":
+            if dec.mnem not in self.DOUBLE:
+                return None             # dadd
+            expr, flags, carry, store = self.DOUBLE[dec.mnem]
+            src = self.operand(dec.smode, dec.sreg, src_x, next_pc, dec.byte_op)
+            # Como destino, x(R3) es el modo absoluto (ver build_decode_table)
+            dreg = Registers.CG1 if dec.dmode == 1 and dec.dreg == Registers.CG2 else dec.dreg
+            dst = self.operand(dec.dmode, dreg, dst_x, next_pc, dec.byte_op)
+            where = self.destination(dec.dmode, dreg, dst) if store else None
+            if where is False:
+                return None
+            info.update(src = src, dst = dst, where = where,
+                        reads_dst = dec.mnem != "mov",
+                        sets_flags = flags is not None,
+                        reads_sr = (dec.smode == 0 and dec.sreg == Registers.SR) or
+                                   (dec.dmode == 0 and dreg == Registers.SR and
+                                    dec.mnem != "mov"),
+                        writes_mem = where == "mem",
+                        ends = where == "pc")
+            return info
+
+        if dec.kind == "SINGLE" and dec.mnem in self.SINGLE:
+            src = self.operand(dec.smode, dec.sreg, src_x, next_pc, dec.byte_op)
+            if dec.mnem in ("push", "call"):
+                where = None
+            else:
+                where = self.destination(dec.smode, dec.sreg, src)
+                if where is False or where == "pc":
+                    return None
+            info.update(src = src, where = where,
+                        sets_flags = dec.mnem in ("rrc", "rra", "sxt"),
+                        reads_sr = dec.smode == 0 and dec.sreg == Registers.SR,
+                        writes_mem = where == "mem" or dec.mnem in ("push", "call"),
+                        ends = dec.mnem == "call")
+            return info
+
+        return None                     # reti
+
+
+    def translate(self, start):
+        """ Traducir el bloque que empieza en <start>. Retorna un Block, o
+            None si la primera instrucción no se sabe traducir.
+        """
+        emu = self.emu
+        instrs = []
+        pc = start
+        while len(instrs) < self.MAX_INSTRUCTIONS:
+            entry = emu.icache.get(pc) or emu.fetch(pc)
+            if entry is None:
+                break
+            info = self.analyze(entry)
+            if info is None:
+                break
+            info["pc"] = pc
+            instrs.append(info)
+            pc = entry[3]
+            if info["ends"]:
+                break
+        if not instrs:
+            return None
+
+        prefix = [0]
+        for info in instrs:
+            prefix.append(prefix[-1] + info["dec"].cycles)
+        source = self.generate(instrs, prefix)
+        namespace = {}
+        exec(compile(source, "<bloque 0x{:04x}>".format(start), "exec"), namespace)
+        regs, memory = emu.registers, emu.memory
+        run = namespace["make_block"](regs.reg, regs, regs.materialize,
+                                      memory.read, memory.read_word,
+                                      memory.write, memory.write_word,
+                                      emu, emu.scheduler)
+        return Block(start, pc, len(instrs), prefix[-1],
+                     prefix[-1] - instrs[-1]["dec"].cycles, tuple(prefix),
+                     frozenset(info["pc"] for info in instrs[1:]),
+                     run, source)
+
+
+    def pending_needed(self, instrs, i):
+        """ Las banderas de la instrucción <i> deben quedar registradas
+            (Registers.pending) si ninguna instrucción posterior del bloque
+            las reemplaza antes de que alguien pueda leerlas: una lectura
+            del SR, o una escritura a la memoria (que puede terminar el
+            bloque antes de tiempo).
+        """
+        for k in range(i + 1, len(instrs)):
+            if instrs[k]["reads_sr"]:
+                return True
+            if instrs[k]["sets_flags"]:
+                return any(instrs[j]["writes_mem"] for j in range(i, k))
+        return True
+
+
+    def flag(self, setter, name):
+        """ Expresión de la bandera <name> (C, Z, N o V) según la última
+            instrucción que modificó las banderas. Si fue en un bloque
+            anterior se lee el SR (variable sr).
+        """
+        if setter is None:
+            return "(sr & 0x{:x})".format(Registers.FL_MASKS[name])
+        kind, a, b, r, width, msb = setter
+        res = "({} & 0x{:x})".format(r, width)
+        if name == "Z":
+            return "not " + res
+        if name == "N":
+            return "({} & 0x{:x})".format(r, msb)
+        if name == "C":
+            if kind in (FLAGS_ADD, FLAGS_SUB):
+                return "({} > 0x{:x})".format(r, width)
+            if kind == FLAGS_CARRY:
+                return a
+            return "({} != 0)".format(res)
+        if kind == FLAGS_ADD:
+            return "(({a} ^ {r}) & ({b} ^ {r}) & 0x{m:x})".format(a = a, b = b, r = res, m = msb)
+        if kind == FLAGS_SUB:
+            return "(({a} ^ {b}) & ({b} ^ {r}) & 0x{m:x})".format(a = a, b = b, r = res, m = msb)
+        if kind == FLAGS_XOR:
+            return "({} & {} & 0x{:x})".format(a, b, msb)
+        return "0"
+
+
+    def generate(self, instrs, prefix):
+        """ Generar el código fuente de la función del bloque
+        """
+        count, cycles = len(instrs), prefix[-1]
+        head = cycles - instrs[-1]["dec"].cycles
+        start = instrs[0]["pc"]
+        final = instrs[-1]["dec"]
+        # Un bloque que termina en un salto a su comienzo es un lazo: se
+        # repite dentro de la función. t es el ciclo al comienzo de cada
+        # vuelta, y k las instrucciones de las vueltas anteriores.
+        loops = final.kind == "JUMP" and \
+                (instrs[-1]["next"] + final.offset * 2) & 0xffff == start
+        lines = ["def make_block(reg, regs, materialize, read, read_word, write, write_word, emu, sched):",
+                 "    def block(now, stop, budget):",
+                 "        t = now"]
+        if loops:
+            lines += ["        k = 0",
+                      "        while True:"]
+        indent = " " * (12 if loops else 8)
+        out = lambda line: lines.append(indent + line)
+        done = (lambda n: "k + {}".format(n)) if loops else str
+        setter = None                   # Última instrucción que fijó banderas
+        sr_loaded = False               # sr ya tiene el SR actualizado
+        last = len(instrs) - 1
+
+        def read_flags(*names):
+            nonlocal sr_loaded
+            if setter is None and not sr_loaded:
+                out("if regs.pending is not None: materialize()")
+                out("sr = reg[2]")
+                sr_loaded = True
+            return {name: self.flag(setter, name) for name in names}
+
+        def store_mem(i, info, addr, value, word = True):
+            out("reg[0] = 0x{:04x}".format(info["next"]))
+            out("emu.cycles = t + {}".format(prefix[i]))
+            out("{}({}, {})".format("write_word" if word else "write", addr, value))
+
+        def load(name, operand, mask, byte_op):
+            """ Leer el operando en la variable <name>. Retorna la expresión
+                de su dirección, si está en la memoria.
+            """
+            value, addr, inc_reg, inc = operand
+            if value is not None:
+                out("{} = {} & 0x{:x}".format(name, value, mask))
+                return None
+            if not addr.startswith("0x"):
+                out("{}_a = {}".format(name, addr))
+                addr = name + "_a"
+            out("{} = {}({}) & 0x{:x}".format(name, "read" if byte_op else "read_word", addr, mask))
+            if inc:
+                out("reg[{r}] = (reg[{r}] + {}) & 0xffff".format(inc, r = inc_reg))
+            return addr
+
+        def early_exit(i):
+            if i < last:
+                out("if sched.next_event <= t + {}: return {}".format(prefix[i + 1], done(i + 1)))
+
+        for i, info in enumerate(instrs):
+            dec = info["dec"]
+            width = 0xff if dec.byte_op else 0xffff
+            msb = 0x80 if dec.byte_op else 0x8000
+            out("# 0x{:04x} {}{}".format(info["pc"], dec.mnem, ".b" if dec.byte_op else ""))
+            if info["reads_sr"]:
+                out("if regs.pending is not None: materialize()")
+
+            if dec.kind == "JUMP":
+                target = (info["next"] + dec.offset * 2) & 0xffff
+                if dec.mnem == "jmp":
+                    out("reg[0] = 0x{:04x}".format(target))
+                else:
+                    cond = self.CONDITIONS[dec.mnem].format(**read_flags("C", "Z", "N", "V"))
+                    out("reg[0] = 0x{:04x} if {} else 0x{:04x}".format(target, cond, info["next"]))
+                continue
+
+            s, d, r = "s{}".format(i), "d{}".format(i), "r{}".format(i)
+            if dec.kind == "DOUBLE":
+                expr, flags, carry, store = self.DOUBLE[dec.mnem]
+                load(s, info["src"], width, dec.byte_op)
+                if info["reads_dst"]:
+                    addr = load(d, info["dst"], width, dec.byte_op)
+                else:
+                    addr = info["dst"][1]
+                if carry:
+                    out("c{} = 1 if {} else 0".format(i, read_flags("C")["C"]))
+                out("{} = {}".format(r, expr.replace("c", "c{}".format(i))
+                                           .replace("W", "0x{:x}".format(width))
+                                           .replace("s", s).replace("d", d)))
+                if flags is not None:
+                    if flags in (FLAGS_ADD, FLAGS_SUB, FLAGS_XOR):
+                        setter = (flags, s, d, r, width, msb)
+                    else:
+                        setter = (flags, "0", "0", r, width, msb)
+                    sr_loaded = False
+                    if self.pending_needed(instrs, i):
+                        out("regs.pending = ({}, {}, {}, {}, {})".format(
+                            flags, setter[1], setter[2], r, dec.byte_op))
+                value = "{} & 0x{:x}".format(r, width) if flags in (FLAGS_ADD, FLAGS_SUB) else r
+                where = info["where"]
+                if where == "reg":
+                    out("reg[{}] = {}".format(dec.dreg, value))
+                elif where == "pc":
+                    out("reg[0] = {}".format(value))
+                elif where == "mem":
+                    store_mem(i, info, addr, value, not dec.byte_op)
+                    early_exit(i)
+                continue
+
+            # Instrucciones de un operando
+            mnem = dec.mnem
+            if mnem == "push":
+                load(s, info["src"], width, dec.byte_op)
+                out("sp = reg[1] - 2")
+                store_mem(i, info, "sp", "{} & 0xff".format(s) if dec.byte_op else s,
+                          not dec.byte_op)
+                out("reg[1] = sp & 0xffff")
+                early_exit(i)
+                continue
+            if mnem == "call":
+                load(s, info["src"], 0xffff, False)
+                out("sp = reg[1] - 2")
+                store_mem(i, info, "sp", "0x{:04x}".format(info["next"]))
+                out("reg[1] = sp & 0xffff")
+                out("reg[0] = {} & 0xffff".format(s))
+                continue
+
+            addr = load(s, info["src"], 0xffff if mnem in ("swpb", "sxt") else width, dec.byte_op)
+            if mnem == "rrc":
+                c = read_flags("C")["C"]
+                out("{} = ({} >> 1) | (0x{:x} if {} else 0)".format(r, s, msb, c))
+                setter = (FLAGS_CARRY, "({} & 1)".format(s), "0", r, width, msb)
+            elif mnem == "rra":
+                out("{} = ({} >> 1) | ({} & 0x{:x})".format(r, s, s, msb))
+                setter = (FLAGS_CARRY, "({} & 1)".format(s), "0", r, width, msb)
+            elif mnem == "swpb":
+                out("{} = (({} << 8) & 0xff00) + ({} >> 8)".format(r, s, s))
+            else:                       # sxt
+                out("{} = ({} | 0xff00) if {} & 0x80 else ({} & 0xff)".format(r, s, s, s))
+                setter = (FLAGS_LOGIC, "0", "0", r, 0xffff, 0x8000)
+            if mnem != "swpb":
+                sr_loaded = False
+                if self.pending_needed(instrs, i):
+                    out("regs.pending = ({}, {}, 0, {}, {})".format(
+                        setter[0], setter[1], r, dec.byte_op and mnem != "sxt"))
+            if info["where"] == "reg":
+                out("reg[{}] = {}".format(dec.sreg, r))
+            elif info["where"] == "mem":
+                store_mem(i, info, addr, r, not dec.byte_op)
+                early_exit(i)
+
+        if not (instrs[-1]["ends"] or instrs[-1]["writes_mem"]):
+            out("reg[0] = 0x{:04x}".format(instrs[-1]["next"]))
+        if loops:
+            out("k += {}".format(count))
+            out("t += {}".format(cycles))
+            out("if reg[0] != 0x{:04x} or k + {} > budget or t + {} >= stop or \\".format(
+                    start, count, head))
+            out("        t + {} >= sched.next_event: return k".format(head))
+        else:
+            out("return {}".format(count))
+        lines.append("    return block")
+        return "\n".join(lines) + "\n"